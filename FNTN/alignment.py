@@ -5,7 +5,8 @@ from typing import List, Dict, Tuple
 from termcolor import cprint, colored
 import os
 import csv
-import pickle
+
+from serialization import dump_pickle, load_pickle
 
 
 ALIGNMENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_alignment')
@@ -127,20 +128,18 @@ class UserAlignment:
             if i % 1000 == 0:
                 print('Initialize {}, {}/{}'.format(self.__class__.__name__, str(i+1), str(len_to_iterate)))
 
-    def dump(self, file_name: str = None):
+    def dump(self, file_name: str = None, compress_level=0, background=False):
         file_name = file_name or self.file_name_to_load_and_dump or 'UserAlignment.pkl'
-        with open(os.path.join(ALIGNMENT_PATH, file_name), 'wb') as f:
-            pickle.dump(self, f)
+        dump_pickle(self, os.path.join(ALIGNMENT_PATH, file_name), compress_level=compress_level, background=background)
         cprint('Dumped: {0}'.format(file_name), 'blue')
 
     def load(self, file_name: str = None):
         file_name = file_name or self.file_name_to_load_and_dump or 'UserAlignment.pkl'
         try:
-            with open(os.path.join(ALIGNMENT_PATH, file_name), 'rb') as f:
-                loaded: UserAlignment = pickle.load(f)
-                self.user_to_alignment = loaded.user_to_alignment
-                self.user_to_following_media = loaded.user_to_following_media
-                self.file_name_to_load_and_dump = loaded.file_name_to_load_and_dump
+            loaded: UserAlignment = load_pickle(os.path.join(ALIGNMENT_PATH, file_name))
+            self.user_to_alignment = loaded.user_to_alignment
+            self.user_to_following_media = loaded.user_to_following_media
+            self.file_name_to_load_and_dump = loaded.file_name_to_load_and_dump
             cprint('Load: {0}'.format(file_name), 'green')
             return True
         except Exception as e:
@@ -0,0 +1,259 @@
+import math
+import os
+from typing import List
+
+import numpy as np
+from termcolor import cprint
+
+from network import UserNetwork, NETWORK_PATH
+from serialization import atomic_open
+from user_array import USER_DTYPE, to_user_array, is_in_user_array, hash_user_ids, dump_user_array, \
+    load_user_array
+
+CRAWL_INDEX_PATH = os.path.join(NETWORK_PATH, "crawl_index")
+PENDING_LIMIT = 1000000  # Pending users to be compacted into an exact shard
+
+
+class BloomFilter:
+
+    def __init__(self, num_bits: int, num_hashes: int, bits: np.ndarray = None):
+        """
+        :param num_bits: size of the filter in bits
+        :param num_hashes: number of hash functions (double hashing of two splitmix64 hashes)
+        :param bits: packed np.uint8 array of num_bits bits
+        """
+        self.num_bits = int(num_bits)
+        self.num_hashes = int(num_hashes)
+        self.bits = bits if bits is not None else np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+
+    @classmethod
+    def for_capacity(cls, capacity: int, error_rate: float = 0.01) -> "BloomFilter":
+        num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        num_hashes = max(1, int(round(num_bits / max(capacity, 1) * math.log(2))))
+        return cls(num_bits, num_hashes)
+
+    def _positions(self, user_ids) -> np.ndarray:
+        """
+        :return: np.uint64 array of shape (num_hashes, len(user_ids))
+        """
+        h1 = hash_user_ids(user_ids, seed=0)
+        h2 = hash_user_ids(user_ids, seed=1) | np.uint64(1)
+        with np.errstate(over="ignore"):
+            return np.stack([(h1 + np.uint64(i) * h2) % np.uint64(self.num_bits) for i in range(self.num_hashes)])
+
+    def add_many(self, user_ids):
+        positions = self._positions(user_ids).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                         np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+    def might_contain_many(self, user_ids) -> np.ndarray:
+        positions = self._positions(user_ids)
+        is_set = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return np.all(is_set == 1, axis=0)
+
+    def __or__(self, other: "BloomFilter") -> "BloomFilter":
+        assert (self.num_bits, self.num_hashes) == (other.num_bits, other.num_hashes), "Filters are not mergeable"
+        return BloomFilter(self.num_bits, self.num_hashes, np.bitwise_or(self.bits, other.bits))
+
+
+class CrawledUserIndex:
+
+    def __init__(self, name: str, capacity: int = 10 ** 8, error_rate: float = 0.01, index_path=None):
+        """
+        Users who were crawled (including error users), to plan a new crawl frontier without loading networks.
+        BloomFilter rejects most new users in O(1), and the rest are confirmed by binary search on exact shards.
+            - Users added after the last dump are pending, and checkpoint appends them to pending.log.
+            - Shards and the BloomFilter are rewritten only at dump, i.e., at PENDING_LIMIT or at the end of a crawl.
+
+        :param name: directory name of the index in index_path
+        :param capacity: expected number of crawled users, which sizes the BloomFilter
+        """
+        self.name = name
+        self.index_path = index_path or CRAWL_INDEX_PATH
+        self.bloom = BloomFilter.for_capacity(capacity, error_rate)
+
+        # Disjoint sorted arrays of crawled users with their file ids (None if not dumped), sorted runs of users
+        # added after the last compaction, and batches added after the last checkpoint (not in pending.log yet).
+        self.shards: List[np.ndarray] = []
+        self.shard_ids: List[int] = []
+        self.pending_runs: List[np.ndarray] = []
+        self.unlogged: List[np.ndarray] = []
+        self.is_dumped = True
+
+    def __len__(self):
+        return sum(len(s) for s in self.shards) + self.num_pending
+
+    @property
+    def num_pending(self) -> int:
+        return sum(len(r) for r in self.pending_runs) + sum(len(b) for b in self.unlogged)
+
+    def contains_many(self, user_ids) -> np.ndarray:
+        user_ids = np.asarray(user_ids, dtype=USER_DTYPE)
+        mask = self.bloom.might_contain_many(user_ids)
+        candidates = np.flatnonzero(mask)
+        if len(candidates) == 0:
+            return mask
+
+        confirmed = np.zeros(len(candidates), dtype=bool)
+        for shard in self.shards + self.pending_runs + self.unlogged:
+            confirmed |= is_in_user_array(user_ids[candidates], shard)
+        mask[candidates] = confirmed
+        return mask
+
+    def filter_not_crawled(self, user_ids) -> np.ndarray:
+        user_ids = np.asarray(user_ids, dtype=USER_DTYPE)
+        return user_ids[~self.contains_many(user_ids)]
+
+    def add(self, user_ids):
+        """
+        :param user_ids: iterable of int (or numeric str) user ids; 'ROOT' is ignored.
+        """
+        user_ids = to_user_array([u for u in user_ids if str(u).isdigit()])
+        user_ids = self.filter_not_crawled(user_ids)
+        if len(user_ids) == 0:
+            return
+        self.bloom.add_many(user_ids)
+        self.unlogged.append(user_ids)
+        self.is_dumped = False
+
+    def add_network(self, net: UserNetwork):
+        self.add(net.user_id_to_friend_ids.keys())
+        self.add(net.user_id_to_follower_ids.keys())
+        self.add(net.error_user_set)
+
+    @staticmethod
+    def _push_run(runs: List[np.ndarray], run: np.ndarray, run_ids: List[int] = None):
+        """
+        Append a sorted run disjoint from runs, merged with previous runs smaller than twice its size,
+        so that runs are O(log n) with sizes at least doubling from the last, and each user is copied O(log n) times.
+        """
+        while runs and len(runs[-1]) < 2 * len(run):
+            run = np.sort(np.concatenate((runs.pop(), run)))
+            if run_ids is not None:
+                run_ids.pop()
+        runs.append(run)
+        if run_ids is not None:
+            run_ids.append(None)
+
+    def _sort_unlogged(self):
+        if self.unlogged:
+            self._push_run(self.pending_runs, np.sort(np.concatenate(self.unlogged)))
+            self.unlogged = []
+
+    def compact(self):
+        """
+        Move pending users into a new shard, merged with previous shards as pending runs.
+        """
+        self._sort_unlogged()
+        if self.pending_runs:
+            self._push_run(self.shards, np.sort(np.concatenate(self.pending_runs)), self.shard_ids)
+            self.pending_runs = []
+
+    def merge(self, other: "CrawledUserIndex"):
+        other.compact()
+        self.compact()
+        self.bloom = self.bloom | other.bloom
+        # Users of other in self are dropped, so that shards stay disjoint.
+        new_users = [shard[~self.contains_many(shard)] for shard in other.shards]
+        new_users = np.sort(np.concatenate(new_users)) if new_users else np.asarray([], dtype=USER_DTYPE)
+        if len(new_users) > 0:
+            self._push_run(self.shards, new_users, self.shard_ids)
+            self.is_dumped = False
+
+    def _get_dir(self):
+        return os.path.join(self.index_path, self.name)
+
+    def _get_shard_file(self, shard_id: int):
+        return os.path.join(self._get_dir(), "crawled_{}.npy".format(shard_id))
+
+    def _get_bloom_file(self):
+        return os.path.join(self._get_dir(), "bloom.npz")
+
+    def _get_log_file(self):
+        return os.path.join(self._get_dir(), "pending.log")
+
+    def checkpoint(self):
+        """
+        Dump the index if PENDING_LIMIT users are pending (or it was never dumped), otherwise append users
+        added since the last checkpoint to pending.log, which load replays.
+        """
+        if self.num_pending >= PENDING_LIMIT or not os.path.exists(self._get_bloom_file()):
+            self.dump()
+        elif self.unlogged:
+            os.makedirs(self._get_dir(), exist_ok=True)
+            with open(self._get_log_file(), "ab") as f:
+                for user_ids in self.unlogged:
+                    user_ids.astype(USER_DTYPE).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            self._sort_unlogged()
+
+    def dump(self):
+        if self.is_dumped and os.path.exists(self._get_bloom_file()):
+            return
+        self.compact()
+        index_dir = self._get_dir()
+        os.makedirs(index_dir, exist_ok=True)
+        dumped_ids = set(self._get_dumped_shard_ids())
+        next_id = max([i for i in self.shard_ids if i is not None] + list(dumped_ids) + [-1]) + 1
+        for i, shard in enumerate(self.shards):
+            if self.shard_ids[i] is None:  # Shards are immutable once dumped.
+                self.shard_ids[i], next_id = next_id, next_id + 1
+                dump_user_array(shard, self._get_shard_file(self.shard_ids[i]))
+        # bloom.npz lists the shards of the index, so shards merged away and the log are removed after it.
+        with atomic_open(self._get_bloom_file()) as f:
+            np.savez(f, bits=self.bloom.bits, num_bits=self.bloom.num_bits, num_hashes=self.bloom.num_hashes,
+                     shard_ids=np.asarray(self.shard_ids, dtype=np.int64))
+        for shard_id in dumped_ids - set(self.shard_ids):
+            os.remove(self._get_shard_file(shard_id))
+        if os.path.exists(self._get_log_file()):
+            os.remove(self._get_log_file())
+        self.unlogged, self.is_dumped = [], True
+        cprint("Dumped: {} with {} users in {} shards".format(index_dir, len(self), len(self.shards)), "blue")
+
+    def _get_dumped_shard_ids(self) -> List[int]:
+        return [int(f[len("crawled_"):-len(".npy")]) for f in os.listdir(self._get_dir())
+                if f.startswith("crawled_") and f.endswith(".npy")]
+
+    def load(self) -> bool:
+        index_dir = self._get_dir()
+        try:
+            with np.load(self._get_bloom_file()) as loaded:
+                self.bloom = BloomFilter(int(loaded["num_bits"]), int(loaded["num_hashes"]), loaded["bits"])
+                self.shard_ids = loaded["shard_ids"].tolist() if "shard_ids" in loaded \
+                    else list(range(int(loaded["num_shards"])))
+            self.shards = [load_user_array(self._get_shard_file(i)) for i in self.shard_ids]
+            self.pending_runs, self.unlogged, self.is_dumped = [], [], True
+        except FileNotFoundError as e:
+            cprint("Load Failed: {}, {}".format(index_dir, e), "red")
+            return False
+
+        # Users logged after the last dump, where a partially written id at the end is skipped.
+        if os.path.exists(self._get_log_file()):
+            num_logged = os.path.getsize(self._get_log_file()) // np.dtype(USER_DTYPE).itemsize
+            logged = to_user_array(np.fromfile(self._get_log_file(), dtype=USER_DTYPE, count=num_logged))
+            logged = self.filter_not_crawled(logged)
+            if len(logged) > 0:
+                self.bloom.add_many(logged)
+                self.pending_runs.append(logged)
+                self.is_dumped = False
+        cprint("Loaded: {} with {} users in {} shards and {} pending".format(
+            index_dir, len(self), len(self.shards), self.num_pending), "green")
+        return True
+
+
+def get_or_create_crawled_user_index(name: str, network_files: list = None, capacity: int = 10 ** 8,
+                                     index_path=None) -> CrawledUserIndex:
+    """
+    :param network_files: file names of UserNetwork to build the index from if it does not exist.
+    """
+    index = CrawledUserIndex(name, capacity=capacity, index_path=index_path)
+    if index.load():
+        return index
+    for network_file in (network_files or []):
+        user_network = UserNetwork()
+        user_network.load(file_name=network_file)
+        index.add_network(user_network)
+        index.compact()
+    index.dump()
+    return index
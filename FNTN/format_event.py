@@ -4,7 +4,8 @@ from typing import Callable, Dict, Tuple, List
 from termcolor import cprint
 import os
 import pprint
-import pickle
+
+from serialization import dump_pickle, load_pickle
 
 
 EVENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_event')
@@ -45,26 +46,24 @@ class FormattedEvent:
     def pprint(self):
         pprint.pprint(self.__dict__)
 
-    def dump(self, file_name=None, event_path=None):
+    def dump(self, file_name=None, event_path=None, compress_level=0, background=False):
         file_name = file_name or 'FormattedEvent_{}.pkl'.format(self.get_twitter_year())
         event_path = event_path or EVENT_PATH
-        with open(os.path.join(event_path, file_name), 'wb') as f:
-            pickle.dump(self, f)
+        dump_pickle(self, os.path.join(event_path, file_name), compress_level=compress_level, background=background)
         cprint('Dumped: {0}'.format(file_name), "blue")
 
     def load(self, file_name=None, event_path=None):
         file_name = file_name or 'FormattedEvent_{}.pkl'.format(self.get_twitter_year())
         try:
             event_path = event_path or EVENT_PATH
-            with open(os.path.join(event_path, file_name), 'rb') as f:
-                loaded: FormattedEvent = pickle.load(f)
-                self.parent_to_children = loaded.parent_to_children
-                self.child_to_parent_and_story = loaded.child_to_parent_and_story
-                self.story_to_users = loaded.story_to_users
-                self.user_to_stories = loaded.user_to_stories
-                self.user_to_id = loaded.user_to_id
-                self.tweet_id_to_story_id = loaded.tweet_id_to_story_id
-                self.story_to_events = loaded.story_to_events
+            loaded: FormattedEvent = load_pickle(os.path.join(event_path, file_name))
+            self.parent_to_children = loaded.parent_to_children
+            self.child_to_parent_and_story = loaded.child_to_parent_and_story
+            self.story_to_users = loaded.story_to_users
+            self.user_to_stories = loaded.user_to_stories
+            self.user_to_id = loaded.user_to_id
+            self.tweet_id_to_story_id = loaded.tweet_id_to_story_id
+            self.story_to_events = loaded.story_to_events
             cprint('Loaded: {0}'.format(file_name), "green")
             return True
         except:
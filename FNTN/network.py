@@ -1,13 +1,31 @@
 # -*- coding: utf-8 -*-
 from termcolor import colored, cprint
 from utill import *
+from serialization import dump_pickle, load_pickle, atomic_open
 import os
-import pickle
+import re
+import numpy as np
 import networkx as nx
 
 NETWORK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data_network')
 
 
+def get_network_file_list(file_name: str = None, network_path=None, is_sliced=False) -> list:
+    """
+    :return: list of file names that UserNetwork.load reads, in the order of loading.
+    """
+    network_path = network_path or NETWORK_PATH
+    if file_name is None or is_sliced:
+        file_name = "SlicedUserNetwork" if file_name is None else file_name.replace(".pkl", "")
+        # Only slices of file_name ({file_name}_{slice_id}.pkl), not other networks of the same prefix.
+        slice_pattern = re.compile(r"{}_\d+\.pkl$".format(re.escape(file_name)))
+        target_file_list = [f for f in os.listdir(network_path) if slice_pattern.match(f)]
+        if not target_file_list:
+            raise FileNotFoundError
+        return target_file_list
+    return [file_name]
+
+
 class UserNetwork:
 
     def __init__(self,
@@ -36,12 +54,18 @@ class UserNetwork:
             self.dump_file_id if self.dump_file_id else os.getpid(),
         ), color))
 
-    def _sliced_dump(self, slice_id: int, network_path: str, file_prefix="SlicedUserNetwork"):
+    def _sliced_dump(self, slice_id: int, network_path: str, file_prefix="SlicedUserNetwork", **dump_kwargs):
         file_name = "{}_{}.pkl".format(file_prefix, str(slice_id))
-        with open(os.path.join(network_path, file_name), 'wb') as f:
-            pickle.dump(self, f)
+        dump_pickle(self, os.path.join(network_path, file_name), **dump_kwargs)
 
-    def dump(self, given_file_name: str = None, file_slice: int = 11, network_path=None, is_sliced=False):
+    def dump(self, given_file_name: str = None, file_slice: int = 11, network_path=None, is_sliced=False,
+             compress_level: int = 0, background: bool = False, with_index: bool = True):
+        """
+        :param compress_level: zlib level of serialization.dump_pickle (0: plain pickle)
+        :param background: write files in background threads (see serialization.wait_for_pending_dumps)
+        :param with_index: write UserNetworkIndex as a sidecar (index_*.npz) of the dumped network
+        """
+        dump_kwargs = dict(compress_level=compress_level, background=background)
         network_path = network_path or NETWORK_PATH
         if given_file_name is None or is_sliced:
             file_name = "SlicedUserNetwork" if given_file_name is None else given_file_name.replace(".pkl", "")
@@ -55,30 +79,29 @@ class UserNetwork:
                     user_set={u for i, u in enumerate(self.user_set) if i % file_slice == slice_idx},
                     error_user_set={u for i, u in enumerate(self.error_user_set) if i % file_slice == slice_idx},
                 )
-                sliced_network._sliced_dump(slice_idx, network_path=network_path, file_prefix=file_name)
+                sliced_network._sliced_dump(slice_idx, network_path=network_path, file_prefix=file_name,
+                                            **dump_kwargs)
         else:
             file_name = given_file_name
-            with open(os.path.join(network_path, file_name), 'wb') as f:
-                pickle.dump(self, f)
+            dump_pickle(self, os.path.join(network_path, file_name), **dump_kwargs)
+        if with_index:
+            self.get_index().dump(file_name, network_path=network_path)
         self.print_info('Dumped', file_name, 'blue')
 
     def _sliced_load(self, file_name: str, network_path: str):
-        with open(os.path.join(network_path, file_name), 'rb') as f:
-            loaded: UserNetwork = pickle.load(f)
-            self.dump_file_id = loaded.dump_file_id
-            self.user_id_to_follower_ids = merge_dicts(self.user_id_to_follower_ids, loaded.user_id_to_follower_ids)
-            self.user_id_to_friend_ids = merge_dicts(self.user_id_to_friend_ids, loaded.user_id_to_friend_ids)
-            self.user_set.update(loaded.user_set)
-            self.error_user_set.update(loaded.error_user_set)
+        loaded: UserNetwork = load_pickle(os.path.join(network_path, file_name))
+        self.dump_file_id = loaded.dump_file_id
+        self.user_id_to_follower_ids = merge_dicts(self.user_id_to_follower_ids, loaded.user_id_to_follower_ids)
+        self.user_id_to_friend_ids = merge_dicts(self.user_id_to_friend_ids, loaded.user_id_to_friend_ids)
+        self.user_set.update(loaded.user_set)
+        self.error_user_set.update(loaded.error_user_set)
 
     def load(self, file_name: str = None, network_path=None, is_sliced=False):
         try:
             network_path = network_path or NETWORK_PATH
             if file_name is None or is_sliced:
                 file_name = "SlicedUserNetwork" if file_name is None else file_name.replace(".pkl", "")
-                target_file_list = [f for f in os.listdir(network_path) if f.startswith(file_name)]
-                if not target_file_list:
-                    raise FileNotFoundError
+                target_file_list = get_network_file_list(file_name, network_path, is_sliced=True)
                 for i, network_file in enumerate(target_file_list):
                     self._sliced_load(network_file, network_path=network_path)
                     self.print_info("{} ({}/{})".format(file_name, i+1, len(target_file_list)), network_file, "green")
@@ -100,6 +123,9 @@ class UserNetwork:
     def get_num_of_crawled_users(self) -> int:
         return max(len(self.user_id_to_friend_ids.keys()), len(self.user_id_to_follower_ids.keys()))
 
+    def get_index(self):
+        return UserNetworkIndex.from_network(self)
+
     def to_networkx(self) -> nx.DiGraph:
         g = nx.DiGraph()
 
@@ -122,6 +148,186 @@ class UserNetwork:
         return g
 
 
+class UserNetworkIndex:
+
+    FOLLOWER_CRAWLED = 1
+    FRIEND_CRAWLED = 2
+    ERROR = 4
+
+    def __init__(self, user_ids: np.ndarray, follower_counts: np.ndarray, friend_counts: np.ndarray,
+                 flags: np.ndarray, num_users: int, num_crawled_users: int):
+        """
+        Degrees and crawl status of UserNetwork, which can be queried without loading adjacency.
+
+        :param user_ids: sorted np.uint64 array of crawled or error users ('ROOT' is excluded)
+        :param follower_counts: in-degree (len of follower ids) of each user, -1 if not crawled or None
+        :param friend_counts: out-degree (len of friend ids) of each user, -1 if not crawled or None
+        :param flags: bits of FOLLOWER_CRAWLED, FRIEND_CRAWLED, and ERROR
+        :param num_users: len of UserNetwork.user_set
+        :param num_crawled_users: UserNetwork.get_num_of_crawled_users()
+        """
+        self.user_ids = user_ids
+        self.follower_counts = follower_counts
+        self.friend_counts = friend_counts
+        self.flags = flags
+        self.num_users = num_users
+        self.num_crawled_users = num_crawled_users
+
+    @classmethod
+    def _to_ids_and_counts(cls, user_id_to_x_ids: dict) -> (np.ndarray, np.ndarray):
+        items = [(int(u), len(x_ids) if x_ids is not None else -1)
+                 for u, x_ids in user_id_to_x_ids.items() if str(u).isdigit()]
+        ids = np.asarray([u for u, _ in items], dtype=np.uint64)
+        counts = np.asarray([c for _, c in items], dtype=np.int64)
+        return ids, counts
+
+    @classmethod
+    def from_network(cls, net: UserNetwork):
+        follower_keys, follower_counts = cls._to_ids_and_counts(net.user_id_to_follower_ids)
+        friend_keys, friend_counts = cls._to_ids_and_counts(net.user_id_to_friend_ids)
+        error_ids = np.asarray([int(u) for u in net.error_user_set if str(u).isdigit()], dtype=np.uint64)
+
+        user_ids = np.unique(np.concatenate((follower_keys, friend_keys, error_ids)))
+        flags = np.zeros(len(user_ids), dtype=np.uint8)
+
+        index_follower_counts = np.full(len(user_ids), -1, dtype=np.int64)
+        follower_idx = np.searchsorted(user_ids, follower_keys)
+        index_follower_counts[follower_idx] = follower_counts
+        flags[follower_idx] |= cls.FOLLOWER_CRAWLED
+
+        index_friend_counts = np.full(len(user_ids), -1, dtype=np.int64)
+        friend_idx = np.searchsorted(user_ids, friend_keys)
+        index_friend_counts[friend_idx] = friend_counts
+        flags[friend_idx] |= cls.FRIEND_CRAWLED
+
+        flags[np.searchsorted(user_ids, error_ids)] |= cls.ERROR
+
+        return cls(user_ids, index_follower_counts, index_friend_counts, flags,
+                   num_users=len(net.user_set), num_crawled_users=net.get_num_of_crawled_users())
+
+    @classmethod
+    def merge(cls, index_list: list, num_users: int, num_crawled_users: int):
+        """
+        Index of a network dumped in slices, from the indexes of its slices (e.g., prune_network_files).
+            - A user crawled in more than one slice keeps the count of the slice crawled last.
+
+        :param num_users: len of user_set of the whole network
+        :param num_crawled_users: get_num_of_crawled_users() of the whole network
+        """
+        concat_ids = np.concatenate([index.user_ids for index in index_list] + [np.asarray([], dtype=np.uint64)])
+        user_ids, position = np.unique(concat_ids, return_inverse=True)
+        follower_counts = np.full(len(user_ids), -1, dtype=np.int64)
+        friend_counts = np.full(len(user_ids), -1, dtype=np.int64)
+        flags = np.zeros(len(user_ids), dtype=np.uint8)
+        offset = 0
+        for index in index_list:
+            idx = position[offset:offset + len(index.user_ids)]
+            for counts, index_counts, flag in ((follower_counts, index.follower_counts, cls.FOLLOWER_CRAWLED),
+                                               (friend_counts, index.friend_counts, cls.FRIEND_CRAWLED)):
+                is_crawled = (index.flags & flag) != 0
+                counts[idx[is_crawled]] = index_counts[is_crawled]
+            flags[idx] |= index.flags
+            offset += len(index.user_ids)
+        return cls(user_ids, follower_counts, friend_counts, flags,
+                   num_users=num_users, num_crawled_users=num_crawled_users)
+
+    @classmethod
+    def get_file_name(cls, network_file_name: str):
+        return "index_{}.npz".format(network_file_name.replace(".pkl", ""))
+
+    def dump(self, network_file_name: str, network_path=None):
+        network_path = network_path or NETWORK_PATH
+        file_name = self.get_file_name(network_file_name)
+        with atomic_open(os.path.join(network_path, file_name)) as f:
+            np.savez(f, user_ids=self.user_ids, follower_counts=self.follower_counts,
+                     friend_counts=self.friend_counts, flags=self.flags,
+                     num_users=self.num_users, num_crawled_users=self.num_crawled_users)
+
+    @classmethod
+    def load(cls, network_file_name: str = None, network_path=None):
+        """
+        :param network_file_name: file name (or prefix if sliced) given to UserNetwork.dump
+        """
+        network_path = network_path or NETWORK_PATH
+        file_name = cls.get_file_name(network_file_name or "SlicedUserNetwork")
+        with np.load(os.path.join(network_path, file_name)) as loaded:
+            index = cls(loaded["user_ids"], loaded["follower_counts"], loaded["friend_counts"], loaded["flags"],
+                        num_users=int(loaded["num_users"]), num_crawled_users=int(loaded["num_crawled_users"]))
+        cprint("Loaded: {} of {} users".format(file_name, len(index.user_ids)), "green")
+        return index
+
+    def _get_position(self, user_id) -> int or None:
+        i = int(np.searchsorted(self.user_ids, np.uint64(int(user_id))))
+        if i < len(self.user_ids) and self.user_ids[i] == np.uint64(int(user_id)):
+            return i
+        return None
+
+    def _get_counts(self, what: str) -> np.ndarray:
+        assert what == "follower" or what == "friend"
+        return self.follower_counts if what == "follower" else self.friend_counts
+
+    def get_num_of_crawled_users(self) -> int:
+        return self.num_crawled_users
+
+    def get_num_of_error_users(self) -> int:
+        return int(np.count_nonzero(self.flags & self.ERROR))
+
+    def get_degree(self, user_id, what: str = "follower") -> int or None:
+        """
+        :return: number of followers (or friends) of user_id in the crawl, None if not crawled or error.
+        """
+        i = self._get_position(user_id)
+        if i is None or self._get_counts(what)[i] < 0:
+            return None
+        return int(self._get_counts(what)[i])
+
+    def is_crawled(self, user_id, what: str = "follower") -> bool:
+        i = self._get_position(user_id)
+        flag = self.FOLLOWER_CRAWLED if what == "follower" else self.FRIEND_CRAWLED
+        return i is not None and bool(self.flags[i] & flag)
+
+    def is_error_user(self, user_id) -> bool:
+        i = self._get_position(user_id)
+        return i is not None and bool(self.flags[i] & self.ERROR)
+
+    def get_degree_array(self, what: str = "follower") -> np.ndarray:
+        """
+        :return: degrees of users with non-None lists in descending order
+        """
+        counts = self._get_counts(what)
+        return -np.sort(-counts[counts >= 0])
+
+    def top_k(self, k: int, what: str = "follower") -> list:
+        """
+        :return: list of (user_id, degree) of k users with the largest degree
+        """
+        counts = self._get_counts(what)
+        k = min(k, len(counts))
+        if k <= 0:
+            return []
+        top_idx = np.argpartition(-counts, k - 1)[:k]
+        top_idx = top_idx[np.argsort(-counts[top_idx], kind="stable")]
+        return [(int(self.user_ids[i]), int(counts[i])) for i in top_idx if counts[i] >= 0]
+
+    def degree_histogram(self, what: str = "follower", bins=80, range=None) -> (np.ndarray, np.ndarray):
+        """
+        :return: (hist, bin_edges) of np.histogram
+        """
+        return np.histogram(self.get_degree_array(what), bins=bins, range=range)
+
+    def print_stats(self, what: str = "follower"):
+        degrees = self.get_degree_array(what)
+        print("Users: {}, Crawled users: {}, Error users: {}".format(
+            self.num_users, self.num_crawled_users, self.get_num_of_error_users()))
+        if len(degrees) == 0:
+            return
+        print("Smallest: {}".format(degrees[-1]))
+        print("Largest: {}".format(degrees[0]))
+        print("Mean: {}".format(float(np.mean(degrees))))
+        print("Stdev: {}".format(float(np.std(degrees))))
+        print("Median: {}".format(float(np.median(degrees))))
+
+
 def get_or_create_user_networkx(user_network_file=None, networkx_file=None, path=None):
     path = path or NETWORK_PATH
     networkx_file = networkx_file or "UserNetworkX.gpickle"
@@ -0,0 +1,187 @@
+from typing import Iterator, Tuple
+
+import numpy as np
+from scipy import sparse
+from termcolor import cprint
+
+from network import UserNetwork
+from network_array import AdjacencyArray
+from network_matrix import AdjMatrix, SparseAdjMatrix
+from user_array import USER_DTYPE, to_user_array, is_in_user_array
+
+BLOCK_SIZE = 10000  # Rows of users computed at once
+
+
+def _to_edges(adjacency: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: (keys, values) of edges in an adjacency dict of UserNetwork, where 'ROOT' is skipped.
+    """
+    adjacency = {k: v for k, v in adjacency.items() if str(k).isdigit()}
+    adjacency_array = AdjacencyArray(adjacency)
+    keys = np.fromiter((int(k) for k in adjacency_array.keys), dtype=USER_DTYPE, count=len(adjacency_array))
+    return np.repeat(keys, np.diff(adjacency_array.offsets)), adjacency_array.values
+
+
+class FollowGraph:
+
+    def __init__(self, users: np.ndarray, sources: np.ndarray, targets: np.ndarray):
+        """
+        Follow graph as a sparse matrix: A[i, j] = 1 if users[i] follows users[j].
+        Friends of a user are its row of A, and followers are its row of A^T.
+
+        :param users: sorted np.ndarray of USER_DTYPE, the vertices
+        :param sources: positions of followers in users
+        :param targets: positions of followees in users
+        """
+        self.users = users
+        n = len(users)
+        a = sparse.csr_matrix((np.ones(len(sources), dtype=np.float64), (sources, targets)), shape=(n, n))
+        a.sum_duplicates()
+        a.data[:] = 1
+        self.matrices = {"friends": a, "followers": a.T.tocsr()}
+
+    @classmethod
+    def from_user_network(cls, net: UserNetwork) -> "FollowGraph":
+        friend_keys, friend_values = _to_edges(net.user_id_to_friend_ids)
+        follower_keys, follower_values = _to_edges(net.user_id_to_follower_ids)
+        sources = np.concatenate((friend_keys, follower_values))
+        targets = np.concatenate((friend_values, follower_keys))
+        users = to_user_array(np.concatenate((sources, targets)))
+        graph = cls(users, np.searchsorted(users, sources), np.searchsorted(users, targets))
+        cprint("FollowGraph: {} users and {} edges".format(len(users), graph.matrices["friends"].nnz), "green")
+        return graph
+
+    @classmethod
+    def from_adj_matrix(cls, adj: AdjMatrix) -> "FollowGraph":
+        """
+        :param adj: AdjMatrix or SparseAdjMatrix, where 1 is 'row follows col'
+        """
+        positive = adj.masks.positive.tocoo() if isinstance(adj, SparseAdjMatrix) \
+            else sparse.coo_matrix(np.asarray(adj.arr) == 1)
+        sources = np.asarray(adj.row_vertices, dtype=USER_DTYPE)[positive.row]
+        targets = np.asarray(adj.col_vertices, dtype=USER_DTYPE)[positive.col]
+        users = to_user_array(np.concatenate((np.asarray(adj.row_vertices, dtype=USER_DTYPE),
+                                              np.asarray(adj.col_vertices, dtype=USER_DTYPE))))
+        return cls(users, np.searchsorted(users, sources), np.searchsorted(users, targets))
+
+    def __len__(self):
+        return len(self.users)
+
+    def get_indices(self, user_ids) -> np.ndarray:
+        """
+        :return: np.int64 array of positions of user_ids, -1 for users not in the graph
+        """
+        user_ids = np.asarray(user_ids, dtype=USER_DTYPE).reshape(-1)
+        idx = np.searchsorted(self.users, user_ids).astype(np.int64)
+        idx[~is_in_user_array(user_ids, self.users)] = -1
+        return idx
+
+    def _get_rows(self, user_ids, kind: str) -> sparse.csr_matrix:
+        # Users not in the graph have empty rows.
+        idx = self.get_indices(user_ids)
+        rows = self.matrices[kind][np.maximum(idx, 0)]
+        return sparse.diags((idx != -1).astype(np.float64)) @ rows
+
+    def get_degrees(self, user_ids, kind: str = "followers") -> np.ndarray:
+        return np.asarray(self._get_rows(user_ids, kind).sum(axis=1)).reshape(-1).astype(np.int64)
+
+    def iter_common_neighbor_blocks(self, us, vs=None, kind: str = "followers", weighted: bool = False,
+                                    block_size: int = BLOCK_SIZE) -> Iterator[Tuple[int, sparse.csr_matrix]]:
+        """
+        Common neighbors of us x vs by A_us A_vs^T, block_size rows of us at a time.
+
+        :param kind: 'followers' (shared followers) or 'friends' (shared followees)
+        :param weighted: weight each common neighbor w by 1 / log(deg(w)) (Adamic-Adar),
+            where deg(w) is the number of users sharing w by kind, e.g., friends of w for shared followers.
+        :return: iterator of (offset in us, csr_matrix of shape (block_size, len(vs)))
+        """
+        vs = us if vs is None else vs
+        vs_rows_t = self._get_rows(vs, kind).T.tocsr()
+        if weighted:
+            other_kind = "friends" if kind == "followers" else "followers"
+            degrees = np.asarray(self.matrices[other_kind].sum(axis=1)).reshape(-1)
+            weights = np.zeros(len(degrees))
+            weights[degrees > 1] = 1 / np.log(degrees[degrees > 1])
+            vs_rows_t = sparse.diags(weights) @ vs_rows_t
+
+        for offset in range(0, len(us), block_size):
+            yield offset, (self._get_rows(us[offset:offset + block_size], kind) @ vs_rows_t).tocsr()
+
+    def common_neighbors(self, us, vs=None, kind: str = "followers", block_size: int = BLOCK_SIZE) \
+            -> sparse.csr_matrix:
+        """
+        :return: csr_matrix of shape (len(us), len(vs)) of the numbers of common neighbors
+        """
+        blocks = [block for _, block in self.iter_common_neighbor_blocks(us, vs, kind, block_size=block_size)]
+        return sparse.vstack(blocks, format="csr") if blocks else sparse.csr_matrix((0, len(us if vs is None else vs)))
+
+    def adamic_adar(self, us, vs=None, kind: str = "followers", block_size: int = BLOCK_SIZE) -> sparse.csr_matrix:
+        blocks = [block for _, block in self.iter_common_neighbor_blocks(us, vs, kind, weighted=True,
+                                                                         block_size=block_size)]
+        return sparse.vstack(blocks, format="csr") if blocks else sparse.csr_matrix((0, len(us if vs is None else vs)))
+
+    def jaccard(self, us, vs=None, kind: str = "followers", block_size: int = BLOCK_SIZE) -> sparse.csr_matrix:
+        """
+        :return: csr_matrix of |N(u) & N(v)| / |N(u) | N(v)|, only for pairs of common neighbors (others are 0)
+        """
+        vs = us if vs is None else vs
+        u_degrees, v_degrees = self.get_degrees(us, kind), self.get_degrees(vs, kind)
+        blocks = []
+        for offset, block in self.iter_common_neighbor_blocks(us, vs, kind, block_size=block_size):
+            block = block.tocoo()
+            union = u_degrees[offset + block.row] + v_degrees[block.col] - block.data
+            blocks.append(sparse.csr_matrix((block.data / union, (block.row, block.col)), shape=block.shape))
+        return sparse.vstack(blocks, format="csr") if blocks else sparse.csr_matrix((0, len(vs)))
+
+    def pair_common_neighbors(self, us, vs, kind: str = "followers", block_size: int = BLOCK_SIZE) -> np.ndarray:
+        """
+        :param us: users of pairs
+        :param vs: users of pairs, of the same length as us
+        :return: np.int64 array of the number of common neighbors of each pair (us[i], vs[i])
+        """
+        counts = np.zeros(len(us), dtype=np.int64)
+        for offset in range(0, len(us), block_size):
+            u_rows = self._get_rows(us[offset:offset + block_size], kind)
+            v_rows = self._get_rows(vs[offset:offset + block_size], kind)
+            counts[offset:offset + block_size] = np.asarray(u_rows.multiply(v_rows).sum(axis=1)).reshape(-1)
+        return counts
+
+    def two_hop_reach(self, us, kind: str = "followers", targets=None, block_size: int = BLOCK_SIZE) -> np.ndarray:
+        """
+        Number of distinct users within two hops of each user (itself excluded), by rows of A_us + A_us A.
+
+        :param kind: 'followers' (users reached by a post of u via retweets) or 'friends'
+        :param targets: count only these users (e.g., participants of a cascade), default: all users
+        :return: np.int64 array of len(us)
+        """
+        a = self.matrices[kind]
+        if targets is not None:
+            target_mask = np.zeros(len(self), dtype=bool)
+            target_idx = self.get_indices(targets)
+            target_mask[target_idx[target_idx != -1]] = True
+        reach = np.zeros(len(us), dtype=np.int64)
+
+        for offset in range(0, len(us), block_size):
+            block_us = us[offset:offset + block_size]
+            one_hop = self._get_rows(block_us, kind)
+            within_two_hops = (one_hop + one_hop @ a).tocoo()
+            is_counted = within_two_hops.col != self.get_indices(block_us)[within_two_hops.row]
+            if targets is not None:
+                is_counted &= target_mask[within_two_hops.col]
+            reach[offset:offset + block_size] = np.bincount(within_two_hops.row[is_counted], minlength=len(block_us))
+        return reach
+
+
+if __name__ == '__main__':
+
+    MODE = "CASCADE"  # CASCADE
+
+    if MODE == "CASCADE":
+        user_network = UserNetwork()
+        user_network.load(file_name="UserNetwork_friends.pkl")
+        graph = FollowGraph.from_user_network(user_network)
+
+        participants = graph.users[:1000]
+        shared_followers = graph.common_neighbors(participants)
+        print("Pairs of shared followers: {}".format(shared_followers.nnz))
+        print("Two-hop reach in participants: {}".format(graph.two_hop_reach(participants, targets=participants)[:10]))
@@ -0,0 +1,187 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from user_array import USER_DTYPE
+
+
+class AdjacencyArray:
+
+    def __init__(self, adjacency: Dict):
+        """
+        Flat (CSR-like) arrays of an adjacency dict of UserNetwork, e.g., user_id_to_follower_ids.
+        Neighbors of keys[i] are values[offsets[i]:offsets[i + 1]], in the order of the list.
+
+        :param adjacency: dict, user_id -> list of int (or None)
+
+        Attributes
+        ----------
+        :keys: list of keys in the order of adjacency
+        :is_none: np.ndarray of bool, True if the list of keys[i] is None
+        """
+        self.keys: list = list(adjacency.keys())
+        lists = list(adjacency.values())
+        self.is_none: np.ndarray = np.fromiter((x is None for x in lists), dtype=bool, count=len(lists))
+        lengths = np.fromiter((len(x) if x else 0 for x in lists), dtype=np.int64, count=len(lists))
+        self.offsets: np.ndarray = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        self.values: np.ndarray = np.fromiter((int(u) for x in lists if x for u in x),
+                                              dtype=USER_DTYPE, count=int(self.offsets[-1]))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def to_lists(self, mask: np.ndarray = None) -> List[list or None]:
+        """
+        :param mask: bool np.ndarray over values to keep (default: keep all)
+        :return: list of neighbor lists of int (None is kept as None), in the order of keys
+        """
+        if mask is None:
+            values, offsets = self.values, self.offsets
+        else:
+            values = self.values[mask]
+            offsets = np.concatenate(([0], np.cumsum(mask))).astype(np.int64)[self.offsets]
+        value_list, offset_list = values.tolist(), offsets.tolist()
+        return [None if is_none else value_list[s:e]
+                for is_none, s, e in zip(self.is_none.tolist(), offset_list[:-1], offset_list[1:])]
+
+
+def count_values(value_arrays: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sort-based counting of values over arrays, as if they were concatenated.
+
+    :return: (sorted unique values, counts, index of the first occurrence in the concatenation)
+    """
+    values = np.concatenate(value_arrays) if value_arrays else np.asarray([], dtype=USER_DTYPE)
+    unique_values, first_idx, counts = np.unique(values, return_index=True, return_counts=True)
+    return unique_values, counts, first_idx
+
+
+def top_k_by_count(counts: np.ndarray, first_idx: np.ndarray, k: int) -> np.ndarray:
+    """
+    Same selection and order as Counter.most_common(k) over the concatenation:
+    larger counts first, and ties are broken by the first occurrence.
+
+    :return: np.ndarray of indices into counts, at most k
+    """
+    k = min(max(k, 0), len(counts))
+    if k == 0:
+        return np.asarray([], dtype=np.int64)
+    if k < len(counts):
+        # Every value of a count larger than the k-th largest one is in, and ties of it are cut by first_idx.
+        kth_count = counts[np.argpartition(-counts, k - 1)[k - 1]]
+        larger = np.flatnonzero(counts > kth_count)
+        ties = np.flatnonzero(counts == kth_count)
+        ties = ties[np.argsort(first_idx[ties], kind="stable")[:k - len(larger)]]
+        selected = np.concatenate((larger, ties))
+    else:
+        selected = np.arange(len(counts))
+    return selected[np.lexsort((first_idx[selected], -counts[selected]))]
+
+
+def merge_counts(ids: np.ndarray, counts: np.ndarray, first_idx: np.ndarray,
+                 other_ids: np.ndarray, other_counts: np.ndarray, other_first_idx: np.ndarray) \
+        -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Merge two count tables of count_values: counts are summed and the first occurrence is the smaller one.
+    """
+    ids, counts, first_idx = (np.concatenate(pair) for pair in ((ids, other_ids),
+                                                                (counts, other_counts),
+                                                                (first_idx, other_first_idx)))
+    order = np.argsort(ids, kind="stable")
+    ids, counts, first_idx = ids[order], counts[order], first_idx[order]
+    if len(ids) == 0:
+        return ids, counts, first_idx
+    starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+    return ids[starts], np.add.reduceat(counts, starts), np.minimum.reduceat(first_idx, starts)
+
+
+def union_edges(adjacency: Dict, users: list, sources: list, targets: list):
+    """
+    Replace the list of each user in users with the sorted, deduplicated union of the list and
+    the targets of edges from the user, by one sort over all edges. None is regarded as an empty list.
+
+    :param adjacency: dict, user_id -> list of int (or None), e.g., user_id_to_friend_ids
+    :param users: unique keys of adjacency to update (every source must be in users)
+    :param sources: keys of adjacency, sources of edges
+    :param targets: int user ids, targets of edges
+    """
+    existing = AdjacencyArray({u: adjacency[u] for u in users})
+    user_to_row = {u: i for i, u in enumerate(existing.keys)}
+    rows = np.concatenate((np.repeat(np.arange(len(existing), dtype=np.int64), np.diff(existing.offsets)),
+                           np.fromiter((user_to_row[s] for s in sources), dtype=np.int64, count=len(sources))))
+    values = np.concatenate((existing.values,
+                             np.fromiter((int(t) for t in targets), dtype=USER_DTYPE, count=len(targets))))
+
+    order = np.lexsort((values, rows))
+    rows, values = rows[order], values[order]
+    is_unique = np.ones(len(rows), dtype=bool)
+    is_unique[1:] = (rows[1:] != rows[:-1]) | (values[1:] != values[:-1])
+    rows, values = rows[is_unique], values[is_unique]
+
+    offsets = np.searchsorted(rows, np.arange(len(existing) + 1)).tolist()
+    value_list = values.tolist()
+    for u, s, e in zip(existing.keys, offsets[:-1], offsets[1:]):
+        adjacency[u] = value_list[s:e]
+
+
+def _to_first_appearance_order(adjacency_array: AdjacencyArray) -> np.ndarray:
+    """
+    :return: np.ndarray of USER_DTYPE, each key followed by its neighbors, in the order of adjacency
+    """
+    key_positions = adjacency_array.offsets[:-1] + np.arange(len(adjacency_array))
+    is_key = np.zeros(len(adjacency_array) + len(adjacency_array.values), dtype=bool)
+    is_key[key_positions] = True
+    sequence = np.empty(len(is_key), dtype=USER_DTYPE)
+    sequence[is_key] = np.fromiter((int(k) for k in adjacency_array.keys), dtype=USER_DTYPE,
+                                   count=len(adjacency_array))
+    sequence[~is_key] = adjacency_array.values
+    return sequence
+
+
+def _to_csr_lists(sources: np.ndarray, targets: np.ndarray, users: np.ndarray) -> List[list]:
+    """
+    :param sources: indices of users, sorted (ties sorted by targets)
+    :return: list of sorted target user ids for each of users
+    """
+    indptr = np.searchsorted(sources, np.arange(len(users) + 1)).tolist()
+    target_list = users[targets].tolist()
+    return [target_list[s:e] for s, e in zip(indptr[:-1], indptr[1:])]
+
+
+def symmetric_completion(friends: AdjacencyArray, followers: AdjacencyArray) -> Tuple[list, List[list], List[list]]:
+    """
+    Union of 'u follows v' edges from friend lists (u -> friends) and follower lists (followers -> u),
+    deduplicated by one lexsort, then both directions are built from the same edge array.
+
+    :return: (users in order of the first appearance in friends then followers,
+              sorted friend list of each user, sorted follower list of each user)
+    """
+    friend_sequence, follower_sequence = _to_first_appearance_order(friends), _to_first_appearance_order(followers)
+    users, first_idx = np.unique(np.concatenate((friend_sequence, follower_sequence)), return_index=True)
+    del friend_sequence, follower_sequence
+
+    def to_edges(adjacency_array: AdjacencyArray):
+        key_idx = np.searchsorted(users, np.fromiter((int(k) for k in adjacency_array.keys), dtype=USER_DTYPE,
+                                                     count=len(adjacency_array)))
+        return np.repeat(key_idx, np.diff(adjacency_array.offsets)), np.searchsorted(users, adjacency_array.values)
+
+    friend_keys, friend_values = to_edges(friends)
+    follower_keys, follower_values = to_edges(followers)
+    sources = np.concatenate((friend_keys, follower_values))  # follower
+    targets = np.concatenate((friend_values, follower_keys))  # followee
+    del friend_keys, friend_values, follower_keys, follower_values
+
+    order = np.lexsort((targets, sources))
+    sources, targets = sources[order], targets[order]
+    is_unique = np.ones(len(sources), dtype=bool)
+    is_unique[1:] = (sources[1:] != sources[:-1]) | (targets[1:] != targets[:-1])
+    sources, targets = sources[is_unique], targets[is_unique]
+
+    friend_lists = _to_csr_lists(sources, targets, users)
+    order = np.lexsort((sources, targets))
+    follower_lists = _to_csr_lists(targets[order], sources[order], users)
+
+    user_order = np.argsort(first_idx, kind="stable")
+    return (users[user_order].tolist(),
+            [friend_lists[i] for i in user_order],
+            [follower_lists[i] for i in user_order])
@@ -1,16 +1,75 @@
 from TwitterAPIWrapper import TwitterAPIWrapper
 from network import *
-from typing import Sequence, Tuple
+from typing import List, Sequence, Tuple
 from user_set import load_user_set
+from serialization import atomic_open, dump_pickle, load_pickle
 import numpy as np
+import json
+import pickle
+from collections import OrderedDict
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from scipy import sparse
 
 ADJ_PATH = os.path.join(NETWORK_PATH, "adjacency")
 
+# 2-bit codes of relations: 0 (not follow), 1 (follow), -1 (unknown), -42 (uninitialized)
+PACKED_VALUES = np.asarray([0, 1, -1, -42], dtype=np.int8)
+
+
+def pack_2bit(arr: np.ndarray) -> np.ndarray or None:
+    """
+    :return: np.uint8 array of 4 cells per byte (row-major), or None if arr has a value not in PACKED_VALUES
+    """
+    flat = np.asarray(arr).reshape(-1)
+    codes = np.full(len(flat), 255, dtype=np.uint8)
+    for code, value in enumerate(PACKED_VALUES.tolist()):
+        codes[flat == value] = code
+    if (codes == 255).any():
+        return None
+    codes = np.concatenate((codes, np.zeros((-len(codes)) % 4, dtype=np.uint8))).reshape(-1, 4)
+    return codes[:, 0] | (codes[:, 1] << 2) | (codes[:, 2] << 4) | (codes[:, 3] << 6)
+
+
+def unpack_2bit(packed: np.ndarray, shape: tuple, dtype=np.int8) -> np.ndarray:
+    size = int(np.prod(shape))
+    codes = np.stack([(packed >> shift) & 3 for shift in (0, 2, 4, 6)], axis=1).reshape(-1)[:size]
+    return PACKED_VALUES[codes].astype(dtype, copy=False).reshape(shape)
+
+
+class VertexIndex:
+
+    def __init__(self, vertices: np.ndarray):
+        """
+        Positions of vertices by binary search on the sorted vertices, built once in O(n log n).
+        The first position is used for duplicated vertices, as np.where(vertices == v)[0][0].
+        """
+        self.vertices = vertices
+        self.order = np.argsort(vertices, kind="stable")
+        self.sorted_vertices = vertices[self.order]
+
+    def get_indices(self, vertices) -> np.ndarray:
+        """
+        :return: np.int64 array of positions of vertices, -1 for vertices not in the index
+        """
+        vertices = np.asarray(vertices).astype(np.int64).reshape(-1)
+        if len(self.sorted_vertices) == 0:
+            return np.full(len(vertices), -1, dtype=np.int64)
+        idx = np.searchsorted(self.sorted_vertices, vertices)
+        idx[idx == len(self.sorted_vertices)] = 0
+        is_found = self.sorted_vertices[idx] == vertices
+        return np.where(is_found, self.order[idx], -1).astype(np.int64)
+
 
 class AdjMatrix:
 
     def __init__(self, row_vertices: Sequence, col_vertices: Sequence or None, tuple_key: Tuple,
-                 file_prefix: str = "adj", initial_value: int = -42, arr_initializer: np.ndarray = None):
+                 file_prefix: str = "adj", initial_value: int = -42, arr_initializer: np.ndarray = None,
+                 dtype=np.int64, packed: bool = False):
+        """
+        :param dtype: dtype of arr, e.g., np.int8 for 1 byte per cell (relations are 0, 1, -1 and -42)
+        :param packed: dump arr in 2 bits per cell (see pack_2bit), and load it back to dtype transparently
+        """
 
         self.is_row_col_same = col_vertices is None
 
@@ -22,11 +81,17 @@ class AdjMatrix:
         self.col_size = len(self.col_vertices)
         self.initial_value = initial_value
         self.file_prefix = file_prefix
+        self.dtype = np.dtype(dtype).name
+        self.packed = packed
+
+        self._init_arr(arr_initializer)
 
-        if arr_initializer:
+    def _init_arr(self, arr_initializer):
+        if arr_initializer is not None:
             self.arr = arr_initializer
+            self.dtype = self.arr.dtype.name
         else:
-            self.arr = np.full((self.row_size, self.col_size), self.initial_value, dtype=np.int64)
+            self.arr = np.full((self.row_size, self.col_size), self.initial_value, dtype=self.dtype)
 
         assert self.arr.shape == (self.row_size, self.col_size)
 
@@ -36,21 +101,58 @@ class AdjMatrix:
     def __repr__(self):
         return self.arr.__repr__()
 
+    def _get_vertex_index(self, attr: str) -> VertexIndex:
+        # Indices are rebuilt when row_vertices or col_vertices is replaced (e.g., by _meta_load).
+        vertices = getattr(self, attr)
+        index: VertexIndex = getattr(self, "_{}_index".format(attr), None)
+        if index is None or index.vertices is not vertices:
+            index = VertexIndex(vertices)
+            setattr(self, "_{}_index".format(attr), index)
+        return index
+
+    def get_row_indices(self, us) -> np.ndarray:
+        return self._get_vertex_index("row_vertices").get_indices(us)
+
+    def get_col_indices(self, vs) -> np.ndarray:
+        return self._get_vertex_index("col_vertices").get_indices(vs)
+
     def get_u_to_v(self, u, v):
-        u_i, = np.where(self.row_vertices == int(u))
-        v_i, = np.where(self.col_vertices == int(v))
+        u_i, = self.get_row_indices([u])
+        v_i, = self.get_col_indices([v])
 
-        if len(u_i) != 0 and len(v_i) != 0:
-            return self.arr[u_i[0]][v_i[0]]
+        if u_i != -1 and v_i != -1:
+            return self.arr[u_i][v_i]
         else:
             return None
 
     def set_u_to_v(self, u, v, val):
-        u_i, = np.where(self.row_vertices == int(u))
-        v_i, = np.where(self.col_vertices == int(v))
-
-        if len(u_i) != 0 and len(v_i) != 0:
-            self.arr[u_i[0]][v_i[0]] = val
+        self.set_many([u], [v], [val])
+
+    def get_many(self, us, vs, missing_value=None) -> np.ndarray:
+        """
+        :param us: row vertices
+        :param vs: col vertices of the same length
+        :param missing_value: value for pairs not in the matrix (default: initial_value)
+        :return: np.ndarray of arr[u][v] for pairs (u, v)
+        """
+        u_idx, v_idx = self.get_row_indices(us), self.get_col_indices(vs)
+        is_found = (u_idx != -1) & (v_idx != -1)
+        values = np.full(len(u_idx), self.initial_value if missing_value is None else missing_value,
+                         dtype=self.arr.dtype)
+        values[is_found] = self.arr[u_idx[is_found], v_idx[is_found]]
+        return values
+
+    def set_many(self, us, vs, vals) -> np.ndarray:
+        """
+        Set arr[u][v] = val for (u, v, val), pairs not in the matrix are skipped.
+
+        :return: bool np.ndarray, True for pairs set
+        """
+        u_idx, v_idx = self.get_row_indices(us), self.get_col_indices(vs)
+        is_found = (u_idx != -1) & (v_idx != -1)
+        vals = np.broadcast_to(np.asarray(vals), is_found.shape)
+        self.arr[u_idx[is_found], v_idx[is_found]] = vals[is_found]
+        return is_found
 
     def get_file_name(self, tuple_key):
         return "{}_{}.pkl".format(self.file_prefix, "_".join([str(e) for e in tuple_key]))
@@ -61,68 +163,109 @@ class AdjMatrix:
         self._meta_dump(file)
 
     def load(self, file=None):
+        # Meta first, since it tells how arr is stored.
         file = file if file else self.get_file_name(self.tuple_key)
-        self._arr_load(file)
         self._meta_load(file)
+        self._arr_load(file)
 
     @classmethod
     def load_and_merge(cls, file_prefix, batch_num):
+        return cls.load_full_matrix(file_prefix, batch_num)
 
-        full_mat = None
-        row_vertices, col_vertices = cls.load_vertices(file_prefix, batch_num)
-
-        for i in range(batch_num):
-
-            one_row = None
-            for j in range(batch_num):
-                tuple_key = (i, j, batch_num)
-                adj = AdjMatrix(row_vertices=[], col_vertices=[], tuple_key=tuple_key, file_prefix=file_prefix)
-                adj.load()
-
-                if one_row is None:
-                    one_row = np.ndarray(shape=(adj.row_size, 0), dtype=np.int64)
-                # (r, n*m) @ (r, m) -> (r, (n+1)*m)
-                one_row = np.concatenate((one_row, adj.arr), axis=1)
-
-            if full_mat is None:
-                full_mat = np.ndarray(shape=(0, one_row.shape[1]), dtype=np.int64)
-            # (n*m, c) @ (m, c) -> ((n+1)*m, c)
-            full_mat = np.concatenate((full_mat, one_row))
-            print(full_mat)
-
-        adj = AdjMatrix(row_vertices=row_vertices, col_vertices=col_vertices, tuple_key=(0, 0, 1),
-                        file_prefix=file_prefix, arr_initializer=full_mat)
+    @classmethod
+    def load_full_matrix(cls, file_prefix, batch_num, memmap_file=None, num_threads=None) -> "AdjMatrix":
+        """
+        Assemble tiles (i, j, batch_num) in a single pass: the output is preallocated, and tiles are
+        loaded in threads and copied into place as they arrive.
+
+        :param memmap_file: if given, the output is a np.memmap of .npy in ADJ_PATH, instead of memory.
+            - Memory is then bounded by num_threads decoded tiles, since tiles are loaded num_threads at a time.
+        :param num_threads: threads to load tiles (default: os.cpu_count())
+        """
+        row_blocks, col_blocks, dtype = cls._load_block_vertices(file_prefix, batch_num)
+        row_offsets = np.cumsum([0] + [len(b) for b in row_blocks])
+        col_offsets = np.cumsum([0] + [len(b) for b in col_blocks])
+        shape = (int(row_offsets[-1]), int(col_offsets[-1]))
+
+        if memmap_file:
+            full_mat = np.lib.format.open_memmap(os.path.join(ADJ_PATH, memmap_file), mode="w+",
+                                                 dtype=dtype, shape=shape)
+        else:
+            full_mat = np.empty(shape, dtype=dtype)
+
+        def load_tile(tuple_key):
+            adj = AdjMatrix(row_vertices=[], col_vertices=[], tuple_key=tuple_key, file_prefix=file_prefix)
+            adj.load()
+            return tuple_key, adj.arr
+
+        tuple_keys = [(i, j, batch_num) for i in range(batch_num) for j in range(batch_num)]
+        num_threads = num_threads or os.cpu_count() or 1
+        with ThreadPool(processes=num_threads) as pool:
+            # A chunk is submitted after the previous one is copied, so at most num_threads tiles are in flight.
+            for chunk_start in range(0, len(tuple_keys), num_threads):
+                chunk = tuple_keys[chunk_start:chunk_start + num_threads]
+                for (i, j, _), arr in pool.imap_unordered(load_tile, chunk):
+                    full_mat[row_offsets[i]:row_offsets[i + 1], col_offsets[j]:col_offsets[j + 1]] = arr
+
+        if memmap_file:
+            full_mat.flush()
+            cprint("Full Matrix Dumped: {} of {}".format(memmap_file, shape), "blue")
+
+        adj = AdjMatrix(row_vertices=np.concatenate(row_blocks), col_vertices=np.concatenate(col_blocks),
+                        tuple_key=(0, 0, 1), file_prefix=file_prefix, arr_initializer=full_mat)
         return adj
 
     @classmethod
-    def load_vertices(cls, file_prefix, batch_num):
-        row_vertices, col_vertices = np.asarray([], dtype=np.int64), np.asarray([], dtype=np.int64)
+    def _load_block_vertices(cls, file_prefix, batch_num):
+        """
+        :return: (list of row vertices of each row of tiles, list of col vertices of each col of tiles, dtype)
+        """
+        row_blocks, col_blocks, dtype = [], [], None
 
         for i in range(batch_num):
             tuple_key = (i, 0, batch_num)
-            adj = AdjMatrix(row_vertices=[], col_vertices=[], tuple_key=tuple_key, file_prefix=file_prefix,
-                            arr_initializer=np.zeros((1,)))
+            adj = AdjMatrix(row_vertices=[], col_vertices=[], tuple_key=tuple_key, file_prefix=file_prefix)
             adj._meta_load(adj.get_file_name(tuple_key))
-            row_vertices = np.concatenate((row_vertices, adj.row_vertices))
+            row_blocks.append(np.asarray(adj.row_vertices, dtype=np.int64))
+            dtype = adj.dtype if dtype is None else dtype
 
         for j in range(batch_num):
             tuple_key = (0, j, batch_num)
-            adj = AdjMatrix(row_vertices=[], col_vertices=[], tuple_key=tuple_key, file_prefix=file_prefix,
-                            arr_initializer=np.zeros((1,)))
+            adj = AdjMatrix(row_vertices=[], col_vertices=[], tuple_key=tuple_key, file_prefix=file_prefix)
             adj._meta_load(adj.get_file_name(tuple_key))
-            col_vertices = np.concatenate((col_vertices, adj.col_vertices))
+            col_blocks.append(np.asarray(adj.col_vertices, dtype=np.int64))
 
-        return row_vertices, col_vertices
+        return row_blocks, col_blocks, dtype
+
+    @classmethod
+    def load_vertices(cls, file_prefix, batch_num):
+        row_blocks, col_blocks, _ = cls._load_block_vertices(file_prefix, batch_num)
+        return np.concatenate(row_blocks), np.concatenate(col_blocks)
 
     def _arr_dump(self, file, adj_path=None):
         adj_path = adj_path or ADJ_PATH
-        self.arr.dump(os.path.join(adj_path, file))
+        arr_to_dump = pack_2bit(self.arr) if self.packed else self.arr
+        if self.packed and arr_to_dump is None:
+            cprint("Not packed: {} has values other than {}".format(file, PACKED_VALUES.tolist()), "red")
+            self.packed, arr_to_dump = False, self.arr
+        with atomic_open(os.path.join(adj_path, file)) as f:
+            np.save(f, arr_to_dump)
         cprint("Batch Dumped: {}".format(file), "blue")
 
-    def _arr_load(self, file, adj_path=None):
+    def _load_dense_arr(self, file, adj_path=None) -> np.ndarray:
         adj_path = adj_path or ADJ_PATH
-        loaded = np.load(os.path.join(adj_path, file))
+        if getattr(self, "sparse", False):
+            return SparseAdjMatrix.load_masks(os.path.join(adj_path, file)).to_dense(self.dtype)
+        # allow_pickle for legacy files written by ndarray.dump
+        loaded = np.load(os.path.join(adj_path, file), allow_pickle=True)
+        if getattr(self, "packed", False):
+            loaded = unpack_2bit(loaded, self.shape, self.dtype)
+        return loaded
+
+    def _arr_load(self, file, adj_path=None):
+        loaded = self._load_dense_arr(file, adj_path)
         self.arr = loaded
+        self.dtype = loaded.dtype.name
         cprint("Batch Loaded: {}".format(file), "green")
         return loaded
 
@@ -130,30 +273,266 @@ class AdjMatrix:
         adj_path = adj_path or ADJ_PATH
         with open(os.path.join(adj_path, "meta_{}".format(file)), 'rb') as f:
             loaded_meta = pickle.load(f)
+            loaded_meta.setdefault("packed", False)  # Legacy meta
+            loaded_meta.setdefault("sparse", False)
             for k, v in loaded_meta.items():
                 setattr(self, k, v)
         cprint("Meta Loaded: {}".format(file), "blue")
 
+    def _get_meta(self) -> dict:
+        return {
+            "is_row_col_same": self.is_row_col_same,
+            "row_vertices": self.row_vertices,
+            "col_vertices": self.col_vertices,
+            "initial_value": self.initial_value,
+            "row_size": self.row_size,
+            "col_size": self.col_size,
+            "tuple_key": self.tuple_key,
+            "file_prefix": self.file_prefix,
+            "packed": self.packed,
+            "shape": (self.row_size, self.col_size),
+            "dtype": self.dtype,
+        }
+
     def _meta_dump(self, file, adj_path=None):
         adj_path = adj_path or ADJ_PATH
         with open(os.path.join(adj_path, "meta_{}".format(file)), 'wb') as f:
-            pickle.dump({
-                "is_row_col_same": self.is_row_col_same,
-                "row_vertices": self.row_vertices,
-                "col_vertices": self.col_vertices,
-                "initial_value": self.initial_value,
-                "row_size": self.row_size,
-                "col_size": self.col_size,
-                "tuple_key": self.tuple_key,
-                "file_prefix": self.file_prefix,
-            }, f)
+            pickle.dump(self._get_meta(), f)
         cprint("Meta Dumped: {}".format(file), "blue")
 
 
+class SparseMasks:
+
+    def __init__(self, positive: sparse.csr_matrix, unknown: sparse.csr_matrix):
+        """
+        :param positive: bool csr_matrix of cells of 1 (u follows v)
+        :param unknown: bool csr_matrix of cells of -1, other cells are 0.
+        """
+        self.positive = positive
+        self.unknown = unknown
+
+    @classmethod
+    def empty(cls, shape) -> "SparseMasks":
+        return cls(sparse.csr_matrix(shape, dtype=bool), sparse.csr_matrix(shape, dtype=bool))
+
+    @property
+    def shape(self):
+        return self.positive.shape
+
+    def to_dense(self, dtype=np.int8) -> np.ndarray:
+        arr = self.positive.toarray().astype(dtype)
+        arr[self.unknown.toarray()] = -1
+        return arr
+
+
+class SparseAdjMatrix(AdjMatrix):
+
+    def __init__(self, row_vertices: Sequence, col_vertices: Sequence or None, tuple_key: Tuple,
+                 file_prefix: str = "adj", masks: SparseMasks = None):
+        """
+        AdjMatrix of scipy.sparse masks of positive (1) and unknown (-1) cells, and 0 for the others.
+            - Uninitialized cells are 0, since there is no dense initial_value.
+            - Dense arrays are built only by to_dense.
+        """
+        super().__init__(row_vertices, col_vertices, tuple_key, file_prefix=file_prefix, initial_value=0,
+                         arr_initializer=masks, dtype=np.int8)
+
+    def _init_arr(self, masks: SparseMasks):
+        self.masks = masks if masks is not None else SparseMasks.empty((self.row_size, self.col_size))
+        assert self.masks.shape == (self.row_size, self.col_size)
+
+    @classmethod
+    def from_dense(cls, adj: AdjMatrix) -> "SparseAdjMatrix":
+        masks = SparseMasks(sparse.csr_matrix(adj.arr == 1), sparse.csr_matrix(adj.arr == -1))
+        return cls(adj.row_vertices, None if adj.is_row_col_same else adj.col_vertices, adj.tuple_key,
+                   file_prefix=adj.file_prefix, masks=masks)
+
+    def to_dense(self, dtype=np.int8) -> AdjMatrix:
+        return AdjMatrix(self.row_vertices, None if self.is_row_col_same else self.col_vertices, self.tuple_key,
+                         file_prefix=self.file_prefix, arr_initializer=self.masks.to_dense(dtype), dtype=dtype)
+
+    def __getitem__(self, item):
+        # int8 csr_matrix (or scalar) of 1, -1 and 0
+        return self.masks.positive[item].astype(np.int8) - self.masks.unknown[item].astype(np.int8)
+
+    def __repr__(self):
+        return "SparseAdjMatrix(shape={}, positive={}, unknown={})".format(
+            self.masks.shape, self.masks.positive.nnz, self.masks.unknown.nnz)
+
+    def get_u_to_v(self, u, v):
+        u_i, = self.get_row_indices([u])
+        v_i, = self.get_col_indices([v])
+        if u_i != -1 and v_i != -1:
+            return int(self.masks.positive[u_i, v_i]) - int(self.masks.unknown[u_i, v_i])
+        else:
+            return None
+
+    def get_many(self, us, vs, missing_value=None) -> np.ndarray:
+        u_idx, v_idx = self.get_row_indices(us), self.get_col_indices(vs)
+        is_found = (u_idx != -1) & (v_idx != -1)
+        values = np.full(len(u_idx), 0 if missing_value is None else missing_value, dtype=np.int8)
+        u_idx, v_idx = u_idx[is_found], v_idx[is_found]
+        values[is_found] = np.asarray(self.masks.positive[u_idx, v_idx]).ravel().astype(np.int8) - \
+            np.asarray(self.masks.unknown[u_idx, v_idx]).ravel().astype(np.int8)
+        return values
+
+    def set_many(self, us, vs, vals) -> np.ndarray:
+        u_idx, v_idx = self.get_row_indices(us), self.get_col_indices(vs)
+        is_found = (u_idx != -1) & (v_idx != -1)
+        vals = np.broadcast_to(np.asarray(vals), is_found.shape)[is_found]
+        u_idx, v_idx = u_idx[is_found], v_idx[is_found]
+
+        # The last value is set for duplicated cells, as in dense arrays.
+        cells = u_idx * self.col_size + v_idx
+        _, last = np.unique(cells[::-1], return_index=True)
+        last = len(cells) - 1 - last
+        u_idx, v_idx, vals = u_idx[last], v_idx[last], vals[last]
+
+        def to_mask(is_set):
+            return sparse.csr_matrix((np.ones(is_set.sum(), dtype=np.int8), (u_idx[is_set], v_idx[is_set])),
+                                     shape=self.masks.shape)
+
+        is_updated = to_mask(np.ones(len(u_idx), dtype=bool))
+        for name, value in (("positive", 1), ("unknown", -1)):
+            mask = getattr(self.masks, name).astype(np.int8)
+            mask = mask - mask.multiply(is_updated) + to_mask(vals == value)
+            mask.eliminate_zeros()
+            setattr(self.masks, name, mask.astype(bool))
+        return is_found
+
+    def _get_meta(self) -> dict:
+        meta = super()._get_meta()
+        meta.update({"sparse": True, "packed": False})
+        return meta
+
+    def _arr_dump(self, file, adj_path=None):
+        adj_path = adj_path or ADJ_PATH
+        masks = self.masks
+        with atomic_open(os.path.join(adj_path, file)) as f:
+            np.savez(f, shape=np.asarray(masks.shape),
+                     positive_indptr=masks.positive.indptr, positive_indices=masks.positive.indices,
+                     unknown_indptr=masks.unknown.indptr, unknown_indices=masks.unknown.indices)
+        cprint("Batch Dumped: {}".format(file), "blue")
+
+    @staticmethod
+    def load_masks(file_path) -> SparseMasks:
+        with np.load(file_path) as loaded:
+            shape = tuple(loaded["shape"].tolist())
+            masks = [sparse.csr_matrix((np.ones(len(loaded["{}_indices".format(name)]), dtype=bool),
+                                        loaded["{}_indices".format(name)], loaded["{}_indptr".format(name)]),
+                                       shape=shape)
+                     for name in ("positive", "unknown")]
+        return SparseMasks(*masks)
+
+    def _arr_load(self, file, adj_path=None):
+        adj_path = adj_path or ADJ_PATH
+        if getattr(self, "sparse", False):
+            self.masks = self.load_masks(os.path.join(adj_path, file))
+        else:
+            # Dense tiles are loaded as sparse masks.
+            arr = self._load_dense_arr(file, adj_path)
+            self.masks = SparseMasks(sparse.csr_matrix(arr == 1), sparse.csr_matrix(arr == -1))
+        self.sparse = True
+        cprint("Batch Loaded: {}".format(file), "green")
+        return self.masks
+
+    @classmethod
+    def load_full_matrix(cls, file_prefix, batch_num, memmap_file=None, num_threads=None) -> "SparseAdjMatrix":
+        """
+        Assemble tiles as sparse masks with scipy.sparse.bmat (memmap_file is not used).
+        """
+        row_blocks, col_blocks, _ = cls._load_block_vertices(file_prefix, batch_num)
+
+        def load_tile(tuple_key):
+            adj = SparseAdjMatrix(row_vertices=[], col_vertices=[], tuple_key=tuple_key, file_prefix=file_prefix)
+            adj.load()
+            return adj.masks
+
+        tuple_keys = [(i, j, batch_num) for i in range(batch_num) for j in range(batch_num)]
+        with ThreadPool(processes=num_threads or os.cpu_count() or 1) as pool:
+            tiles = pool.map(load_tile, tuple_keys)
+        tiles = [tiles[i * batch_num:(i + 1) * batch_num] for i in range(batch_num)]
+
+        masks = SparseMasks(*[sparse.bmat([[getattr(m, name) for m in row] for row in tiles], format="csr")
+                              for name in ("positive", "unknown")])
+        return cls(row_vertices=np.concatenate(row_blocks), col_vertices=np.concatenate(col_blocks),
+                   tuple_key=(0, 0, 1), file_prefix=file_prefix, masks=masks)
+
+
+class LazyAdjMatrix:
+
+    def __init__(self, file_prefix, batch_num, max_tiles: int = 1, matrix_cls=AdjMatrix):
+        """
+        Full matrix of tiles (i, j, batch_num), where a tile is loaded on first access.
+
+        :param max_tiles: number of tiles kept in memory (least recently used tiles are dropped)
+        :param matrix_cls: AdjMatrix or SparseAdjMatrix to load tiles
+        """
+        self.file_prefix = file_prefix
+        self.batch_num = batch_num
+        self.max_tiles = max_tiles
+        self.matrix_cls = matrix_cls
+
+        row_blocks, col_blocks, _ = AdjMatrix._load_block_vertices(file_prefix, batch_num)
+        self.row_vertices = np.concatenate(row_blocks)
+        self.col_vertices = np.concatenate(col_blocks)
+        self.row_offsets = np.cumsum([0] + [len(b) for b in row_blocks])
+        self.col_offsets = np.cumsum([0] + [len(b) for b in col_blocks])
+        self.row_index = VertexIndex(self.row_vertices)
+        self.col_index = VertexIndex(self.col_vertices)
+        self._tiles = OrderedDict()
+
+    @property
+    def shape(self):
+        return len(self.row_vertices), len(self.col_vertices)
+
+    def get_tile(self, i, j) -> AdjMatrix:
+        tuple_key = (int(i), int(j), self.batch_num)
+        if tuple_key in self._tiles:
+            self._tiles.move_to_end(tuple_key)
+        else:
+            tile = self.matrix_cls(row_vertices=[], col_vertices=[], tuple_key=tuple_key, file_prefix=self.file_prefix)
+            tile.load()
+            self._tiles[tuple_key] = tile
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return self._tiles[tuple_key]
+
+    def get_many(self, us, vs, missing_value=-42) -> np.ndarray:
+        """
+        :return: np.ndarray of values of pairs (u, v), loading tiles in the order of tiles
+        """
+        u_idx, v_idx = self.row_index.get_indices(us), self.col_index.get_indices(vs)
+        values = np.full(len(u_idx), missing_value, dtype=np.int64)
+        is_found = (u_idx != -1) & (v_idx != -1)
+        tile_i = np.searchsorted(self.row_offsets, u_idx, side="right") - 1
+        tile_j = np.searchsorted(self.col_offsets, v_idx, side="right") - 1
+
+        tile_keys = tile_i[is_found] * self.batch_num + tile_j[is_found]
+        found_idx = np.flatnonzero(is_found)
+        for tile_key in np.unique(tile_keys).tolist():
+            idx = found_idx[tile_keys == tile_key]
+            tile = self.get_tile(tile_key // self.batch_num, tile_key % self.batch_num)
+            values[idx] = tile.get_many(self.row_vertices[u_idx[idx]], self.col_vertices[v_idx[idx]])
+        return values
+
+    def get_u_to_v(self, u, v):
+        if self.row_index.get_indices([u])[0] == -1 or self.col_index.get_indices([v])[0] == -1:
+            return None
+        return self.get_many([u], [v])[0]
+
+
 class AdjMatrixAPIWrapper(TwitterAPIWrapper):
 
     def __init__(self, config_file_path_or_list: str or list,
-                 file_prefix: str = "adj", batch_size: int = 10000, initial_value: int = -42, progress: int = None):
+                 file_prefix: str = "adj", batch_size: int = 10000, initial_value: int = -42, progress: int = None,
+                 dtype=np.int64, packed: bool = False, checkpoint_rows: int = 1):
+        """
+        :param progress: row of tiles to start from (tiles done in the manifest are skipped anyway)
+        :param dtype: dtype of tiles, np.int8 to opt in to 1 byte per cell (see AdjMatrix)
+        :param packed: opt in to dump tiles in 2 bits per cell (see AdjMatrix)
+        :param checkpoint_rows: a partial tile is checkpointed every checkpoint_rows rows of it
+        """
 
         super().__init__(config_file_path_or_list)
 
@@ -162,6 +541,10 @@ class AdjMatrixAPIWrapper(TwitterAPIWrapper):
         self.batch_size = batch_size
         self.initial_value = initial_value
         self.row_progress = progress if progress else 0
+        self.dtype = dtype
+        self.packed = packed
+        self.checkpoint_rows = checkpoint_rows
+        self.manifest: dict = None
 
     def set_vertices(self, vertices, sorting=False):
         self.vertices = list(vertices) if not sorting else sorted(vertices)
@@ -174,42 +557,128 @@ class AdjMatrixAPIWrapper(TwitterAPIWrapper):
         mat.load()
         return mat
 
+    def _get_manifest_file(self):
+        return os.path.join(ADJ_PATH, "manifest_{}.json".format(self.file_prefix))
+
+    def _get_checkpoint_file(self, tuple_key):
+        return os.path.join(ADJ_PATH, "checkpoint_{}_{}.pkl".format(
+            self.file_prefix, "_".join([str(e) for e in tuple_key])))
+
+    @staticmethod
+    def _get_tile_name(tuple_key):
+        return "_".join([str(e) for e in tuple_key])
+
+    def _load_manifest(self, batch_num) -> dict:
+        """
+        :return: dict of the vertices it was made for, names of done tiles, and finished rows of partial tiles
+        """
+        manifest = {"num_vertices": len(self.vertices), "batch_size": self.batch_size, "batch_num": batch_num,
+                    "dtype": np.dtype(self.dtype).name, "packed": self.packed, "done": [], "partial": {}}
+        try:
+            with open(self._get_manifest_file(), "r") as f:
+                loaded_manifest = json.load(f)
+        except FileNotFoundError:
+            return manifest
+
+        # Legacy manifest, for tiles of the old format.
+        loaded_manifest.setdefault("dtype", np.dtype(np.int64).name)
+        loaded_manifest.setdefault("packed", False)
+        for k in ("num_vertices", "batch_size", "batch_num", "dtype", "packed"):
+            if loaded_manifest[k] != manifest[k]:
+                raise ValueError("Manifest of {} is for {} of {}, not {}".format(
+                    self.file_prefix, k, loaded_manifest[k], manifest[k]))
+        cprint("Manifest Loaded: {} tiles done, {} tiles partial".format(
+            len(loaded_manifest["done"]), len(loaded_manifest["partial"])), "green")
+        return loaded_manifest
+
+    def _dump_manifest(self):
+        with atomic_open(self._get_manifest_file(), "w") as f:
+            json.dump(self.manifest, f)
+
+    def _load_checkpoint(self, tuple_key, mats: List[AdjMatrix]) -> int:
+        """
+        Restore arr of mats from the checkpoint of the tile.
+
+        :return: number of finished rows of the tile (0 if there is no checkpoint)
+        """
+        try:
+            checkpoint = load_pickle(self._get_checkpoint_file(tuple_key))
+        except FileNotFoundError:
+            return 0
+        for mat, arr in zip(mats, checkpoint["arrs"]):
+            mat.arr[:] = arr
+        cprint("Checkpoint Loaded: {} from row {}".format(tuple_key, checkpoint["rows_done"]), "green")
+        return checkpoint["rows_done"]
+
+    def _dump_checkpoint(self, tuple_key, rows_done: int, mats: List[AdjMatrix]):
+        # Rows done are written with arr in one atomic file, so only the row in flight is lost by a crash.
+        if rows_done % self.checkpoint_rows != 0 or rows_done == mats[0].row_size:
+            return
+        dump_pickle({"rows_done": rows_done, "arrs": [mat.arr for mat in mats]}, self._get_checkpoint_file(tuple_key))
+        if self.manifest is not None:  # None if tiles are scheduled by tile_scheduler
+            self.manifest["partial"][self._get_tile_name(tuple_key)] = rows_done
+            self._dump_manifest()
+
+    def _finish_tile(self, tuple_key, mats: List[AdjMatrix]):
+        for mat in mats:
+            mat.dump()
+        tile_name = self._get_tile_name(tuple_key)
+        self.manifest["done"].append(tile_name)
+        self.manifest["partial"].pop(tile_name, None)
+        self._dump_manifest()
+        if os.path.exists(self._get_checkpoint_file(tuple_key)):
+            os.remove(self._get_checkpoint_file(tuple_key))
+
     def _get_one_batch_matrix(self, row_vertices_batch: list, tuple_key: tuple):
         mat = AdjMatrix(row_vertices=row_vertices_batch, col_vertices=None, tuple_key=tuple_key,
-                        file_prefix=self.file_prefix, initial_value=self.initial_value)
+                        file_prefix=self.file_prefix, initial_value=self.initial_value,
+                        dtype=self.dtype, packed=self.packed)
 
-        for i, u in enumerate(row_vertices_batch):
+        start_row = self._load_checkpoint(tuple_key, [mat])
+        for i in range(start_row, len(row_vertices_batch)):
+            u = row_vertices_batch[i]
             relations = self.get_sft_and_tfs_async_batch(st_pairs=[(u, v) for v in row_vertices_batch[i:]])
             for j, (u_follows_v, v_follows_u) in enumerate(relations):
                 j = j + i
                 mat[i][j] = u_follows_v
                 mat[j][i] = v_follows_u
+            self._dump_checkpoint(tuple_key, i + 1, [mat])
 
         return mat
 
     def _get_pair_batch_matrix(self, row_vertices_batch: list, col_vertices_batch: list, tuple_key: tuple):
         mat = AdjMatrix(row_vertices=row_vertices_batch, col_vertices=col_vertices_batch, tuple_key=tuple_key,
-                        file_prefix=self.file_prefix, initial_value=self.initial_value)
+                        file_prefix=self.file_prefix, initial_value=self.initial_value,
+                        dtype=self.dtype, packed=self.packed)
 
         transposed_key = (tuple_key[1], tuple_key[0], tuple_key[2])
         mat_t = AdjMatrix(row_vertices=col_vertices_batch, col_vertices=row_vertices_batch, tuple_key=transposed_key,
-                          file_prefix=self.file_prefix, initial_value=self.initial_value)
+                          file_prefix=self.file_prefix, initial_value=self.initial_value,
+                          dtype=self.dtype, packed=self.packed)
 
-        for i, u in enumerate(row_vertices_batch):
+        start_row = self._load_checkpoint(tuple_key, [mat, mat_t])
+        for i in range(start_row, len(row_vertices_batch)):
+            u = row_vertices_batch[i]
             relations = self.get_sft_and_tfs_async_batch(st_pairs=[(u, v) for v in col_vertices_batch])
             for j, (u_follows_v, v_follows_u) in enumerate(relations):
                 mat[i][j] = u_follows_v
                 mat_t[j][i] = v_follows_u
+            self._dump_checkpoint(tuple_key, i + 1, [mat, mat_t])
 
         return mat, mat_t
 
     def get_matrices(self):
 
         batch_num = round_up_division(len(self.vertices), self.batch_size)
+        self.manifest = self._load_manifest(batch_num)
+        done_tiles = set(self.manifest["done"])
 
         for row_idx in range(self.row_progress, batch_num):
             for col_idx in range(row_idx, batch_num):
                 tuple_key = (row_idx, col_idx, batch_num)
+                if self._get_tile_name(tuple_key) in done_tiles:
+                    cprint("Tile Skipped: {}".format(tuple_key), "green")
+                    continue
 
                 row_base = row_idx * self.batch_size
                 row_vertices = self.vertices[row_base:row_base + self.batch_size]
@@ -219,17 +688,23 @@ class AdjMatrixAPIWrapper(TwitterAPIWrapper):
 
                 if row_idx == col_idx:
                     mat = self._get_one_batch_matrix(row_vertices, tuple_key)
-                    mat.dump()
+                    self._finish_tile(tuple_key, [mat])
                 else:
                     mat, mat_t = self._get_pair_batch_matrix(row_vertices, col_vertices, tuple_key)
-                    mat.dump()
-                    mat_t.dump()
+                    self._finish_tile(tuple_key, [mat, mat_t])
 
 
 class AdjMatrixFromNetwork:
 
     def __init__(self, user_id_to_friend_ids: dict, user_id_to_follower_ids: dict or None, marginal_user_set: set,
-                 file_prefix: str = "adj", batch_size: int = 10000, initial_value: int = -42, progress: int = None):
+                 file_prefix: str = "adj", batch_size: int = 10000, initial_value: int = -42, progress: int = None,
+                 dtype=np.int64, packed: bool = False, is_sparse: bool = False, num_processes: int = 1):
+        """
+        :param dtype: dtype of tiles, np.int8 to opt in to 1 byte per cell (see AdjMatrix)
+        :param packed: opt in to dump tiles in 2 bits per cell (see AdjMatrix)
+        :param is_sparse: build SparseAdjMatrix tiles instead of dense ones
+        :param num_processes: processes to build and dump tiles in parallel
+        """
 
         self.user_id_to_friend_ids = user_id_to_friend_ids
         self.user_id_to_follower_ids = user_id_to_follower_ids
@@ -241,6 +716,10 @@ class AdjMatrixFromNetwork:
         self.batch_size = batch_size
         self.initial_value = initial_value
         self.row_progress = progress if progress else 0
+        self.dtype = dtype
+        self.packed = packed
+        self.is_sparse = is_sparse
+        self.num_processes = num_processes
 
     def update_user_id_to_follower_ids(self, user_id_to_follower_ids):
         if not self.user_id_to_follower_ids:
@@ -272,24 +751,103 @@ class AdjMatrixFromNetwork:
 
         return s_follows_t
 
+    def _get_sparse_batch_matrix(self, row_vertices_batch: list, col_vertices_batch: list, tuple_key: tuple,
+                                 search_to_ids=None, file_pre_prefix=""):
+        """
+        SparseAdjMatrix of the same values as _get_batch_matrix, built from neighbor lists without dense cells.
+        """
+        search_to_ids = search_to_ids or self.user_id_to_friend_ids
+        mat = SparseAdjMatrix(row_vertices=row_vertices_batch,
+                              col_vertices=col_vertices_batch,
+                              tuple_key=tuple_key,
+                              file_prefix="{}{}".format(file_pre_prefix, self.file_prefix))
+
+        cells = {"positive": ([], []), "unknown": ([], [])}
+        all_col_idx = np.arange(mat.col_size)
+        for i, u in enumerate(mat.row_vertices.tolist()):
+            friend_ids = search_to_ids[str(u)]
+            if friend_ids:
+                col_idx = mat.get_col_indices(friend_ids)
+                name, col_idx = "positive", col_idx[col_idx != -1]
+            else:
+                name, col_idx = "unknown", all_col_idx
+            col_idx = np.unique(col_idx[mat.col_vertices[col_idx] != u])  # s == t is 0
+            cells[name][0].append(np.full(len(col_idx), i, dtype=np.int64))
+            cells[name][1].append(col_idx)
+
+        masks = []
+        for name in ("positive", "unknown"):
+            rows = np.concatenate(cells[name][0]) if cells[name][0] else np.asarray([], dtype=np.int64)
+            cols = np.concatenate(cells[name][1]) if cells[name][1] else np.asarray([], dtype=np.int64)
+            masks.append(sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=mat.masks.shape))
+        mat.masks = SparseMasks(*masks)
+        return mat
+
     def _get_batch_matrix(self, row_vertices_batch: list, col_vertices_batch: list, tuple_key: tuple,
                           search_to_ids=None, file_pre_prefix=""):
 
+        if self.is_sparse:
+            return self._get_sparse_batch_matrix(row_vertices_batch, col_vertices_batch, tuple_key,
+                                                 search_to_ids=search_to_ids, file_pre_prefix=file_pre_prefix)
+
         mat = AdjMatrix(row_vertices=row_vertices_batch,
                         col_vertices=col_vertices_batch,
                         tuple_key=tuple_key,
                         file_prefix="{}{}".format(file_pre_prefix, self.file_prefix),
-                        initial_value=self.initial_value)
-
-        for i, u in enumerate(row_vertices_batch):
-            for j, v in enumerate(col_vertices_batch):
-                mat[i][j] = self.get_sft(u, v, search_to_ids=search_to_ids)
+                        initial_value=self.initial_value,
+                        dtype=self.dtype, packed=self.packed)
+        self._fill_batch_arr(mat, search_to_ids or self.user_id_to_friend_ids)
         return mat
 
+    @staticmethod
+    def _fill_batch_arr(mat: AdjMatrix, search_to_ids: dict):
+        """
+        Same values as get_sft for every cell: each neighbor list is looked up once,
+        and its neighbors are set to 1 by the col index of mat, instead of a membership test per cell.
+        """
+        rows, neighbors, is_unknown = [], [], np.zeros(mat.row_size, dtype=bool)
+        for i, u in enumerate(mat.row_vertices.tolist()):
+            friend_ids = search_to_ids[str(u)]
+            if friend_ids:
+                rows.append(np.full(len(friend_ids), i, dtype=np.int64))
+                neighbors.append(np.fromiter(friend_ids, dtype=np.int64, count=len(friend_ids)))
+            else:
+                is_unknown[i] = True
+
+        mat.arr[:] = 0
+        mat.arr[is_unknown] = -1
+        if rows:
+            rows, col_idx = np.concatenate(rows), mat.get_col_indices(np.concatenate(neighbors))
+            is_found = col_idx != -1
+            mat.arr[rows[is_found], col_idx[is_found]] = 1
+
+        # s == t is 0
+        diagonal_col_idx = mat.get_col_indices(mat.row_vertices)
+        is_diagonal = diagonal_col_idx != -1
+        mat.arr[np.flatnonzero(is_diagonal), diagonal_col_idx[is_diagonal]] = 0
+
+    def _build_tiles(self, tile_args: list):
+        """
+        :param tile_args: list of (row_vertices, col_vertices, tuple_key, search_to_ids_attr, file_pre_prefix)
+        """
+        if self.num_processes > 1:
+            # This instance is given to each worker once (not per tile). Under the fork start method (Linux),
+            # workers inherit it without pickling; under spawn or forkserver (macOS, Windows), the whole instance,
+            # including neighbor dicts, is pickled once for each worker.
+            with Pool(processes=self.num_processes, initializer=_init_tile_builder, initargs=(self,)) as pool:
+                for tuple_key in pool.imap_unordered(_build_and_dump_tile, tile_args):
+                    cprint("Tile Built: {}".format(tuple_key), "green")
+        else:
+            _init_tile_builder(self)
+            for args in tile_args:
+                tuple_key = _build_and_dump_tile(args)
+                cprint("Tile Built: {}".format(tuple_key), "green")
+
     def get_matrices_NetworkXNetwork(self):
 
         batch_num = round_up_division(len(self.network_vertices), self.batch_size)
 
+        tile_args = []
         for row_idx in range(self.row_progress, batch_num):
             for col_idx in range(row_idx, batch_num):
                 tuple_key = (row_idx, col_idx, batch_num)
@@ -300,15 +858,16 @@ class AdjMatrixFromNetwork:
                 col_base = col_idx * self.batch_size
                 col_vertices = self.network_vertices[col_base:col_base + self.batch_size]
 
-                mat = self._get_batch_matrix(row_vertices, col_vertices, tuple_key)
-                mat.dump()
-                print(mat)
+                tile_args.append((row_vertices, col_vertices, tuple_key, "user_id_to_friend_ids", ""))
 
-    def _get_matrices_with_marginal(self, row_vertices_all, col_vertices_all, search_to_ids, file_pre_prefix):
+        self._build_tiles(tile_args)
+
+    def _get_matrices_with_marginal(self, row_vertices_all, col_vertices_all, search_to_ids_attr, file_pre_prefix):
 
         row_batch_num = round_up_division(len(row_vertices_all), self.batch_size)
         col_batch_num = round_up_division(len(col_vertices_all), self.batch_size)
 
+        tile_args = []
         for row_idx in range(row_batch_num):
             for col_idx in range(col_batch_num):
                 tuple_key = (row_idx, col_idx, max(row_batch_num, col_batch_num))
@@ -319,17 +878,16 @@ class AdjMatrixFromNetwork:
                 col_base = col_idx * self.batch_size
                 col_vertices = col_vertices_all[col_base:col_base + self.batch_size]
 
-                mat = self._get_batch_matrix(row_vertices, col_vertices, tuple_key,
-                                             search_to_ids=search_to_ids, file_pre_prefix=file_pre_prefix)
-                mat.dump()
-                print(mat)
+                tile_args.append((row_vertices, col_vertices, tuple_key, search_to_ids_attr, file_pre_prefix))
+
+        self._build_tiles(tile_args)
 
     def get_matrices_NetworkXMarginal(self):
-        self._get_matrices_with_marginal(self.network_vertices, self.marginal_vertices, self.user_id_to_friend_ids,
+        self._get_matrices_with_marginal(self.network_vertices, self.marginal_vertices, "user_id_to_friend_ids",
                                          file_pre_prefix="NetworkXMarginal_")
 
     def get_matrices_MarginalXNetwork(self):
-        self._get_matrices_with_marginal(self.network_vertices, self.marginal_vertices, self.user_id_to_follower_ids,
+        self._get_matrices_with_marginal(self.network_vertices, self.marginal_vertices, "user_id_to_follower_ids",
                                          file_pre_prefix="MarginalXNetwork_")
 
     def get_matrices_MarginalXDot(self):
@@ -337,8 +895,26 @@ class AdjMatrixFromNetwork:
         self.get_matrices_MarginalXNetwork()
 
 
+_tile_builder: AdjMatrixFromNetwork = None
+
+
+def _init_tile_builder(builder: AdjMatrixFromNetwork):
+    global _tile_builder
+    _tile_builder = builder
+
+
+def _build_and_dump_tile(args) -> tuple:
+    row_vertices, col_vertices, tuple_key, search_to_ids_attr, file_pre_prefix = args
+    mat = _tile_builder._get_batch_matrix(row_vertices, col_vertices, tuple_key,
+                                          search_to_ids=getattr(_tile_builder, search_to_ids_attr),
+                                          file_pre_prefix=file_pre_prefix)
+    mat.dump()
+    return tuple_key
+
+
 def get_adj_matrix_from_user_network(friend_file, follower_file, marginal_user_set,
-                                     file_prefix="network_adj", need_follower_load=False, batch_size=10000):
+                                     file_prefix="network_adj", need_follower_load=False, batch_size=10000,
+                                     is_sparse=False, num_processes=1):
     friend_network = UserNetwork()
     friend_network.load(friend_file)
     user_id_to_friend_ids = friend_network.user_id_to_friend_ids
@@ -349,6 +925,8 @@ def get_adj_matrix_from_user_network(friend_file, follower_file, marginal_user_s
         marginal_user_set=marginal_user_set,
         file_prefix=file_prefix,
         batch_size=batch_size,
+        is_sparse=is_sparse,
+        num_processes=num_processes,
     )
 
     if need_follower_load:
@@ -409,13 +987,13 @@ if __name__ == '__main__':
         adj.get_matrices_NetworkXNetwork()
 
     elif MODE == "FROM_SAMPLE":
-        user_set = load_user_set("sampled_not_propagated_user_set_follower_0.pkl")
+        user_set = load_user_set("sampled_not_propagated_user_set_follower_0.npy")
         matrix_api = AdjMatrixAPIWrapper(given_config_file_path_list, batch_size=10000, file_prefix="sample_adj")
         matrix_api.set_vertices(user_set, sorting=True)
         matrix_api.get_matrices()
 
     elif MODE == "FROM_MARGINAL":
-        user_set = load_user_set("sampled_not_propagated_user_set_follower_0.pkl")
+        user_set = load_user_set("sampled_not_propagated_user_set_follower_0.npy")
         adj = get_adj_matrix_from_user_network(
             friend_file="UserNetwork_friends.pkl",
             follower_file=None,
@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
-from network import get_or_create_user_networkx
+from network import get_or_create_user_networkx, get_network_file_list, UserNetworkIndex
 from TwitterAPIWrapper import TwitterAPIWrapper, is_account_public_for_one
 from story_bow import *
 from format_event import *
 from user_set import *
+from user_array import USER_DTYPE, to_user_array, is_in_user_array, hash_user_ids
+from user_bitmap import UserIdInterner, UserBitmap
+from network_array import AdjacencyArray, count_values, top_k_by_count, merge_counts, union_edges, \
+    symmetric_completion
+from serialization import load_pickle
+from crawl_index import CrawledUserIndex
 from utill import *
 from termcolor import colored, cprint
-from typing import List, Dict
+from typing import List, Dict, Tuple
 import os
 import shutil
 from collections import Counter
+from multiprocessing import Pool
 import time
 import networkx as nx
 
@@ -23,8 +30,12 @@ class UserNetworkAPIWrapper(TwitterAPIWrapper):
                  user_set: set,
                  dump_file_id: int = None,
                  what_to_crawl: str = "follower",
-                 sec_to_wait: int = 60):
+                 sec_to_wait: int = 60,
+                 crawl_index: CrawledUserIndex = None):
         """
+        :param crawl_index: CrawledUserIndex updated with crawled users at every save point (optional),
+            which is logged at save points and dumped at PENDING_LIMIT users or at the end of the crawl
+
         Attributes
         ----------
         :user_id_to_follower_ids: dict, str -> list
@@ -37,6 +48,7 @@ class UserNetworkAPIWrapper(TwitterAPIWrapper):
         self.error_user_set: set = set()
         self.sec_to_wait = sec_to_wait
         self.what_to_crawl = what_to_crawl
+        self.crawl_index = crawl_index
         assert what_to_crawl is "friend" or what_to_crawl is "follower"
 
         # user IDs for every user following the specified user.
@@ -49,7 +61,11 @@ class UserNetworkAPIWrapper(TwitterAPIWrapper):
             config_file_path, len(self.user_set), 'with' if 'ROOT' in user_set else 'without',
         ), 'green'))
 
-    def _dump_user_network(self, file_name: str = None, file_slice: int = 11, network_path=None, is_sliced=False):
+    def _dump_user_network(self, file_name: str = None, file_slice: int = 11, network_path=None, is_sliced=False,
+                           with_index=True):
+        """
+        :param with_index: write UserNetworkIndex, which save points skip and the end of the crawl writes.
+        """
         user_network_for_dumping = UserNetwork(
             self.user_id_to_follower_ids,
             self.user_id_to_friend_ids,
@@ -57,7 +73,8 @@ class UserNetworkAPIWrapper(TwitterAPIWrapper):
             self.error_user_set,
             self.dump_file_id,
         )
-        user_network_for_dumping.dump(file_name, file_slice=file_slice, network_path=network_path, is_sliced=is_sliced)
+        user_network_for_dumping.dump(file_name, file_slice=file_slice, network_path=network_path, is_sliced=is_sliced,
+                                      with_index=with_index)
         return user_network_for_dumping
 
     def _load_user_network(self, file_name: str = None, network_path=None, is_sliced=False):
@@ -101,10 +118,12 @@ class UserNetworkAPIWrapper(TwitterAPIWrapper):
             user_list_need_crawling = [u for u in self.user_set if u not in self.user_id_to_friend_ids]
 
         len_user_set = len(user_list_need_crawling)
+        users_crawled_after_save = []
         for i, user_id in enumerate(user_list_need_crawling):
 
             if user_id != 'ROOT' and user_id not in user_id_to_target_ids and user_id not in self.error_user_set:
 
+                users_crawled_after_save.append(user_id)
                 target_ids = fetch_target_ids(user_id)
                 user_id_to_target_ids[user_id] = target_ids
 
@@ -120,10 +139,22 @@ class UserNetworkAPIWrapper(TwitterAPIWrapper):
             if (i + 1) % save_point == 0:
                 self._dump_user_network(
                     file_name,
-                    file_slice=file_slice, network_path=network_path, is_sliced=is_sliced
+                    file_slice=file_slice, network_path=network_path, is_sliced=is_sliced, with_index=False,
                 )
+                self._update_crawl_index(users_crawled_after_save)
+                users_crawled_after_save = []
                 print('{0} | {1}/{2} finished.'.format(os.getpid(), i + 1, len_user_set))
 
+        self._update_crawl_index(users_crawled_after_save, is_end=True)
+
+    def _update_crawl_index(self, crawled_users: list, is_end=False):
+        if self.crawl_index is not None:
+            self.crawl_index.add(crawled_users)
+            if is_end:
+                self.crawl_index.dump()
+            else:
+                self.crawl_index.checkpoint()
+
     def get_user_id_to_follower_ids(self, file_name, save_point=10,
                                     file_slice: int = 11, network_path=None, is_sliced=False):
         self.get_user_id_to_target_ids(file_name, self.user_id_to_follower_ids, self._fetch_follower_ids, save_point,
@@ -282,90 +313,318 @@ class UserNetworkChecker:
         _user_network_api.get_and_dump_user_network(file_name=file_name, with_load=False, save_point=save_point)
 
 
-def prune_networks(network_list: List[UserNetwork], aux_user_set=None,
-                   pruning_ratio=1.0) -> UserNetwork:
+def _get_most_common_rank(total_counts: np.ndarray, first_idx: np.ndarray, num_remained_users_list: List[int]):
     """
-    :param network_list: list of UserNetwork
-    :param aux_user_set: auxiliary uer set
-    :param pruning_ratio: the ratio of users to prune (>0.0 and <=1.0)
-        - e.g., if pr = 1.0: Prune all except users who are keys of UserNetwork (participated in the propagation).
-
-    :return: UserNetwork pruned with level.
+    :return: (indices of total users in most common order, rank of total users in that order)
+        - users remained in a ratio are users of rank < num_remained_users.
     """
-    # All users who participated in the propagation
-    real_user_set = set()
+    most_common_idx = top_k_by_count(total_counts, first_idx, max(num_remained_users_list))
+    total_user_rank = np.full(len(total_counts), len(total_counts), dtype=np.int64)
+    total_user_rank[most_common_idx] = np.arange(len(most_common_idx))
+    return most_common_idx, total_user_rank
 
-    # All users in the network allowing duplicates.
-    total_user_counter = Counter()
 
-    cprint("Loading user set from {} networks".format(len(network_list)), "green")
-    for net in network_list:
-        real_user_set.update(net.user_id_to_friend_ids.keys())
-        real_user_set.update(net.user_id_to_follower_ids.keys())
-
-        for followers in tqdm(net.user_id_to_follower_ids.values(), total=len(net.user_id_to_follower_ids)):
-            if followers:
-                total_user_counter.update(followers)
-        for friends in tqdm(net.user_id_to_friend_ids.values(), total=len(net.user_id_to_friend_ids)):
-            if friends:
-                total_user_counter.update(friends)
-
-    real_user_set = {int(u) for u in real_user_set}
+def _get_real_user_bitmap(total_users: np.ndarray, real_user_array: np.ndarray) -> UserBitmap:
+    """
+    :return: UserBitmap of real users interned by their positions in total_users (real users not in total_users,
+        i.e., never neighbors, are not needed).
+    """
+    real_user_bitmap = UserBitmap.from_ids(UserIdInterner(total_users, is_sorted=True).intern(real_user_array))
+    cprint("Build real_user_bitmap: {} of {} bytes".format(len(real_user_bitmap), real_user_bitmap.nbytes()),
+           "green")
+    return real_user_bitmap
 
-    num_remained_users = int(len(total_user_counter) * (1 - pruning_ratio))
-    print("num_remained_users: {}".format(num_remained_users))
 
-    most_common_user_and_count = total_user_counter.most_common(num_remained_users)
-    if num_remained_users > 0:
-        count_array = np.asarray(most_common_user_and_count).transpose()[1]
-        print_stats(count_array)
+def _get_neighbor_ranks(adjacency_array: AdjacencyArray, total_users: np.ndarray, total_user_rank: np.ndarray,
+                        real_user_bitmap: UserBitmap) -> np.ndarray:
+    """
+    :return: rank of every neighbor, and -1 for real users who always remain.
+    """
+    positions = np.searchsorted(total_users, adjacency_array.values)
+    ranks = total_user_rank[positions]
+    ranks[real_user_bitmap.contains_many(positions)] = -1
+    return ranks
 
-    pruned_total_user_set = {int(u) for u, cnt in most_common_user_and_count}
-    cprint("Load real_user_set: {}".format(len(real_user_set)), "green")
-    cprint("Load pruned_total_user_set: {} from {}".format(len(pruned_total_user_set),
-                                                           len(total_user_counter)), "green")
 
-    if len(pruned_total_user_set) > 0:
-        real_user_set.update(pruned_total_user_set)
+def _prune_adjacency_arrays(network_to_prune: UserNetwork, followers: AdjacencyArray, friends: AdjacencyArray,
+                            follower_ranks: np.ndarray, friend_ranks: np.ndarray, num_remained_users: int,
+                            follower_key_masks=None, friend_key_masks=None):
+    """
+    :param follower_key_masks: (is_in_network, is_kept), bool np.ndarray over keys of followers (default: all True)
+        - Keys not in the network are skipped, and keys not kept only add error users.
+    :param friend_key_masks: same as follower_key_masks, for friends
+    """
+    for adjacency, adjacency_array, ranks, key_masks in (
+            (network_to_prune.user_id_to_friend_ids, friends, friend_ranks, friend_key_masks),
+            (network_to_prune.user_id_to_follower_ids, followers, follower_ranks, follower_key_masks)):
+        if key_masks is None:
+            key_masks = (np.ones(len(adjacency_array), dtype=bool),) * 2
+        is_in_network, is_kept = key_masks
+        pruned_lists = adjacency_array.to_lists(ranks < num_remained_users)
+        for user_id, is_none, in_network, kept, pruned in zip(adjacency_array.keys, adjacency_array.is_none.tolist(),
+                                                              is_in_network.tolist(), is_kept.tolist(), pruned_lists):
+            if not in_network:
+                continue
+            user_id = int(user_id)
+            if is_none:
+                network_to_prune.error_user_set.add(user_id)
+            if kept:
+                adjacency[user_id] = pruned
 
-    if aux_user_set:
-        real_user_set.update({int(u) for u in aux_user_set})
-        cprint("Update aux_user_set: {}, now real_user_set: {}".format(len(aux_user_set), len(real_user_set)), "green")
 
-    network_to_prune = UserNetwork()
-    error_user_set = set()
+def _print_pruning_stats(pruning_ratio, num_remained_users, total_counts, most_common_idx):
+    print("pruning_ratio: {}, num_remained_users: {}".format(pruning_ratio, num_remained_users))
+    if num_remained_users > 0:
+        print_stats(total_counts[most_common_idx[:num_remained_users]])
+    cprint("Load pruned_total_user_set: {} from {}".format(min(num_remained_users, len(most_common_idx)),
+                                                           len(total_counts)), "green")
 
-    cprint("Pruning users from {} networks".format(len(network_list)), "green")
-    for net in network_list:
 
-        for i, (user_with_friend, friends) in enumerate(tqdm(net.user_id_to_friend_ids.items(),
-                                                             total=len(net.user_id_to_friend_ids))):
-            user_with_friend = int(user_with_friend)
+def prune_networks(network_list: List[UserNetwork], aux_user_set=None,
+                   pruning_ratio=1.0, on_pruned=None) -> UserNetwork or Dict[float, UserNetwork]:
+    """
+    :param network_list: list of UserNetwork
+    :param aux_user_set: auxiliary uer set
+    :param pruning_ratio: the ratio of users to prune (>0.0 and <=1.0), or a list of ratios
+        - e.g., if pr = 1.0: Prune all except users who are keys of UserNetwork (participated in the propagation).
+        - Users are counted once for all ratios, and the retained users of a ratio are a subset of a lower one's.
+    :param on_pruned: function (pruning_ratio, UserNetwork) -> None, called when each network is pruned.
+        - If given, pruned networks are not kept in memory (e.g., dump in on_pruned).
 
-            if friends is None:
-                pruned_friends = None
-                error_user_set.add(user_with_friend)
-            else:
-                pruned_friends = [f for f in friends if f in real_user_set]
+    :return: UserNetwork pruned with level if pruning_ratio is a float,
+        else dict, pruning_ratio -> UserNetwork (empty if on_pruned is given)
+    """
+    pruning_ratio_list = pruning_ratio if isinstance(pruning_ratio, (list, tuple)) else [pruning_ratio]
 
-            network_to_prune.user_id_to_friend_ids[user_with_friend] = pruned_friends
+    cprint("Loading user set from {} networks".format(len(network_list)), "green")
+    adjacency_arrays = []
+    for net in tqdm(network_list):
+        adjacency_arrays.append((AdjacencyArray(net.user_id_to_follower_ids),
+                                 AdjacencyArray(net.user_id_to_friend_ids)))
 
-        for i, (user_with_follower, followers) in enumerate(tqdm(net.user_id_to_follower_ids.items(),
-                                                                 total=len(net.user_id_to_follower_ids))):
-            user_with_follower = int(user_with_follower)
+    # All users who participated in the propagation
+    real_user_array = to_user_array([u for followers, friends in adjacency_arrays
+                                     for u in followers.keys + friends.keys])
+    cprint("Load real_user_set: {}".format(len(real_user_array)), "green")
+    if aux_user_set:
+        real_user_array = np.union1d(real_user_array, to_user_array(aux_user_set))
+        cprint("Update aux_user_set: {}, now real_user_set: {}".format(len(aux_user_set), len(real_user_array)),
+               "green")
+
+    # All users in the network allowing duplicates, counted in the order of networks, followers then friends.
+    total_users, total_counts, first_idx = count_values([adj.values for pair in adjacency_arrays for adj in pair])
+
+    num_remained_users_list = [int(len(total_users) * (1 - pr)) for pr in pruning_ratio_list]
+    most_common_idx, total_user_rank = _get_most_common_rank(total_counts, first_idx, num_remained_users_list)
+    real_user_bitmap = _get_real_user_bitmap(total_users, real_user_array)
+    neighbor_ranks = [tuple(_get_neighbor_ranks(adj, total_users, total_user_rank, real_user_bitmap) for adj in pair)
+                      for pair in adjacency_arrays]
+
+    pruned_networks = dict()
+    for pr, num_remained_users in zip(pruning_ratio_list, num_remained_users_list):
+        _print_pruning_stats(pr, num_remained_users, total_counts, most_common_idx)
+
+        network_to_prune = UserNetwork()
+        cprint("Pruning users from {} networks".format(len(network_list)), "green")
+        for (followers, friends), (follower_ranks, friend_ranks) in tqdm(zip(adjacency_arrays, neighbor_ranks),
+                                                                         total=len(adjacency_arrays)):
+            _prune_adjacency_arrays(network_to_prune, followers, friends, follower_ranks, friend_ranks,
+                                    num_remained_users)
+
+        pruned_total_user_array = to_user_array(total_users[most_common_idx[:num_remained_users]])
+        network_to_prune.user_set = set(np.union1d(real_user_array, pruned_total_user_array).tolist())
+
+        if on_pruned is not None:
+            on_pruned(pr, network_to_prune)
+        else:
+            pruned_networks[pr] = network_to_prune
 
-            if followers is None:
-                pruned_followers = None
-                error_user_set.add(user_with_follower)
-            else:
-                pruned_followers = [f for f in followers if f in real_user_set]
+    if not isinstance(pruning_ratio, (list, tuple)):
+        return pruned_networks.get(pruning_ratio)
+    return pruned_networks
 
-            network_to_prune.user_id_to_follower_ids[user_with_follower] = pruned_followers
 
-    network_to_prune.user_set = real_user_set
-    network_to_prune.error_user_set = error_user_set
+def _get_key_table(key_arrays: List[np.ndarray], slice_arrays: List[np.ndarray], position_arrays: List[np.ndarray],
+                   length_arrays: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Keys of slices of one network as UserNetwork.load merges them: a key is placed at its position in the first
+    slice (in the order of prune_network_files) and has the list of the last slice.
 
-    return network_to_prune
+    :return: (sorted keys, the last slice of each key, offset of each key in the values of the loaded network)
+    """
+    keys, slices, positions, lengths = (np.concatenate(arrays) if arrays else np.asarray([], dtype=np.int64)
+                                        for arrays in (key_arrays, slice_arrays, position_arrays, length_arrays))
+    order = np.lexsort((slices, keys))
+    keys, slices, positions, lengths = keys[order], slices[order], positions[order], lengths[order]
+    is_first = np.concatenate(([True], keys[1:] != keys[:-1])) if len(keys) > 0 else np.asarray([], dtype=bool)
+    is_last = np.concatenate((keys[1:] != keys[:-1], [True])) if len(keys) > 0 else np.asarray([], dtype=bool)
+
+    unique_keys, last_slices, last_lengths = keys[is_last], slices[is_last], lengths[is_last]
+    placement = np.lexsort((positions[is_first], slices[is_first]))
+    key_offsets = np.empty(len(unique_keys), dtype=np.int64)
+    key_offsets[placement] = np.cumsum(last_lengths[placement]) - last_lengths[placement]
+    return unique_keys.astype(USER_DTYPE), last_slices, key_offsets
+
+
+def prune_network_files(network_files: list, pruned_file_name_format: str, aux_user_set=None,
+                        pruning_ratio=1.0, network_path=None, compress_level: int = 0):
+    """
+    Out-of-core prune_networks: peak memory is bounded by one slice of networks, keys, and the count table.
+        - Pass 0 streams slices to find the slice of each key, Pass 1 streams slices to count users,
+          and Pass 2 streams slices again to prune and dump them.
+        - As UserNetwork.load, a key in more than one slice of a network has the list of the slice loaded first,
+          and lists of the other slices are not counted. Users are counted in the order of prune_networks over
+          loaded networks, so the results are the same.
+        - A user crawled in more than one network is kept in the later network, as prune_networks.
+          Keys of pruned slices are disjoint, so they load the same in any order.
+
+    :param network_files: list of file names of UserNetwork (None for SlicedUserNetwork)
+    :param pruned_file_name_format: e.g., "PrunedUserNetwork_without_aux_pruning_{}.pkl", formatted with the ratio.
+        - Pruned networks are dumped in slices, one for each slice of networks (load them with is_sliced=True).
+    :param pruning_ratio: the ratio of users to prune, or a list of ratios (see prune_networks)
+    """
+    network_path = network_path or NETWORK_PATH
+    pruning_ratio_list = pruning_ratio if isinstance(pruning_ratio, (list, tuple)) else [pruning_ratio]
+
+    # UserNetwork.load merges a slice in front of the previous ones, so slices are read in reverse.
+    slices_of_network = [get_network_file_list(network_file, network_path)[::-1] for network_file in network_files]
+    slice_files = [f for slices in slices_of_network for f in slices]
+    network_idx_of_slice = [ni for ni, slices in enumerate(slices_of_network) for _ in slices]
+
+    def iter_slices(desc):
+        for i, slice_file in enumerate(slice_files):
+            cprint("{} ({}/{}): {}".format(desc, i + 1, len(slice_files), slice_file), "green")
+            sliced_network: UserNetwork = load_pickle(os.path.join(network_path, slice_file))
+            yield i, (AdjacencyArray(sliced_network.user_id_to_follower_ids),
+                      AdjacencyArray(sliced_network.user_id_to_friend_ids))
+
+    def get_slice_keys(adjacency_array: AdjacencyArray) -> np.ndarray:
+        return np.asarray([int(k) for k in adjacency_array.keys], dtype=USER_DTYPE)
+
+    # Pass 0: for each network and followers or friends, (sorted keys, last slice, offset in values).
+    key_columns = [[([], [], [], []) for _ in range(2)] for _ in network_files]
+    real_user_array = to_user_array(aux_user_set or [])
+    for i, (followers, friends) in iter_slices("Indexing"):
+        real_user_array = np.union1d(real_user_array, to_user_array(followers.keys + friends.keys))
+        for kind, adjacency_array in enumerate((followers, friends)):
+            slice_keys = get_slice_keys(adjacency_array)
+            for column, array in zip(key_columns[network_idx_of_slice[i]][kind],
+                                     (slice_keys, np.full(len(slice_keys), i, dtype=np.int64),
+                                      np.arange(len(slice_keys)), np.diff(adjacency_array.offsets))):
+                column.append(array)
+    key_tables = [[_get_key_table(*columns) for columns in network_columns] for network_columns in key_columns]
+
+    # For followers and friends, (sorted keys, the last slice of each key in all networks).
+    last_slices = []
+    for kind in range(2):
+        keys = np.concatenate([tables[kind][0] for tables in key_tables] + [np.asarray([], dtype=USER_DTYPE)])
+        key_slices = np.concatenate([tables[kind][1] for tables in key_tables] + [np.asarray([], dtype=np.int64)])
+        order = np.lexsort((key_slices, keys))
+        keys, key_slices = keys[order], key_slices[order]
+        is_last = np.concatenate((keys[1:] != keys[:-1], [True])) if len(keys) > 0 else np.asarray([], dtype=bool)
+        last_slices.append((keys[is_last], key_slices[is_last]))
+
+    def get_key_masks(i, kind, adjacency_array: AdjacencyArray):
+        """
+        :return: (keys whose list is in the loaded network, keys whose list is kept in all networks)
+        """
+        slice_keys = get_slice_keys(adjacency_array)
+        keys, key_slices, _ = key_tables[network_idx_of_slice[i]][kind]
+        all_keys, all_key_slices = last_slices[kind]
+        return (key_slices[np.searchsorted(keys, slice_keys)] == i,
+                all_key_slices[np.searchsorted(all_keys, slice_keys)] == i)
+
+    # Pass 1: count table of (sorted users, counts, first occurrence). First occurrences are keyed by
+    # (network, followers or friends, position in the loaded network), which is the order of prune_networks.
+    total_users = np.asarray([], dtype=USER_DTYPE)
+    total_counts = np.asarray([], dtype=np.int64)
+    first_idx = np.asarray([], dtype=np.int64)
+    for i, (followers, friends) in iter_slices("Counting"):
+        for kind, adjacency_array in enumerate((followers, friends)):
+            is_in_network, _ = get_key_masks(i, kind, adjacency_array)
+            keys, _, key_offsets = key_tables[network_idx_of_slice[i]][kind]
+            lengths = np.diff(adjacency_array.offsets)[is_in_network]
+            offsets = key_offsets[np.searchsorted(keys, get_slice_keys(adjacency_array)[is_in_network])]
+            values = adjacency_array.values[np.repeat(is_in_network, np.diff(adjacency_array.offsets))]
+            starts = np.cumsum(lengths) - lengths
+            value_positions = np.repeat(offsets - starts, lengths) + np.arange(len(values))
+
+            order = np.argsort(value_positions, kind="stable")
+            ids, counts, first = count_values([values[order]])
+            first = value_positions[order][first] + ((2 * network_idx_of_slice[i] + kind) << 40)
+            total_users, total_counts, first_idx = merge_counts(total_users, total_counts, first_idx,
+                                                                ids, counts, first)
+    cprint("Load real_user_set: {}, total_user_set: {}".format(len(real_user_array), len(total_users)), "green")
+
+    num_remained_users_list = [int(len(total_users) * (1 - pr)) for pr in pruning_ratio_list]
+    most_common_idx, total_user_rank = _get_most_common_rank(total_counts, first_idx, num_remained_users_list)
+    for pr, num_remained_users in zip(pruning_ratio_list, num_remained_users_list):
+        _print_pruning_stats(pr, num_remained_users, total_counts, most_common_idx)
+
+    # user_set of each pruned network is divided into slices.
+    user_set_slices_list = [
+        np.array_split(np.union1d(real_user_array, total_users[most_common_idx[:num_remained_users]]),
+                       len(slice_files))
+        for num_remained_users in num_remained_users_list
+    ]
+
+    # Pass 2: prune and dump slices, and the index of each pruned network from the indexes of its slices.
+    real_user_bitmap = _get_real_user_bitmap(total_users, real_user_array)
+    index_lists = [[] for _ in pruning_ratio_list]
+    num_crawled_lists = [[0, 0] for _ in pruning_ratio_list]
+    for i, (followers, friends) in iter_slices("Pruning"):
+        follower_ranks, friend_ranks = (_get_neighbor_ranks(adj, total_users, total_user_rank, real_user_bitmap)
+                                        for adj in (followers, friends))
+        follower_key_masks, friend_key_masks = (get_key_masks(i, kind, adj)
+                                                for kind, adj in enumerate((followers, friends)))
+        for pr, num_remained_users, user_set_slices, index_list, num_crawled in zip(
+                pruning_ratio_list, num_remained_users_list, user_set_slices_list, index_lists, num_crawled_lists):
+            sliced_network = UserNetwork()
+            _prune_adjacency_arrays(sliced_network, followers, friends, follower_ranks, friend_ranks,
+                                    num_remained_users, follower_key_masks, friend_key_masks)
+            num_crawled[0] += len(sliced_network.user_id_to_follower_ids)
+            num_crawled[1] += len(sliced_network.user_id_to_friend_ids)
+            sliced_network.user_set = set(user_set_slices[i].tolist())
+            sliced_network._sliced_dump(i, network_path=network_path,
+                                        file_prefix=pruned_file_name_format.format(pr).replace(".pkl", ""),
+                                        compress_level=compress_level)
+            index_list.append(sliced_network.get_index())
+
+    for pr, user_set_slices, index_list, num_crawled in zip(pruning_ratio_list, user_set_slices_list,
+                                                            index_lists, num_crawled_lists):
+        UserNetworkIndex.merge(index_list, num_users=sum(len(s) for s in user_set_slices),
+                               num_crawled_users=max(num_crawled)).dump(pruned_file_name_format.format(pr),
+                                                                        network_path=network_path)
+
+
+def check_pruned_network_files(network_files: list, pruned_file_name_format: str, aux_user_set=None,
+                               pruning_ratio=1.0, network_path=None) -> bool:
+    """
+    Check that pruned networks of prune_network_files are the same as prune_networks over loaded networks.
+    """
+    network_list = []
+    for network_file in network_files:
+        user_network = UserNetwork()
+        user_network.load(file_name=network_file, network_path=network_path)
+        network_list.append(user_network)
+    pruning_ratio_list = pruning_ratio if isinstance(pruning_ratio, (list, tuple)) else [pruning_ratio]
+    expected_networks = prune_networks(network_list, aux_user_set=aux_user_set, pruning_ratio=pruning_ratio_list)
+
+    is_same = True
+    for pr, expected in expected_networks.items():
+        pruned = UserNetwork()
+        pruned.load(pruned_file_name_format.format(pr), network_path=network_path, is_sliced=True)
+        for what in ("user_id_to_follower_ids", "user_id_to_friend_ids", "user_set", "error_user_set"):
+            if getattr(pruned, what) != getattr(expected, what):
+                cprint("Different {} at pruning_ratio {}".format(what, pr), "red")
+                is_same = False
+        index = UserNetworkIndex.load(pruned_file_name_format.format(pr), network_path=network_path)
+        expected_index = expected.get_index()
+        for what in ("user_ids", "follower_counts", "friend_counts", "flags", "num_users", "num_crawled_users"):
+            if not np.array_equal(getattr(index, what), getattr(expected_index, what)):
+                cprint("Different index {} at pruning_ratio {}".format(what, pr), "red")
+                is_same = False
+    return is_same
 
 
 def fill_adjacency_from_events(base_network: UserNetwork, event_file_name=None, is_dump=False):
@@ -379,6 +638,9 @@ def fill_adjacency_from_events(base_network: UserNetwork, event_file_name=None,
     if is_dump:
         events.dump(event_file_name)
 
+    # Edges from the propagation, collected to be merged into the network at once.
+    parent_list, child_list = [], []
+    friend_sources, friend_targets = [], []
     for parent, children in tqdm(events.parent_to_children.items(),
                                  total=len(events.parent_to_children)):
         # By nature, children must follow parent
@@ -387,21 +649,28 @@ def fill_adjacency_from_events(base_network: UserNetwork, event_file_name=None,
             continue
 
         # == parent is a friend of children
-        for child in children:
-            if base_network.user_id_to_friend_ids[child] is None:
-                base_network.user_id_to_friend_ids[child] = []
-            if base_network.user_id_to_follower_ids[child] is None:  # Remove None
-                base_network.user_id_to_follower_ids[child] = []
-            friends_of_child = base_network.user_id_to_friend_ids[child] + [parent]
-            base_network.user_id_to_friend_ids[child] = list(set(friends_of_child))
+        friend_sources += children
+        friend_targets += [parent] * len(children)
 
         # == children are followers of parent
-        if base_network.user_id_to_follower_ids[parent] is None:
-            base_network.user_id_to_follower_ids[parent] = []
-        if base_network.user_id_to_friend_ids[parent] is None:  # Remove None
-            base_network.user_id_to_friend_ids[parent] = []
-        followers_of_parent = base_network.user_id_to_follower_ids[parent] + children
-        base_network.user_id_to_follower_ids[parent] = list(set(followers_of_parent))
+        parent_list.append(parent)
+        child_list += children
+
+    parent_list, child_list = list(dict.fromkeys(parent_list)), list(dict.fromkeys(child_list))
+    for user in child_list + parent_list:
+        if user not in base_network.user_id_to_friend_ids or user not in base_network.user_id_to_follower_ids:
+            raise KeyError(user)
+
+    # Remove None
+    for user in child_list:
+        if base_network.user_id_to_follower_ids[user] is None:
+            base_network.user_id_to_follower_ids[user] = []
+    for user in parent_list:
+        if base_network.user_id_to_friend_ids[user] is None:
+            base_network.user_id_to_friend_ids[user] = []
+
+    union_edges(base_network.user_id_to_friend_ids, child_list, friend_sources, friend_targets)
+    union_edges(base_network.user_id_to_follower_ids, parent_list, friend_targets, friend_sources)
 
     return base_network
 
@@ -418,53 +687,179 @@ def check_correctness(net: UserNetwork):
     return len(error_list) == 0
 
 
-def coalesce_not_propagated_users(net: UserNetwork):
-    co_net = UserNetwork()
-    for user_with_friend, friends in tqdm(net.user_id_to_friend_ids.items(),
-                                          total=len(net.user_id_to_friend_ids)):
+def _sample_pairs(mask: np.ndarray, owners: np.ndarray, members: np.ndarray, num_samples: int) -> list:
+    idx = np.flatnonzero(mask)[:num_samples]
+    return list(zip(owners[idx].tolist(), members[idx].tolist()))
 
-        if user_with_friend not in co_net.user_id_to_friend_ids:
-            co_net.user_id_to_friend_ids[user_with_friend] = net.user_id_to_friend_ids[user_with_friend]
-        else:
-            co_net.user_id_to_friend_ids[user_with_friend] += net.user_id_to_friend_ids[user_with_friend]
-        if user_with_friend not in co_net.user_id_to_follower_ids:
-            co_net.user_id_to_follower_ids[user_with_friend] = []
-
-        for f in friends:
-            # f is a friend of user == user is a follower of f
-            if f not in co_net.user_id_to_follower_ids:
-                co_net.user_id_to_follower_ids[f] = [user_with_friend]
-            else:
-                co_net.user_id_to_follower_ids[f].append(user_with_friend)
-            if f not in co_net.user_id_to_friend_ids:
-                co_net.user_id_to_friend_ids[f] = []
-
-    for user_with_follower, followers in tqdm(net.user_id_to_follower_ids.items(),
-                                              total=len(net.user_id_to_follower_ids)):
-        if user_with_follower not in co_net.user_id_to_follower_ids:
-            co_net.user_id_to_follower_ids[user_with_follower] = net.user_id_to_follower_ids[user_with_follower]
+
+def _verify_edge_partition(args) -> Dict[str, tuple]:
+    """
+    :param args: (friend_edges, follower_edges, num_samples)
+        - friend_edges: (followers, followees, is_checkable) of friend lists (owner = follower)
+        - follower_edges: (followers, followees, is_checkable) of follower lists (owner = followee)
+        - is_checkable: True if the other side of the edge has a list to be checked for reciprocity
+    :return: dict, violation -> (count, list of sample (owner, neighbor))
+    """
+    friend_edges, follower_edges, num_samples = args
+    report = dict()
+    pair_arrays = []
+    for what, (followers, followees, is_checkable), owner_is_follower in (("friend", friend_edges, True),
+                                                                          ("follower", follower_edges, False)):
+        owners, members = (followers, followees) if owner_is_follower else (followees, followers)
+
+        is_self_loop = followers == followees
+        report["self_loop_{}s".format(what)] = (int(is_self_loop.sum()),
+                                               _sample_pairs(is_self_loop, owners, members, num_samples))
+
+        order = np.lexsort((followees, followers))
+        followers, followees, is_checkable = followers[order], followees[order], is_checkable[order]
+        is_duplicate = np.zeros(len(order), dtype=bool)
+        is_duplicate[1:] = (followers[1:] == followers[:-1]) & (followees[1:] == followees[:-1])
+        owners, members = (followers, followees) if owner_is_follower else (followees, followers)
+        report["duplicate_{}s".format(what)] = (int(is_duplicate.sum()),
+                                               _sample_pairs(is_duplicate, owners, members, num_samples))
+        pair_arrays.append((followers[~is_duplicate], followees[~is_duplicate], is_checkable[~is_duplicate]))
+
+    # Pair membership: in (follower, followee, side) order, a pair is in both sides iff the pair next to it is equal.
+    (fr_followers, fr_followees, fr_checkable), (fo_followers, fo_followees, fo_checkable) = pair_arrays
+    followers = np.concatenate((fr_followers, fo_followers))
+    followees = np.concatenate((fr_followees, fo_followees))
+    is_checkable = np.concatenate((fr_checkable, fo_checkable))
+    side = np.concatenate((np.zeros(len(fr_followers), dtype=np.int8), np.ones(len(fo_followers), dtype=np.int8)))
+    order = np.lexsort((side, followees, followers))
+    followers, followees, is_checkable, side = followers[order], followees[order], is_checkable[order], side[order]
+    is_same_as_next = np.zeros(len(order), dtype=bool)
+    is_same_as_next[:-1] = (followers[1:] == followers[:-1]) & (followees[1:] == followees[:-1])
+    is_in_both = is_same_as_next | np.concatenate(([False], is_same_as_next[:-1]))
+
+    is_unreciprocated = is_checkable & ~is_in_both & (side == 0)
+    report["unreciprocated_friends"] = (int(is_unreciprocated.sum()),
+                                        _sample_pairs(is_unreciprocated, followers, followees, num_samples))
+    is_unreciprocated = is_checkable & ~is_in_both & (side == 1)
+    report["unreciprocated_followers"] = (int(is_unreciprocated.sum()),
+                                          _sample_pairs(is_unreciprocated, followees, followers, num_samples))
+    return report
+
+
+def verify_network(net: UserNetwork, num_processes: int = 1, num_samples: int = 5) -> Dict[str, tuple]:
+    """
+    Integrity check of UserNetwork, stricter than check_correctness.
+        - mixed_type_ids: keys (or neighbors) of a type other than the most common type of keys (or neighbors)
+            - e.g., int keys in a network of str keys, but consistent str keys of a raw crawl are not flagged
+        - unrecorded_error_users / stale_error_users: None lists not in error_user_set, and vice versa
+        - keys_without_friends / keys_without_followers: users crawled in only one direction
+        - keys_not_in_user_set
+        - self_loop_*, duplicate_*: in friend or follower lists
+        - unreciprocated_friends: v in friends of u, but u not in followers of v (if v has followers)
+        - unreciprocated_followers: v in followers of u, but u not in friends of v (if v has friends)
+
+    :param num_processes: processes to check edges, partitioned by the hash of followers
+    :return: dict, violation -> (count, list of sample violations)
+    """
+    report = dict()
+
+    def add(violation, violated):
+        violated = list(violated)
+        report[violation] = (len(violated), violated[:num_samples])
+
+    adjacency_of = (("friend", net.user_id_to_friend_ids), ("follower", net.user_id_to_follower_ids))
+
+    # Ids
+    key_types = Counter(type(u) for _, adjacency in adjacency_of for u in adjacency)
+    neighbor_types = Counter(type(u) for _, adjacency in adjacency_of
+                             for neighbors in adjacency.values() if neighbors for u in neighbors)
+    key_type = key_types.most_common(1)[0][0] if key_types else None
+    neighbor_type = neighbor_types.most_common(1)[0][0] if neighbor_types else None
+    mixed_type_ids = []
+    for _, adjacency in adjacency_of:
+        mixed_type_ids += [u for u in adjacency if type(u) is not key_type]
+        mixed_type_ids += [u for neighbors in adjacency.values() if neighbors for u in neighbors
+                           if type(u) is not neighbor_type]
+    add("mixed_type_ids", mixed_type_ids)
+
+    def to_int_adjacency(adjacency: dict) -> dict:
+        if set(key_types) | set(neighbor_types) <= {int}:
+            return adjacency
+        # Check the rest with numeric ids, without ids that are not numbers.
+        def is_numeric(x):
+            return type(x) is int or str(x).isdigit()
+        return {int(u): ([int(v) for v in neighbors if is_numeric(v)] if neighbors is not None else None)
+                for u, neighbors in adjacency.items() if is_numeric(u)}
+
+    # Errors and keys
+    none_users = {u for _, adjacency in adjacency_of for u, neighbors in adjacency.items() if neighbors is None}
+    add("unrecorded_error_users", (u for u in none_users if u not in net.error_user_set))
+    add("stale_error_users", (u for u in net.error_user_set if u not in none_users))
+    add("keys_without_friends", (u for u in net.user_id_to_follower_ids if u not in net.user_id_to_friend_ids))
+    add("keys_without_followers", (u for u in net.user_id_to_friend_ids if u not in net.user_id_to_follower_ids))
+    add("keys_not_in_user_set", (u for _, adjacency in adjacency_of for u in adjacency if u not in net.user_set))
+
+    # Edges
+    friends = AdjacencyArray(to_int_adjacency(net.user_id_to_friend_ids))
+    followers = AdjacencyArray(to_int_adjacency(net.user_id_to_follower_ids))
+
+    def to_edges(adjacency_array: AdjacencyArray, other_adjacency_array: AdjacencyArray):
+        keys = np.fromiter((int(k) for k in adjacency_array.keys), dtype=USER_DTYPE, count=len(adjacency_array))
+        owners = np.repeat(keys, np.diff(adjacency_array.offsets))
+        other_keys = np.fromiter((int(k) for k in other_adjacency_array.keys), dtype=USER_DTYPE,
+                                 count=len(other_adjacency_array))
+        other_keys_with_list = to_user_array(other_keys[~other_adjacency_array.is_none])
+        is_checkable = is_in_user_array(adjacency_array.values, other_keys_with_list)
+        return owners, adjacency_array.values, is_checkable
+
+    friend_owners, friend_members, friend_checkable = to_edges(friends, followers)
+    follower_owners, follower_members, follower_checkable = to_edges(followers, friends)
+
+    num_processes = max(1, num_processes or 1)
+    friend_partition = hash_user_ids(friend_owners) % np.uint64(num_processes)
+    follower_partition = hash_user_ids(follower_members) % np.uint64(num_processes)
+    partitions = []
+    for p in range(num_processes):
+        fr, fo = friend_partition == p, follower_partition == p
+        partitions.append(((friend_owners[fr], friend_members[fr], friend_checkable[fr]),
+                           (follower_members[fo], follower_owners[fo], follower_checkable[fo]),
+                           num_samples))
+    if num_processes > 1:
+        with Pool(processes=num_processes) as pool:
+            partition_reports = pool.map(_verify_edge_partition, partitions)
+    else:
+        partition_reports = [_verify_edge_partition(partitions[0])]
+
+    for violation in partition_reports[0]:
+        report[violation] = (sum(r[violation][0] for r in partition_reports),
+                             [s for r in partition_reports for s in r[violation][1]][:num_samples])
+    return report
+
+
+def print_verification(report: Dict[str, tuple]) -> bool:
+    """
+    :return: True if there is no violation
+    """
+    for violation, (count, samples) in report.items():
+        if count == 0:
+            cprint("{}: 0".format(violation), "green")
         else:
-            co_net.user_id_to_follower_ids[user_with_follower] += net.user_id_to_follower_ids[user_with_follower]
-        if user_with_follower not in co_net.user_id_to_friend_ids:
-            co_net.user_id_to_friend_ids[user_with_follower] = []
-
-        for f in followers:
-            # f is a follower of user == user is a friend of f
-            if f not in co_net.user_id_to_friend_ids:
-                co_net.user_id_to_friend_ids[f] = [user_with_follower]
-            else:
-                co_net.user_id_to_friend_ids[f].append(user_with_follower)
-            if f not in co_net.user_id_to_follower_ids:
-                co_net.user_id_to_follower_ids[f] = []
-
-    for user_with_friend, friends in tqdm(net.user_id_to_friend_ids.items(),
-                                          total=len(net.user_id_to_friend_ids)):
-        co_net.user_id_to_friend_ids[user_with_friend] = \
-            list(set(co_net.user_id_to_friend_ids[user_with_friend]))
-    for user_with_follower, followers in tqdm(net.user_id_to_follower_ids.items(),
-                                              total=len(net.user_id_to_follower_ids)):
-        co_net.user_id_to_follower_ids[user_with_follower] = \
-            list(set(co_net.user_id_to_follower_ids[user_with_follower]))
+            cprint("{}: {}, e.g., {}".format(violation, count, samples), "red")
+    return all(count == 0 for count, _ in report.values())
+
+
+def coalesce_not_propagated_users(net: UserNetwork):
+    """
+    :return: UserNetwork where every user in net (keys and neighbors) has both friend and follower lists,
+        completed symmetrically (u is a friend of v == v is a follower of u), deduplicated and sorted.
+        - net is not modified.
+    """
+    friends = AdjacencyArray(net.user_id_to_friend_ids)
+    followers = AdjacencyArray(net.user_id_to_follower_ids)
+    if friends.is_none.any() or followers.is_none.any():
+        raise ValueError("Network has error users (None), check_correctness first")
+
+    users, friend_lists, follower_lists = symmetric_completion(friends, followers)
+    del friends, followers
+
+    co_net = UserNetwork()
+    co_net.user_id_to_friend_ids = dict(zip(users, friend_lists))
+    co_net.user_id_to_follower_ids = dict(zip(users, follower_lists))
 
     print("User set: {}, {} (should same)".format(len(co_net.user_id_to_friend_ids),
                                                   len(co_net.user_id_to_follower_ids)))
@@ -490,6 +885,8 @@ if __name__ == '__main__':
     with_aux = False
     aux_postfix = "with" if with_aux else "without"
     user_pruning_ratio = 0.997
+    user_pruning_ratio_list = [0.995, 0.997, 0.998, 0.999, 1.0]
+    check_pruned = False  # Compare PRUNE_NETWORK_FILES with prune_networks
 
     if what_to_crawl_in_main == "friend":
         main_file_name = "UserNetwork_friends.pkl"
@@ -552,7 +949,7 @@ if __name__ == '__main__':
 
     elif MODE == "PRUNE_NETWORKS":  # Remove users who do not participate in the propagation.
 
-        print("PRUNE_NETWORKS: pruning ratio of {}".format(user_pruning_ratio))
+        print("PRUNE_NETWORKS: pruning ratios of {}".format(user_pruning_ratio_list))
 
         network_files = [
             None,  # SlicedUserNetworks for followers
@@ -573,13 +970,37 @@ if __name__ == '__main__':
             user_network.load(file_name=net_file_name)
             user_network_instances.append(user_network)
 
-        pruned_network = prune_networks(user_network_instances, pruning_ratio=user_pruning_ratio)
-        pruned_network.dump("PrunedUserNetwork_{}_aux_pruning_{}.pkl".format(
-            aux_postfix, user_pruning_ratio,
-        ))
-        print('Total {0} crawled users.'.format(pruned_network.get_num_of_crawled_users()))
-        print('Total {0} users in network'.format(len(pruned_network.user_set)))
-        print('Total {0} error users.'.format(len(pruned_network.error_user_set)))
+        def dump_pruned_network(pruning_ratio, pruned_network):
+            pruned_network.dump("PrunedUserNetwork_{}_aux_pruning_{}.pkl".format(
+                aux_postfix, pruning_ratio,
+            ))
+            print('Total {0} crawled users.'.format(pruned_network.get_num_of_crawled_users()))
+            print('Total {0} users in network'.format(len(pruned_network.user_set)))
+            print('Total {0} error users.'.format(len(pruned_network.error_user_set)))
+
+        prune_networks(user_network_instances, pruning_ratio=user_pruning_ratio_list, on_pruned=dump_pruned_network)
+
+    elif MODE == "PRUNE_NETWORK_FILES":  # PRUNE_NETWORKS streaming slices, without loading all networks.
+
+        print("PRUNE_NETWORK_FILES: pruning ratios of {}".format(user_pruning_ratio_list))
+
+        network_files = [
+            None,  # SlicedUserNetworks for followers
+            "UserNetwork_friends.pkl",
+            "UserNetwork_friends_leaves.pkl",
+            "UserNetwork_followers_leaves_0.pkl",
+            "UserNetwork_followers_leaves_1.pkl",
+        ]
+        if with_aux:
+            network_files += ["UserNetwork_follower_aux_{}.pkl".format(i) for i in range(6)] + \
+                             ["UserNetwork_friend_aux_{}.pkl".format(i) for i in range(3)]
+
+        prune_network_files(network_files, "PrunedUserNetwork_{}_aux_pruning_{{}}.pkl".format(aux_postfix),
+                            pruning_ratio=user_pruning_ratio_list)
+        if check_pruned:  # Loads all networks, as PRUNE_NETWORKS.
+            check_pruned_network_files(network_files,
+                                       "PrunedUserNetwork_{}_aux_pruning_{{}}.pkl".format(aux_postfix),
+                                       pruning_ratio=user_pruning_ratio_list)
 
     elif MODE == "FILL_ADJ_FROM_EVENTS":  # Add following/follower in the propagation.
         print("FILL_ADJ_FROM_EVENTS: pruning_ratio of {}".format(user_pruning_ratio))
@@ -621,6 +1042,17 @@ if __name__ == '__main__':
         print("Total {} nodes".format(user_networkx.number_of_nodes()))
         print("Total {} edges".format(user_networkx.number_of_edges()))
 
+    elif MODE == "VERIFY":  # Integrity of the network, e.g., reciprocity of friends and followers.
+        user_network = UserNetwork()
+        user_network.load(file_name=main_file_name)
+        print_verification(verify_network(user_network, num_processes=os.cpu_count()))
+
+    elif MODE == "INDEX_STATS":  # Stats from the index sidecar, without loading the network.
+        user_network_index = UserNetworkIndex.load(main_file_name)
+        user_network_index.print_stats("follower")
+        user_network_index.print_stats("friend")
+        print("Top 10 followed users: {}".format(user_network_index.top_k(10, "follower")))
+
     else:
         user_network = UserNetwork()
         user_network.load(file_name=main_file_name)
@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+from copy import deepcopy
+from typing import Callable, Dict, List
+
+import networkx as nx
+from termcolor import cprint
+
+from format_event import EVENT_PATH
+from network import UserNetwork, NETWORK_PATH, get_network_file_list
+from network_util import prune_networks, fill_adjacency_from_events, coalesce_not_propagated_users, \
+    check_correctness
+from serialization import atomic_open, dump_pickle, load_pickle, wait_for_pending_dumps
+from story_feature import STORY_PATH
+from to_data import to_events_numpy, to_stories_numpy, indexify_propagation
+
+PIPELINE_CACHE_PATH = os.path.join(NETWORK_PATH, "pipeline_cache")
+_FILE_HASH_CHUNK_SIZE = 1 << 24
+
+
+class Stage:
+
+    def __init__(self, name: str, func: Callable, inputs: List[str] = None, params: dict = None,
+                 files: List[str] = None, outputs: List[str] = None, version: str = "1"):
+        """
+        :param name: unique name of the stage in Pipeline
+        :param func: function (*artifacts of inputs, **params) -> artifact (None if the stage only writes outputs)
+        :param inputs: names of stages whose artifacts are given to func, in order
+        :param params: keyword arguments of func (JSON-serializable)
+        :param files: paths of files that func reads, hashed by content
+        :param outputs: paths of files that func writes, the stage reruns if any of them is missing.
+        :param version: change it when func changes, to invalidate the cache
+        """
+        self.name = name
+        self.func = func
+        self.inputs = inputs or []
+        self.params = params or dict()
+        self.files = files or []
+        self.outputs = outputs or []
+        self.version = version
+
+    def __repr__(self):
+        return "Stage({}, inputs={}, params={})".format(self.name, self.inputs, self.params)
+
+
+class Pipeline:
+
+    def __init__(self, stages: List[Stage], cache_path: str = None):
+        """
+        Stage graph whose results are cached by a Merkle key: hash of the stage (name, version, params),
+        the content of its files, and the keys of its inputs. So a stage reruns only if itself or
+        anything upstream changed, and artifacts of a run are passed in memory to the following stages.
+        """
+        self.stages: Dict[str, Stage] = {stage.name: stage for stage in stages}
+        self.cache_path = cache_path or PIPELINE_CACHE_PATH
+        os.makedirs(self.cache_path, exist_ok=True)
+        self._file_hash_path = os.path.join(self.cache_path, "file_hashes.json")
+        self._file_hashes = self._load_file_hashes()
+
+    def _load_file_hashes(self) -> dict:
+        try:
+            with open(self._file_hash_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return dict()
+
+    def _hash_file(self, file_path: str) -> str:
+        # Content hashes are memoized by (size, mtime), so unchanged files are not read again.
+        stat = os.stat(file_path)
+        signature = "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+        memoized = self._file_hashes.get(os.path.abspath(file_path))
+        if memoized and memoized[0] == signature:
+            return memoized[1]
+
+        sha = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(_FILE_HASH_CHUNK_SIZE), b""):
+                sha.update(chunk)
+        self._file_hashes[os.path.abspath(file_path)] = [signature, sha.hexdigest()]
+        with atomic_open(self._file_hash_path, "w") as f:
+            json.dump(self._file_hashes, f)
+        return sha.hexdigest()
+
+    def _get_order(self, targets: List[str]) -> List[str]:
+        order, visiting = [], set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError("Cycle in stages: {}".format(name))
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(input_name)
+            visiting.remove(name)
+            order.append(name)
+
+        for target in targets:
+            visit(target)
+        return order
+
+    def get_keys(self, targets: List[str] = None) -> Dict[str, str]:
+        keys = dict()
+        for name in self._get_order(targets or list(self.stages)):
+            stage = self.stages[name]
+            description = {
+                "name": stage.name,
+                "version": stage.version,
+                "params": stage.params,
+                "files": [[f, self._hash_file(f)] for f in stage.files],
+                "inputs": [keys[input_name] for input_name in stage.inputs],
+            }
+            keys[name] = hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        return keys
+
+    def _get_cache_file(self, name: str, key: str) -> str:
+        return os.path.join(self.cache_path, "{}-{}.pkl".format(name, key))
+
+    def _is_fresh(self, name: str, key: str) -> bool:
+        return os.path.exists(self._get_cache_file(name, key)) and \
+            all(os.path.exists(output) for output in self.stages[name].outputs)
+
+    def run(self, targets: List[str] = None, force: List[str] = None) -> dict:
+        """
+        :param targets: names of stages to run with their upstream stages (default: all stages)
+        :param force: names of stages to rerun even if they are cached
+        :return: dict, name -> artifact of the given targets (empty if targets is None)
+        """
+        targets_to_return = targets or []
+        targets = targets or list(self.stages)
+        force = set(force or [])
+        order = self._get_order(targets)
+        keys = self.get_keys(targets)
+
+        # A stage is stale if it is not cached, or any of its inputs is stale.
+        stale = set()
+        for name in order:
+            if name in force or not self._is_fresh(name, keys[name]) or \
+                    any(input_name in stale for input_name in self.stages[name].inputs):
+                stale.add(name)
+
+        # Artifacts are kept in memory until their last consumer in this run.
+        last_consumer = dict()
+        for name in order:
+            for input_name in self.stages[name].inputs:
+                last_consumer[input_name] = name
+
+        artifacts = dict()
+
+        def get_artifact(name):
+            if name not in artifacts:
+                artifacts[name] = load_pickle(self._get_cache_file(name, keys[name]))
+                cprint("Pipeline | Loaded: {} ({})".format(name, keys[name]), "green")
+            return artifacts[name]
+
+        for name in order:
+            stage = self.stages[name]
+            if name not in stale:
+                cprint("Pipeline | Fresh: {} ({})".format(name, keys[name]), "green")
+                continue
+
+            cprint("Pipeline | Running: {} ({})".format(name, keys[name]), "yellow")
+            input_artifacts = [get_artifact(input_name) for input_name in stage.inputs]
+            artifact = stage.func(*input_artifacts, **stage.params)
+            artifacts[name] = artifact
+
+            # The artifact is pickled before returning, so the next stage can use it while it is written.
+            dump_pickle(artifact, self._get_cache_file(name, keys[name]), background=True)
+            cprint("Pipeline | Finished: {} ({})".format(name, keys[name]), "blue")
+
+            for input_name in stage.inputs:
+                if last_consumer.get(input_name) == name and input_name not in targets_to_return:
+                    artifacts.pop(input_name, None)
+
+        wait_for_pending_dumps()
+        return {name: get_artifact(name) for name in targets_to_return}
+
+
+def _load_networks(network_files: List[str]) -> List[UserNetwork]:
+    user_network_instances = []
+    for net_file_name in network_files:
+        user_network = UserNetwork()
+        user_network.load(file_name=net_file_name)
+        user_network_instances.append(user_network)
+    return user_network_instances
+
+
+def _prune_stage(network_files, pruning_ratio):
+    return prune_networks(_load_networks(network_files), pruning_ratio=pruning_ratio)
+
+
+def _fill_stage(pruned_network: UserNetwork, event_file_name):
+    # Input artifacts are not modified, since they may be passed to other stages.
+    result_network = fill_adjacency_from_events(deepcopy(pruned_network), event_file_name=event_file_name)
+    if not check_correctness(result_network):
+        raise Exception("Correctness fail")
+    return result_network
+
+
+def _coalesce_stage(filled_network: UserNetwork):
+    coalesce_network = coalesce_not_propagated_users(filled_network)
+    if not check_correctness(coalesce_network):
+        raise Exception("Correctness fail")
+    return coalesce_network
+
+
+def _dump_network_stage(coalesced_network: UserNetwork, networkx_path):
+    g = coalesced_network.to_networkx()
+    nx.write_gpickle(g, networkx_path)
+    cprint("Dumped: {} with {} nodes and {} edges".format(
+        networkx_path, g.number_of_nodes(), g.number_of_edges(),
+    ), "blue")
+
+
+def _dump_others_stage(data_path):
+    e, esl = to_events_numpy(os.path.join(data_path, "propagation.pkl"))
+    s, ssl = to_stories_numpy(os.path.join(data_path, "story.pkl"))
+    for item in zip(ssl, esl):
+        assert item[0] == item[1], "Error: {}".format(item)
+
+
+def _indexify_stage(_network, _others, nx_file, out_file_postfix, data_path):
+    indexify_propagation(nx_file=nx_file, out_file_postfix=out_file_postfix, path=data_path)
+
+
+def get_dataset_pipeline(pruning_ratio: float, with_aux: bool = False, data_path: str = "./data",
+                         event_file_name: str = "FormattedEvent_with_leaves.pkl",
+                         cache_path: str = None) -> Pipeline:
+    """
+    Stages of PRUNE_NETWORKS, FILL_ADJ_FROM_EVENTS, COALESCE_NOT_PROPAGATED_USERS (network_util),
+    and DUMP_NETWORK, DUMP_OTHERS, INDEXIFY (to_data).
+    """
+    network_files = [
+        None,  # SlicedUserNetworks for followers
+        "UserNetwork_friends.pkl",
+        "UserNetwork_friends_leaves.pkl",
+        "UserNetwork_followers_leaves_0.pkl",
+        "UserNetwork_followers_leaves_1.pkl",
+    ]
+    if with_aux:
+        network_files += ["UserNetwork_follower_aux_{}.pkl".format(i) for i in range(6)] + \
+                         ["UserNetwork_friend_aux_{}.pkl".format(i) for i in range(3)]
+    network_file_paths = [os.path.join(NETWORK_PATH, f)
+                          for network_file in network_files for f in get_network_file_list(network_file)]
+
+    postfix = "{}".format(round(1 - pruning_ratio, 5))
+    networkx_file = "network_{}.gpickle".format(postfix)
+    event_file_path = os.path.join(EVENT_PATH, event_file_name)
+    story_feature_path = os.path.join(STORY_PATH, "StoryFeature.pkl")
+
+    return Pipeline([
+        Stage("prune", _prune_stage,
+              params=dict(network_files=network_files, pruning_ratio=pruning_ratio),
+              files=network_file_paths),
+        Stage("fill", _fill_stage, inputs=["prune"],
+              params=dict(event_file_name=event_file_name),
+              files=[event_file_path]),
+        Stage("coalesce", _coalesce_stage, inputs=["fill"]),
+        Stage("dump_network", _dump_network_stage, inputs=["coalesce"],
+              params=dict(networkx_path=os.path.join(data_path, networkx_file)),
+              outputs=[os.path.join(data_path, networkx_file)]),
+        Stage("dump_others", _dump_others_stage,
+              params=dict(data_path=data_path),
+              files=[event_file_path, story_feature_path],
+              outputs=[os.path.join(data_path, "propagation.pkl"), os.path.join(data_path, "story.pkl")]),
+        Stage("indexify", _indexify_stage, inputs=["dump_network", "dump_others"],
+              params=dict(nx_file=networkx_file, out_file_postfix=postfix, data_path=data_path),
+              outputs=[os.path.join(data_path, "idx_propagation_{}.pkl".format(postfix)),
+                       os.path.join(data_path, "idx_network_{}.gpickle".format(postfix))]),
+    ], cache_path=cache_path)
+
+
+if __name__ == '__main__':
+
+    MODE = "RUN"  # RUN, KEYS
+
+    pipeline = get_dataset_pipeline(pruning_ratio=0.999, with_aux=False)
+
+    if MODE == "RUN":
+        pipeline.run()
+
+    elif MODE == "KEYS":
+        for stage_name, stage_key in pipeline.get_keys().items():
+            print(stage_name, stage_key)
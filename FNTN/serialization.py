@@ -0,0 +1,158 @@
+import json
+import os
+import pickle
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from termcolor import cprint
+
+PICKLE_PROTOCOL = min(5, pickle.HIGHEST_PROTOCOL)
+CONTAINER_MAGIC = b"FNTNPKL\x05"
+CHUNK_SIZE = 1 << 24  # 16MB per compressed chunk
+
+_pending_dumps = []
+_pending_dumps_lock = threading.Lock()
+
+
+@contextmanager
+def atomic_open(file_path: str, mode: str = "wb"):
+    """
+    Write to a hidden temporary file in the same directory and rename it over file_path on success,
+    so that a crash never leaves a truncated file behind.
+    """
+    dir_path, base_name = os.path.split(os.path.abspath(file_path))
+    tmp_path = os.path.join(dir_path, ".{}.tmp-{}-{}".format(base_name, os.getpid(), threading.get_ident()))
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _to_frames(obj, copy_buffers=False) -> list:
+    """
+    :param copy_buffers: copy out-of-band buffers instead of referencing the memory of obj.
+    :return: list of bytes-like, [main pickle, *out-of-band buffers (e.g., numpy arrays)]
+    """
+    buffers = []
+    if PICKLE_PROTOCOL >= 5:
+        main = pickle.dumps(obj, protocol=PICKLE_PROTOCOL, buffer_callback=buffers.append)
+    else:
+        main = pickle.dumps(obj, protocol=PICKLE_PROTOCOL)
+    return [main] + [bytes(b.raw()) if copy_buffers else b.raw() for b in buffers]
+
+
+def _compress_chunk(args):
+    chunk, compress_level = args
+    return zlib.compress(chunk, compress_level)
+
+
+def _write_frames(frames: list, file_path: str, compress_level: int, num_threads: int):
+
+    # Plain pickle: readable by pickle.load without this module.
+    if len(frames) == 1 and compress_level == 0:
+        with atomic_open(file_path) as f:
+            f.write(frames[0])
+        return
+
+    chunks = [(memoryview(frame)[base:base + CHUNK_SIZE], compress_level)
+              for frame in frames for base in range(0, len(frame), CHUNK_SIZE)]
+    if compress_level > 0 and num_threads > 1 and len(chunks) > 1:
+        # zlib releases the GIL, so threads compress chunks in parallel.
+        with ThreadPool(processes=num_threads) as pool:
+            compressed = pool.map(_compress_chunk, chunks)
+    elif compress_level > 0:
+        compressed = [_compress_chunk(c) for c in chunks]
+    else:
+        compressed = [c for c, _ in chunks]
+
+    header = {
+        "compress_level": compress_level,
+        "frame_lengths": [len(frame) for frame in frames],
+        "chunk_lengths": [len(c) for c in compressed],
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+
+    with atomic_open(file_path) as f:
+        f.write(CONTAINER_MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for c in compressed:
+            f.write(c)
+
+
+def dump_pickle(obj, file_path: str, compress_level: int = 0, num_threads: int = None, background: bool = False):
+    """
+    :param obj: object to dump
+    :param file_path: path of the file to write (atomically replaced)
+    :param compress_level: zlib level (0: no compression)
+    :param num_threads: threads for compression (default: os.cpu_count())
+    :param background: if True, compression and writing run in a thread after obj is pickled.
+        - obj is pickled before returning, so it is safe to keep modifying obj.
+    :return: threading.Thread if background else None
+    """
+    num_threads = num_threads or os.cpu_count() or 1
+    frames = _to_frames(obj, copy_buffers=background)
+
+    if not background:
+        _write_frames(frames, file_path, compress_level, num_threads)
+        return None
+
+    thread = threading.Thread(target=_write_frames, args=(frames, file_path, compress_level, num_threads))
+    with _pending_dumps_lock:
+        _pending_dumps.append(thread)
+    thread.start()
+    return thread
+
+
+def wait_for_pending_dumps():
+    with _pending_dumps_lock:
+        threads = list(_pending_dumps)
+        _pending_dumps.clear()
+    for thread in threads:
+        thread.join()
+    if threads:
+        cprint("Finished {} background dumps".format(len(threads)), "blue")
+
+
+def load_pickle(file_path: str, num_threads: int = None):
+    """
+    :param file_path: a file written by dump_pickle or a plain pickle file
+    :param num_threads: threads for decompression (default: os.cpu_count())
+    """
+    num_threads = num_threads or os.cpu_count() or 1
+    with open(file_path, "rb") as f:
+        if f.read(len(CONTAINER_MAGIC)) != CONTAINER_MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+
+        header_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"))
+        compressed = [f.read(chunk_len) for chunk_len in header["chunk_lengths"]]
+
+    if header["compress_level"] > 0 and num_threads > 1 and len(compressed) > 1:
+        with ThreadPool(processes=num_threads) as pool:
+            chunks = pool.map(zlib.decompress, compressed)
+    elif header["compress_level"] > 0:
+        chunks = [zlib.decompress(c) for c in compressed]
+    else:
+        chunks = compressed
+
+    frames, chunk_iter = [], iter(chunks)
+    for frame_len in header["frame_lengths"]:
+        frame = bytearray()
+        while len(frame) < frame_len:
+            frame += next(chunk_iter)
+        frames.append(frame)
+
+    if PICKLE_PROTOCOL >= 5:
+        return pickle.loads(frames[0], buffers=frames[1:])
+    return pickle.loads(frames[0])
@@ -1,15 +1,16 @@
 from nltk import PorterStemmer
 import pandas as pd
 import re
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 import os
 import pprint
-import pickle
 from copy import deepcopy
 import random
 from pprint import pprint
 
 from story_feature import get_story_files
+from serialization import dump_pickle, load_pickle
+from text_matcher import StopSentenceRemover
 
 from ordered_set import OrderedSet
 
@@ -31,6 +32,61 @@ def get_stops():
     return stop_words, stop_sentences
 
 
+class StemCache:
+
+    def __init__(self, stemmer, max_size: int = 1000000, cache_file: str = None):
+        """
+        Bounded LRU dict of word -> stem in front of stemmer.stem, so stemming scales with the vocabulary.
+
+        :param max_size: number of words to keep
+        :param cache_file: path to load the cache from (if it exists) and dump it to, to persist between runs
+        """
+        self.stemmer = stemmer
+        self.max_size = max_size
+        self.cache_file = cache_file
+        self.word_to_stem = OrderedDict()
+        self.hits, self.misses = 0, 0
+        if cache_file and os.path.exists(cache_file):
+            self.word_to_stem.update(load_pickle(cache_file))
+            print('Loaded: {0} of {1} words'.format(cache_file, len(self.word_to_stem)))
+
+    def __len__(self):
+        return len(self.word_to_stem)
+
+    def stem(self, word: str) -> str:
+        try:
+            stemmed = self.word_to_stem[word]
+            self.word_to_stem.move_to_end(word)
+            self.hits += 1
+            return stemmed
+        except KeyError:
+            self.misses += 1
+        stemmed = self.stemmer.stem(word)
+        self.word_to_stem[word] = stemmed
+        if len(self.word_to_stem) > self.max_size:
+            self.word_to_stem.popitem(last=False)
+        return stemmed
+
+    def get_hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.
+
+    def print_stats(self):
+        print('StemCache: {0} words, hit rate {1:.4f} ({2} hits, {3} misses)'.format(
+            len(self), self.get_hit_rate(), self.hits, self.misses))
+
+    def dump(self):
+        if self.cache_file:
+            dump_pickle(dict(self.word_to_stem), self.cache_file)
+            print('Dumped: {0} of {1} words'.format(self.cache_file, len(self.word_to_stem)))
+
+    def __getstate__(self):
+        # Words are not pickled with the owner (e.g., BOWStory.dump), but by dump to cache_file.
+        state = self.__dict__.copy()
+        state["word_to_stem"] = OrderedDict()
+        state["hits"], state["misses"] = 0, 0
+        return state
+
+
 class BOWStoryElement:
 
     def __init__(self, story_label: str, word_ids_with_duplicates: list):
@@ -49,8 +105,11 @@ class BOWStoryElement:
 class BOWStory:
 
     def __init__(self, story_path_list, stemmer=PorterStemmer, delimiter='\s', len_criteria=None, wf_criteria=None,
-                 story_order='original', force_save=False):
+                 story_order='original', force_save=False, stem_cache_size=1000000, stem_cache_file=None):
         """
+        :param stem_cache_size: max number of words in StemCache
+        :param stem_cache_file: path to persist StemCache between runs (default: not persisted)
+
         Attributes
         ----------
 
@@ -67,10 +126,12 @@ class BOWStory:
         """
         self.story_path_list = story_path_list
         self.stemmer = stemmer()
+        self.stem_cache = StemCache(self.stemmer, max_size=stem_cache_size, cache_file=stem_cache_file)
         self.delimiter = delimiter
         self.len_criteria = len_criteria if len_criteria else lambda l: l > 1
         self.wf_criteria = wf_criteria if wf_criteria else lambda wf: 2 < wf < 500
         self.stop_words, self.stop_sentences = get_stops()
+        self.stop_sentence_remover = StopSentenceRemover(self.stop_sentences)
         self.force_save = force_save
 
         # Attributes that should be loaded
@@ -93,34 +154,29 @@ class BOWStory:
         return tmp
 
     def remove_stop_sentences(self, content: str):
-        for ss in self.stop_sentences:
-            if ss in content:
-                content = content.replace(ss, '')
-        return content
+        return self.stop_sentence_remover.remove(content)
 
     def clear_lambda(self):
         self.len_criteria = None
         self.wf_criteria = None
 
-    def dump(self, story_path=None):
+    def dump(self, story_path=None, compress_level=0, background=False):
         file_name = 'FormattedStory_{}.pkl'.format(self.get_twitter_year())
         story_path = story_path or STORY_PATH
-        with open(os.path.join(story_path, file_name), 'wb') as f:
-            self.clear_lambda()
-            pickle.dump(self, f)
+        self.clear_lambda()
+        dump_pickle(self, os.path.join(story_path, file_name), compress_level=compress_level, background=background)
         print('Dumped: {0}'.format(file_name))
 
     def load(self, story_path=None):
         file_name = 'FormattedStory_{}.pkl'.format(self.get_twitter_year())
         try:
             story_path = story_path or STORY_PATH
-            with open(os.path.join(story_path, file_name), 'rb') as f:
-                loaded = pickle.load(f)
-                self.FormattedStoryElement_list = loaded.FormattedStoryElement_list
-                self.word_to_id = loaded.word_to_id
-                self.id_to_word = loaded.id_to_word
-                self.tweet_id_to_story_id = loaded.tweet_id_to_story_id
-                self.story_order = loaded.story_order
+            loaded = load_pickle(os.path.join(story_path, file_name))
+            self.FormattedStoryElement_list = loaded.FormattedStoryElement_list
+            self.word_to_id = loaded.word_to_id
+            self.id_to_word = loaded.id_to_word
+            self.tweet_id_to_story_id = loaded.tweet_id_to_story_id
+            self.story_order = loaded.story_order
             print('Loaded: {0}'.format(file_name))
             return True
         except Exception as e:
@@ -145,28 +201,37 @@ class BOWStory:
         # key: str, value: int
         word_frequency = Counter()
 
-        for i, story in stories.iterrows():
-            content = story['title'] + '\n' + story['content']
+        stop_words = set(self.stop_words)
+        delimiter, non_word = re.compile(self.delimiter), re.compile('[\W_]+')
+        stem = self.stem_cache.stem
+
+        # Columns are iterated as lists, and word_frequency is updated in place, so it is linear in the corpus.
+        columns = zip(stories['tweet_id'].tolist(), stories['title'].tolist(),
+                      stories['content'].tolist(), stories['label'].tolist())
+        for i, (tweet_id, title, content, label) in enumerate(columns):
+            content = title + '\n' + content
             content = content.lower()
             content = self.remove_stop_sentences(content)
 
-            words = re.split(self.delimiter, content)
-            words = [self.stemmer.stem(v) for v in words]
-            words = [v for v in words if v not in self.stop_words]
-            words = [re.sub('[\W_]+', '', v) for v in words]
+            words = delimiter.split(content)
+            words = [stem(v) for v in words]
+            words = [non_word.sub('', v) for v in words if v not in stop_words]
             words = [v for v in words if self.len_criteria(len(v))]
 
-            word_frequency = sum((word_frequency, Counter(words)), Counter())
+            word_frequency.update(words)
 
-            tweet_id = str(story['tweet_id'])
+            tweet_id = str(tweet_id)
             tweet_id_to_contents[tweet_id] = words
 
-            label = str(story['label'])
+            label = str(label)
             tweet_id_to_label[tweet_id] = label
 
             if i % 100 == 0 and __name__ == '__main__':
                 print('stories.iterrows: {0}'.format(i))
 
+        self.stem_cache.print_stats()
+        self.stem_cache.dump()
+
         tweet_id_list = list(OrderedSet(tweet_id_to_contents.keys()))
         if self.story_order == 'shuffle':
             random.shuffle(tweet_id_list)
@@ -192,7 +257,7 @@ class BOWStory:
         # Construct a set of words
         vocab = set()
         for words in story_id_to_contents.values():
-            vocab = vocab | set(words)
+            vocab.update(words)
 
         word_to_id = {word: idx for idx, word in enumerate(sorted(vocab))}
         id_to_word = {idx: word for word, idx in word_to_id.items()}
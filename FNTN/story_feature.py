@@ -1,5 +1,4 @@
 import os
-import pickle
 import re
 from collections import defaultdict
 from typing import List, Dict, Any
@@ -10,6 +9,8 @@ from termcolor import cprint
 from sklearn.decomposition import LatentDirichletAllocation
 from sklearn.feature_extraction.text import TfidfVectorizer
 
+from serialization import dump_pickle, load_pickle
+
 
 DATA_PATH = os.path.dirname(os.path.abspath(__file__))
 STORY_PATH = os.path.join(DATA_PATH, 'data_story')
@@ -112,18 +113,16 @@ class StoryFeature:
             n_components, int(lda.perplexity(text_tf_vectors))
         ))
 
-    def dump(self, file_name, path=None):
+    def dump(self, file_name, path=None, compress_level=0, background=False):
         path = path or STORY_PATH
-        with open(os.path.join(path, file_name), 'wb') as f:
-            pickle.dump(self, f)
+        dump_pickle(self, os.path.join(path, file_name), compress_level=compress_level, background=background)
         cprint("Dumped: {}".format(file_name), "blue")
 
     def load(self, file_name, path=None) -> bool:
         try:
             path = path or STORY_PATH
-            with open(os.path.join(path, file_name), 'rb') as f:
-                loaded: StoryFeature = pickle.load(f)
-                self.story_to_attr = loaded.story_to_attr
+            loaded: StoryFeature = load_pickle(os.path.join(path, file_name))
+            self.story_to_attr = loaded.story_to_attr
             cprint("Loaded: {}".format(file_name), "green")
             return True
         except Exception as e:
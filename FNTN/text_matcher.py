@@ -0,0 +1,29 @@
+import re
+from typing import List
+
+
+class StopSentenceRemover:
+
+    def __init__(self, stop_sentences: List[str]):
+        """
+        Remove stop sentences from texts, shared by text stages (e.g., BOWStory).
+
+        :param stop_sentences: list of str. Empty ones are skipped.
+        """
+        # Longer first, so that a stop sentence is removed as a whole rather than a shorter one in it.
+        self.stop_sentences = sorted((ss for ss in stop_sentences if ss), key=len, reverse=True)
+        self.pattern = re.compile('|'.join(re.escape(ss) for ss in self.stop_sentences)) \
+            if self.stop_sentences else None
+
+    def remove(self, content: str) -> str:
+        """
+        Remove every stop sentence in one pass of the alternation, repeated while a removal joins a new one.
+            - Of overlapping stop sentences, the leftmost one is removed (e.g., 'ab' of 'abcd' for 'bcd' and 'ab'),
+              whereas replacing each one in turn removed the longer one.
+        """
+        if self.pattern is None:
+            return content
+        while True:
+            content, num_removed = self.pattern.subn('', content)
+            if num_removed == 0:
+                return content
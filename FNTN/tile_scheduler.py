@@ -0,0 +1,318 @@
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing import Pool
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+from termcolor import cprint
+
+from network_matrix import AdjMatrixAPIWrapper, AdjMatrixFromNetwork
+from tile_store import TileStore, get_block_offsets
+
+LEASE_SECONDS = 60 * 60
+
+
+class TileLeases:
+
+    def __init__(self, lease_path: str, lease_seconds: int = LEASE_SECONDS, worker_id: str = None):
+        """
+        Lease protocol on a directory shared by workers (processes or hosts):
+            - {tile}.lease is created with O_EXCL by the worker building the tile, and renewed by its mtime.
+            - A lease not renewed for lease_seconds is expired, and can be taken over by another worker.
+            - {tile}.done is created when the tile is written into the store.
+        At worst, a tile is built twice (e.g., a worker that outlived its lease), never skipped.
+        """
+        self.lease_path = lease_path
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or "{}-{}".format(socket.gethostname(), os.getpid())
+        os.makedirs(lease_path, exist_ok=True)
+
+    def _get_file(self, tile_name, ext):
+        return os.path.join(self.lease_path, "{}.{}".format(tile_name, ext))
+
+    def _is_expired(self, lease_file) -> bool:
+        try:
+            return time.time() - os.path.getmtime(lease_file) > self.lease_seconds
+        except FileNotFoundError:
+            return True
+
+    def is_done(self, tile_name) -> bool:
+        return os.path.exists(self._get_file(tile_name, "done"))
+
+    def is_leased(self, tile_name) -> bool:
+        return not self._is_expired(self._get_file(tile_name, "lease"))
+
+    def acquire(self, tile_name) -> bool:
+        if self.is_done(tile_name):
+            return False
+        lease_file = self._get_file(tile_name, "lease")
+        try:
+            fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self._is_expired(lease_file):
+                return False
+            # Only one of the workers renaming the expired lease succeeds.
+            expired_file = "{}.{}".format(lease_file, self.worker_id)
+            try:
+                os.rename(lease_file, expired_file)
+            except FileNotFoundError:
+                return False
+            if not self._is_expired(expired_file):  # A fresh lease was renamed, so it is put back.
+                try:
+                    os.link(expired_file, lease_file)
+                except FileExistsError:
+                    pass
+                os.remove(expired_file)
+                return False
+            os.remove(expired_file)
+            cprint("Lease Expired: {}".format(tile_name), "yellow")
+            return self.acquire(tile_name)
+
+        with os.fdopen(fd, "w") as f:
+            f.write(self.worker_id)
+        if self.is_done(tile_name):  # Done by another worker between the check and the lease.
+            self.release(tile_name)
+            return False
+        return True
+
+    def renew(self, tile_name):
+        try:
+            os.utime(self._get_file(tile_name, "lease"))
+        except FileNotFoundError:
+            pass
+
+    def release(self, tile_name):
+        try:
+            os.remove(self._get_file(tile_name, "lease"))
+        except FileNotFoundError:
+            pass
+
+    def mark_done(self, tile_name):
+        with open(self._get_file(tile_name, "done"), "w") as f:
+            f.write(self.worker_id)
+        self.release(tile_name)
+
+    @contextmanager
+    def keep(self, tile_name):
+        """
+        Renew the lease of tile_name in a thread while the block runs (e.g., tiles of API calls for days).
+        """
+        stop = threading.Event()
+
+        def renew_periodically():
+            while not stop.wait(self.lease_seconds / 4):
+                self.renew(tile_name)
+
+        thread = threading.Thread(target=renew_periodically, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+class TileScheduler:
+
+    def __init__(self, store: TileStore, build_tile: Callable, tile_costs: Dict[Tuple[int, int], float],
+                 lease_path: str = None, lease_seconds: int = LEASE_SECONDS, worker_id: str = None):
+        """
+        Build tiles of a TileStore, the most costly tile first, by local processes (run_local)
+        or by workers on hosts sharing the store directory (run_worker). Both take tiles by TileLeases.
+
+        :param build_tile: function (tuple_key, row_vertices, col_vertices) -> dict, (i, j) -> np.ndarray of tile
+            - It can return other tiles as well, e.g., (j, i) of API calls.
+        :param tile_costs: dict, (i, j) -> cost of the tile to schedule
+        :param lease_path: shared directory of leases (default: leases/ in the store)
+        """
+        self.store = store
+        self.build_tile = build_tile
+        self.tile_costs = tile_costs
+        self.leases = TileLeases(lease_path or os.path.join(store._get_dir(), "leases"),
+                                 lease_seconds=lease_seconds, worker_id=worker_id)
+        self._store_of_process, self._pid = None, None
+
+    @staticmethod
+    def get_tile_name(tile) -> str:
+        return "{}_{}".format(*tile)
+
+    def get_pending_tiles(self) -> List[Tuple[int, int]]:
+        """
+        :return: tiles not done, in the decreasing order of costs (LPT scheduling)
+        """
+        tiles = [t for t in self.tile_costs if not self.leases.is_done(self.get_tile_name(t))]
+        return sorted(tiles, key=lambda t: (-self.tile_costs[t], t))
+
+    def _get_store(self) -> TileStore:
+        # Each process opens its own np.memmap of tiles.bin.
+        if self._pid != os.getpid():
+            self._store_of_process = TileStore(self.store.name, self.store.store_path).open()
+            self._pid = os.getpid()
+        return self._store_of_process
+
+    def run_tile(self, tile) -> bool:
+        """
+        :return: True if the tile is built and written by this worker
+        """
+        tile_name = self.get_tile_name(tile)
+        if not self.leases.acquire(tile_name):
+            return False
+
+        try:
+            store = self._get_store()
+            tuple_key = (tile[0], tile[1], max(store.num_row_tiles, store.num_col_tiles))
+            row_vertices, col_vertices = store.get_tile_vertices(*tile)
+            with self.leases.keep(tile_name):
+                tile_arrs = self.build_tile(tuple_key, np.asarray(row_vertices), np.asarray(col_vertices))
+            for (i, j), arr in tile_arrs.items():
+                store.write_tile(i, j, arr)
+            store.flush()
+        except BaseException:
+            self.leases.release(tile_name)
+            raise
+
+        self.leases.mark_done(tile_name)
+        cprint("Tile Done: {} by {}".format(tile_name, self.leases.worker_id), "green")
+        return True
+
+    def run_local(self, num_processes: int = None):
+        """
+        Build pending tiles by a pool of processes, each given this scheduler once by the pool initializer.
+        Under fork (Linux), workers inherit build_tile without pickling; under spawn or forkserver (macOS, Windows),
+        build_tile with its neighbor dicts is pickled once for each worker.
+        For API-derived tiles, run run_worker in a process of each API key pool instead.
+        """
+        tiles = self.get_pending_tiles()
+        num_processes = num_processes or os.cpu_count() or 1
+        cprint("Scheduling {} tiles on {} processes".format(len(tiles), num_processes), "yellow")
+        if num_processes == 1:
+            for tile in tiles:
+                self.run_tile(tile)
+            return
+
+        # imap_unordered of chunksize 1 hands out tiles in the given order, so the largest ones go first.
+        with Pool(processes=num_processes, initializer=_init_scheduler, initargs=(self,)) as pool:
+            for _ in pool.imap_unordered(_run_scheduled_tile, tiles, chunksize=1):
+                pass
+
+    def run_worker(self, poll_seconds: int = 60):
+        """
+        Take pending tiles until every tile is done. Tiles leased by other workers are retried
+        after poll_seconds, so tiles of dead workers are taken over once their leases expire.
+        """
+        while True:
+            tiles = self.get_pending_tiles()
+            if not tiles:
+                cprint("All tiles are done: {}".format(self.store.name), "blue")
+                return
+            if not any([self.run_tile(tile) for tile in tiles]):
+                time.sleep(poll_seconds)
+
+
+_scheduler: TileScheduler = None
+
+
+def _init_scheduler(scheduler: TileScheduler):
+    global _scheduler
+    _scheduler = scheduler
+
+
+def _run_scheduled_tile(tile) -> bool:
+    return _scheduler.run_tile(tile)
+
+
+def _get_or_create_store(store_name, row_vertices, col_vertices, batch_size, dtype, initial_value,
+                         store_path) -> TileStore:
+    # Create the store on one host before starting workers of other hosts, since create truncates tiles.bin.
+    store = TileStore(store_name, store_path)
+    if store.exists():
+        store.open()
+        assert store.shape == (len(row_vertices), len(col_vertices)), "Store {} has another shape".format(store_name)
+        return store
+    return TileStore.create(store_name, row_vertices, col_vertices,
+                            row_offsets=get_block_offsets(len(row_vertices), batch_size),
+                            col_offsets=get_block_offsets(len(col_vertices), batch_size),
+                            dtype=dtype, initial_value=initial_value, store_path=store_path)
+
+
+def _build_network_tile(builder: AdjMatrixFromNetwork, search_to_ids_attr, tuple_key, row_vertices, col_vertices):
+    mat = builder._get_batch_matrix(row_vertices.tolist(), col_vertices.tolist(), tuple_key,
+                                    search_to_ids=getattr(builder, search_to_ids_attr))
+    return {tuple_key[:2]: mat.to_dense().arr if builder.is_sparse else mat.arr}
+
+
+def _build_api_tile(api: AdjMatrixAPIWrapper, tuple_key, row_vertices, col_vertices):
+    i, j = tuple_key[:2]
+    if i == j:
+        return {(i, j): api._get_one_batch_matrix(row_vertices.tolist(), tuple_key).arr}
+    mat, mat_t = api._get_pair_batch_matrix(row_vertices.tolist(), col_vertices.tolist(), tuple_key)
+    return {(i, j): mat.arr, (j, i): mat_t.arr}
+
+
+def get_network_tile_scheduler(builder: AdjMatrixFromNetwork, store_name: str, row_vertices: list = None,
+                               col_vertices: list = None, search_to_ids_attr: str = "user_id_to_friend_ids",
+                               store_path: str = None, **kwargs) -> TileScheduler:
+    """
+    Every (i, j) tile of row_vertices x col_vertices (default: network_vertices x network_vertices).
+    Cost of a tile is its cells plus the neighbors of its row users to look up.
+    """
+    row_vertices = row_vertices or builder.network_vertices
+    col_vertices = col_vertices or builder.network_vertices
+    store = _get_or_create_store(store_name, row_vertices, col_vertices, builder.batch_size,
+                                 builder.dtype, builder.initial_value, store_path)
+
+    search_to_ids = getattr(builder, search_to_ids_attr)
+    tile_costs = dict()
+    for i in range(store.num_row_tiles):
+        rows, _ = store.get_tile_vertices(i, 0)
+        num_neighbors = sum(len(search_to_ids.get(str(u)) or []) for u in rows.tolist())
+        for j in range(store.num_col_tiles):
+            tile_rows, tile_cols = store.get_tile_shape(i, j)
+            tile_costs[(i, j)] = tile_rows * tile_cols + num_neighbors
+
+    return TileScheduler(store, partial(_build_network_tile, builder, search_to_ids_attr), tile_costs, **kwargs)
+
+
+def get_api_tile_scheduler(api: AdjMatrixAPIWrapper, store_name: str, store_path: str = None,
+                           **kwargs) -> TileScheduler:
+    """
+    (i, j) tiles of i <= j over api.vertices, where (j, i) is built with (i, j) from the same calls.
+    Cost of a tile is the number of ShowFriendship calls.
+    """
+    store = _get_or_create_store(store_name, api.vertices, api.vertices, api.batch_size,
+                                 api.dtype, api.initial_value, store_path)
+
+    tile_costs = dict()
+    for i in range(store.num_row_tiles):
+        for j in range(i, store.num_col_tiles):
+            tile_rows, tile_cols = store.get_tile_shape(i, j)
+            tile_costs[(i, j)] = tile_rows * (tile_rows + 1) / 2 if i == j else tile_rows * tile_cols
+
+    return TileScheduler(store, partial(_build_api_tile, api), tile_costs, **kwargs)
+
+
+if __name__ == '__main__':
+
+    from network_matrix import get_adj_matrix_from_user_network
+    from user_set import load_user_set
+
+    MODE = "NETWORK_LOCAL"  # NETWORK_LOCAL, NETWORK_WORKER, API_WORKER
+
+    if MODE.startswith("NETWORK"):
+        adj = get_adj_matrix_from_user_network("UserNetwork_friends.pkl", None, None)
+        scheduler = get_network_tile_scheduler(adj, store_name="network_adj")
+        if MODE == "NETWORK_LOCAL":
+            scheduler.run_local()
+        else:
+            scheduler.run_worker()
+
+    elif MODE == "API_WORKER":
+        # One worker per API key pool, e.g., config files of this host.
+        given_config_file_path_list = [os.path.join('config', f) for f in os.listdir('./config') if '.ini' in f]
+        matrix_api = AdjMatrixAPIWrapper(given_config_file_path_list, batch_size=10000, file_prefix="sample_adj")
+        matrix_api.set_vertices(load_user_set("sampled_not_propagated_user_set_follower_0.npy"), sorting=True)
+        get_api_tile_scheduler(matrix_api, store_name="sample_adj").run_worker()
@@ -0,0 +1,250 @@
+import json
+import os
+from typing import List, Tuple
+
+import numpy as np
+from termcolor import cprint
+
+from network_matrix import AdjMatrix, SparseAdjMatrix, VertexIndex, ADJ_PATH
+from serialization import atomic_open
+
+TILE_STORE_PATH = os.path.join(ADJ_PATH, "tile_store")
+TILE_STORE_VERSION = 1
+
+
+def get_block_offsets(num_vertices: int, batch_size: int) -> List[int]:
+    """
+    :return: offsets of blocks of batch_size vertices, e.g., [0, 10000, 20000, 23456]
+    """
+    return list(range(0, num_vertices, batch_size)) + [num_vertices] if num_vertices > 0 else [0, 0]
+
+
+class TileStore:
+
+    def __init__(self, name: str, store_path: str = None):
+        """
+        Tiled matrix in one directory: manifest.json (header), row_vertices.npy and col_vertices.npy
+        (stored once for all tiles), and tiles.bin of every tile in row-major order at fixed byte offsets.
+        Opening a store reads the manifest only, and tiles are views of one np.memmap of tiles.bin.
+
+        :param name: directory name of the store in store_path
+        """
+        self.name = name
+        self.store_path = store_path or TILE_STORE_PATH
+        self.manifest: dict = None
+        self._row_vertices, self._col_vertices = None, None
+        self._row_index, self._col_index = None, None
+        self._buffer: np.memmap = None
+        self._buffer_mode = None
+
+    def _get_dir(self):
+        return os.path.join(self.store_path, self.name)
+
+    def _get_file(self, file_name):
+        return os.path.join(self._get_dir(), file_name)
+
+    def exists(self) -> bool:
+        return os.path.exists(self._get_file("manifest.json"))
+
+    @classmethod
+    def create(cls, name: str, row_vertices, col_vertices, row_offsets: List[int], col_offsets: List[int],
+               dtype=np.int8, initial_value: int = -42, store_path: str = None) -> "TileStore":
+        """
+        :param row_offsets: tile (i, j) has rows row_offsets[i]:row_offsets[i + 1] (see get_block_offsets)
+        :param col_offsets: tile (i, j) has cols col_offsets[j]:col_offsets[j + 1]
+        """
+        store = cls(name, store_path)
+        os.makedirs(store._get_dir(), exist_ok=True)
+        row_vertices = np.asarray(row_vertices, dtype=np.int64)
+        col_vertices = np.asarray(col_vertices, dtype=np.int64)
+        assert row_offsets[-1] == len(row_vertices) and col_offsets[-1] == len(col_vertices)
+
+        itemsize = np.dtype(dtype).itemsize
+        tile_offsets, total_bytes = [], 0
+        for i in range(len(row_offsets) - 1):
+            tile_offsets.append([])
+            for j in range(len(col_offsets) - 1):
+                tile_offsets[i].append(total_bytes)
+                total_bytes += (row_offsets[i + 1] - row_offsets[i]) * (col_offsets[j + 1] - col_offsets[j]) * itemsize
+
+        for file_name, vertices in (("row_vertices.npy", row_vertices), ("col_vertices.npy", col_vertices)):
+            with atomic_open(store._get_file(file_name)) as f:
+                np.save(f, vertices)
+        with open(store._get_file("tiles.bin"), "wb") as f:
+            f.truncate(total_bytes)
+
+        # The manifest is written last, so a store without it is incomplete.
+        store.manifest = {
+            "version": TILE_STORE_VERSION,
+            "dtype": np.dtype(dtype).name,
+            "initial_value": initial_value,
+            "shape": [len(row_vertices), len(col_vertices)],
+            "row_offsets": [int(o) for o in row_offsets],
+            "col_offsets": [int(o) for o in col_offsets],
+            "tile_offsets": tile_offsets,
+            "total_bytes": total_bytes,
+        }
+        if initial_value != 0:
+            for i, j in store.get_tile_keys():
+                store.get_tile(i, j, writable=True)[:] = initial_value
+            store.flush()
+        with atomic_open(store._get_file("manifest.json"), "w") as f:
+            json.dump(store.manifest, f)
+        cprint("Created: {} of shape {} in {} tiles".format(
+            store._get_dir(), store.shape, len(store.get_tile_keys())), "blue")
+        return store
+
+    def open(self) -> "TileStore":
+        with open(self._get_file("manifest.json"), "r") as f:
+            self.manifest = json.load(f)
+        return self
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return tuple(self.manifest["shape"])
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(self.manifest["dtype"])
+
+    @property
+    def num_row_tiles(self) -> int:
+        return len(self.manifest["row_offsets"]) - 1
+
+    @property
+    def num_col_tiles(self) -> int:
+        return len(self.manifest["col_offsets"]) - 1
+
+    @property
+    def row_vertices(self) -> np.ndarray:
+        if self._row_vertices is None:
+            self._row_vertices = np.load(self._get_file("row_vertices.npy"), mmap_mode="r")
+        return self._row_vertices
+
+    @property
+    def col_vertices(self) -> np.ndarray:
+        if self._col_vertices is None:
+            self._col_vertices = np.load(self._get_file("col_vertices.npy"), mmap_mode="r")
+        return self._col_vertices
+
+    def get_tile_keys(self) -> List[Tuple[int, int]]:
+        return [(i, j) for i in range(self.num_row_tiles) for j in range(self.num_col_tiles)]
+
+    def get_tile_shape(self, i, j) -> Tuple[int, int]:
+        row_offsets, col_offsets = self.manifest["row_offsets"], self.manifest["col_offsets"]
+        return row_offsets[i + 1] - row_offsets[i], col_offsets[j + 1] - col_offsets[j]
+
+    def get_tile_vertices(self, i, j) -> Tuple[np.ndarray, np.ndarray]:
+        row_offsets, col_offsets = self.manifest["row_offsets"], self.manifest["col_offsets"]
+        return (self.row_vertices[row_offsets[i]:row_offsets[i + 1]],
+                self.col_vertices[col_offsets[j]:col_offsets[j + 1]])
+
+    def _get_buffer(self, writable: bool) -> np.memmap:
+        mode = "r+" if writable else "r"
+        if self._buffer is None or (writable and self._buffer_mode != "r+"):
+            self._buffer = np.memmap(self._get_file("tiles.bin"), dtype=np.uint8, mode=mode,
+                                     shape=(self.manifest["total_bytes"],))
+            self._buffer_mode = mode
+        return self._buffer
+
+    def get_tile(self, i, j, writable: bool = False) -> np.ndarray:
+        """
+        :return: np.ndarray view of tile (i, j) on tiles.bin, without copies.
+        """
+        shape = self.get_tile_shape(i, j)
+        if shape[0] * shape[1] == 0:
+            return np.empty(shape, dtype=self.dtype)
+        offset = self.manifest["tile_offsets"][i][j]
+        nbytes = shape[0] * shape[1] * self.dtype.itemsize
+        return self._get_buffer(writable)[offset:offset + nbytes].view(self.dtype).reshape(shape)
+
+    def write_tile(self, i, j, arr: np.ndarray):
+        tile = self.get_tile(i, j, writable=True)
+        assert tile.shape == arr.shape, "Shape mismatch: {} and {}".format(tile.shape, arr.shape)
+        tile[:] = arr
+
+    def flush(self):
+        if self._buffer is not None and self._buffer_mode == "r+":
+            self._buffer.flush()
+
+    def get_adj_matrix(self, i, j) -> AdjMatrix:
+        row_vertices, col_vertices = self.get_tile_vertices(i, j)
+        return AdjMatrix(row_vertices=row_vertices, col_vertices=col_vertices,
+                         tuple_key=(i, j, max(self.num_row_tiles, self.num_col_tiles)), file_prefix=self.name,
+                         initial_value=self.manifest["initial_value"], arr_initializer=self.get_tile(i, j))
+
+    def get_full_matrix(self, out: np.ndarray = None) -> AdjMatrix:
+        """
+        :param out: np.ndarray (or np.memmap) of shape to copy tiles into (default: a new array)
+        """
+        full_mat = out if out is not None else np.empty(self.shape, dtype=self.dtype)
+        row_offsets, col_offsets = self.manifest["row_offsets"], self.manifest["col_offsets"]
+        for i, j in self.get_tile_keys():
+            full_mat[row_offsets[i]:row_offsets[i + 1], col_offsets[j]:col_offsets[j + 1]] = self.get_tile(i, j)
+        return AdjMatrix(row_vertices=self.row_vertices, col_vertices=self.col_vertices, tuple_key=(0, 0, 1),
+                         file_prefix=self.name, initial_value=self.manifest["initial_value"],
+                         arr_initializer=full_mat)
+
+    def get_many(self, us, vs, missing_value: int = None) -> np.ndarray:
+        """
+        :param missing_value: value for pairs not in the matrix (default: initial_value)
+        :return: np.ndarray of values of pairs (u, v), read tile by tile from tiles.bin
+        """
+        if self._row_index is None:
+            self._row_index = VertexIndex(np.asarray(self.row_vertices))
+            self._col_index = VertexIndex(np.asarray(self.col_vertices))
+        u_idx, v_idx = self._row_index.get_indices(us), self._col_index.get_indices(vs)
+        missing_value = self.manifest["initial_value"] if missing_value is None else missing_value
+        values = np.full(len(u_idx), missing_value, dtype=self.dtype)
+
+        row_offsets, col_offsets = np.asarray(self.manifest["row_offsets"]), np.asarray(self.manifest["col_offsets"])
+        found_idx = np.flatnonzero((u_idx != -1) & (v_idx != -1))
+        tile_i = np.searchsorted(row_offsets, u_idx[found_idx], side="right") - 1
+        tile_j = np.searchsorted(col_offsets, v_idx[found_idx], side="right") - 1
+        tile_keys = tile_i * self.num_col_tiles + tile_j
+        for tile_key in np.unique(tile_keys).tolist():
+            i, j = divmod(tile_key, self.num_col_tiles)
+            idx = found_idx[tile_keys == tile_key]
+            values[idx] = self.get_tile(i, j)[u_idx[idx] - row_offsets[i], v_idx[idx] - col_offsets[j]]
+        return values
+
+
+def import_adj_matrix(file_prefix: str, batch_num: int, name: str = None, is_sparse: bool = False,
+                      store_path: str = None) -> TileStore:
+    """
+    Import tiles (i, j, batch_num) of AdjMatrix (or SparseAdjMatrix) files in ADJ_PATH into a TileStore.
+    """
+    row_blocks, col_blocks, dtype = AdjMatrix._load_block_vertices(file_prefix, batch_num)
+    matrix_cls = SparseAdjMatrix if is_sparse else AdjMatrix
+
+    store = None
+    for i in range(batch_num):
+        for j in range(batch_num):
+            mat = matrix_cls(row_vertices=[], col_vertices=[], tuple_key=(i, j, batch_num), file_prefix=file_prefix)
+            mat.load()
+            if store is None:
+                store = TileStore.create(name or file_prefix,
+                                         row_vertices=np.concatenate(row_blocks),
+                                         col_vertices=np.concatenate(col_blocks),
+                                         row_offsets=np.cumsum([0] + [len(b) for b in row_blocks]).tolist(),
+                                         col_offsets=np.cumsum([0] + [len(b) for b in col_blocks]).tolist(),
+                                         dtype=np.int8 if is_sparse else dtype,
+                                         initial_value=mat.initial_value, store_path=store_path)
+            store.write_tile(i, j, mat.to_dense().arr if is_sparse else mat.arr)
+    store.flush()
+    return store
+
+
+if __name__ == '__main__':
+
+    MODE = "IMPORT"  # IMPORT, INFO
+
+    store_name = "network_adj"
+
+    if MODE == "IMPORT":
+        import_adj_matrix(file_prefix="network_adj", batch_num=4, name=store_name)
+
+    elif MODE == "INFO":
+        tile_store = TileStore(store_name).open()
+        print(tile_store.shape, tile_store.dtype, "{} x {} tiles".format(
+            tile_store.num_row_tiles, tile_store.num_col_tiles))
@@ -0,0 +1,211 @@
+import os
+import struct
+from typing import Iterable, Iterator, List
+
+import numpy as np
+
+from serialization import atomic_open
+
+USER_DTYPE = np.uint64
+MERGE_CHUNK_SIZE = 1 << 22  # Elements read from each shard per merge round
+
+_NPY_HEADER_SIZE = 128
+
+
+def to_user_array(user_ids) -> np.ndarray:
+    """
+    :param user_ids: set, list or np.ndarray of int user ids
+    :return: sorted and deduplicated np.ndarray of USER_DTYPE
+    """
+    if isinstance(user_ids, np.ndarray):
+        return np.unique(user_ids.astype(USER_DTYPE, copy=False))
+    return np.unique(np.fromiter((int(u) for u in user_ids), dtype=USER_DTYPE, count=len(user_ids)))
+
+
+def is_in_user_array(user_ids: np.ndarray, user_array: np.ndarray) -> np.ndarray:
+    """
+    :param user_ids: np.ndarray of any int dtype
+    :param user_array: sorted np.ndarray of USER_DTYPE
+    :return: bool mask of user_ids that are in user_array, by binary search.
+    """
+    user_ids = np.asarray(user_ids, dtype=USER_DTYPE)
+    if len(user_array) == 0:
+        return np.zeros(len(user_ids), dtype=bool)
+    idx = np.searchsorted(user_array, user_ids)
+    idx[idx == len(user_array)] = 0
+    return user_array[idx] == user_ids
+
+
+def hash_user_ids(user_ids, seed: int = 0) -> np.ndarray:
+    """
+    :return: np.uint64 array of splitmix64 hashes of user ids, deterministic under seed
+    """
+    with np.errstate(over="ignore"):
+        x = np.asarray(user_ids, dtype=USER_DTYPE) + np.uint64(seed + 1) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+class UserArrayWriter:
+
+    def __init__(self, file_path: str):
+        """
+        Write a .npy file of USER_DTYPE chunk by chunk, without knowing the total length in advance.
+        Chunks must be sorted, deduplicated, and written in increasing order.
+        """
+        self.file_path = file_path
+        self.length = 0
+        self._context = atomic_open(file_path)
+        self._f = self._context.__enter__()
+        self._f.write(b"\x00" * _NPY_HEADER_SIZE)
+
+    def write(self, chunk: np.ndarray):
+        chunk = np.ascontiguousarray(chunk, dtype=USER_DTYPE)
+        self._f.write(chunk.tobytes())
+        self.length += len(chunk)
+
+    def close(self):
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(
+            np.dtype(USER_DTYPE).str, self.length)
+        header = header.ljust(_NPY_HEADER_SIZE - 10 - 1) + "\n"
+        self._f.seek(0)
+        self._f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+        self._f.seek(0, os.SEEK_END)
+        self._context.__exit__(None, None, None)
+
+    def abort(self, exc):
+        self._context.__exit__(type(exc), exc, exc.__traceback__)
+
+
+def dump_user_array(user_array: np.ndarray, file_path: str):
+    with atomic_open(file_path) as f:
+        np.save(f, np.asarray(user_array, dtype=USER_DTYPE))
+
+
+def load_user_array(file_path: str, mmap: bool = True) -> np.ndarray:
+    return np.load(file_path, mmap_mode="r" if mmap else None)
+
+
+def dump_user_array_chunks(chunks: Iterable[np.ndarray], file_path_format: str, shard_size: int) -> List[str]:
+    """
+    :param chunks: sorted and disjoint chunks in increasing order (e.g., from iter_union)
+    :param file_path_format: e.g., "/path/reduced_user_set_{}.npy", formatted with the shard index
+    :param shard_size: max number of users in a shard
+    :return: list of dumped file paths
+    """
+    file_paths, writer = [], None
+    try:
+        for chunk in chunks:
+            while len(chunk) > 0:
+                if writer is None:
+                    writer = UserArrayWriter(file_path_format.format(len(file_paths)))
+                    file_paths.append(writer.file_path)
+                n = min(shard_size - writer.length, len(chunk))
+                writer.write(chunk[:n])
+                chunk = chunk[n:]
+                if writer.length >= shard_size:
+                    writer.close()
+                    writer = None
+    except BaseException as e:
+        if writer is not None:
+            writer.abort(e)
+        raise
+    if writer is not None:
+        writer.close()
+    return file_paths
+
+
+def _iter_merge_rounds(groups: List[List[np.ndarray]], chunk_size: int) -> Iterator[List[np.ndarray]]:
+    """
+    k-way merge over sorted arrays: each round consumes every value <= bound from all arrays,
+    where bound is the smallest last value of the chunks read in the round.
+    So the rounds partition the value range, and a set operation can be applied round by round.
+
+    :return: iterator of the union of values of each group in the round
+    """
+    arrays = [a for group in groups for a in group]
+    group_of_array = [gi for gi, group in enumerate(groups) for _ in group]
+    positions = [0] * len(arrays)
+
+    while True:
+        heads = [a[p:p + chunk_size] for a, p in zip(arrays, positions)]
+        non_empty = [h for h in heads if len(h) > 0]
+        if not non_empty:
+            return
+        bound = min(h[-1] for h in non_empty)
+
+        parts_of_group = [[] for _ in groups]
+        for i, h in enumerate(heads):
+            n = int(np.searchsorted(h, bound, side="right"))
+            positions[i] += n
+            parts_of_group[group_of_array[i]].append(np.asarray(h[:n], dtype=USER_DTYPE))
+
+        yield [np.unique(np.concatenate(parts)) if parts else np.asarray([], dtype=USER_DTYPE)
+               for parts in parts_of_group]
+
+
+def iter_union(arrays: List[np.ndarray], chunk_size: int = MERGE_CHUNK_SIZE) -> Iterator[np.ndarray]:
+    for union_part, in _iter_merge_rounds([arrays], chunk_size):
+        if len(union_part) > 0:
+            yield union_part
+
+
+def iter_intersection(groups: List[List[np.ndarray]], chunk_size: int = MERGE_CHUNK_SIZE) -> Iterator[np.ndarray]:
+    """
+    :param groups: list of sets, each is a list of sorted shards.
+    """
+    for parts in _iter_merge_rounds(groups, chunk_size):
+        intersection = parts[0]
+        for part in parts[1:]:
+            intersection = np.intersect1d(intersection, part, assume_unique=True)
+        if len(intersection) > 0:
+            yield intersection
+
+
+def iter_difference(arrays: List[np.ndarray], arrays_to_subtract: List[np.ndarray],
+                    chunk_size: int = MERGE_CHUNK_SIZE) -> Iterator[np.ndarray]:
+    for part, part_to_subtract in _iter_merge_rounds([arrays, arrays_to_subtract], chunk_size):
+        difference = np.setdiff1d(part, part_to_subtract, assume_unique=True)
+        if len(difference) > 0:
+            yield difference
+
+
+def sample_bottom_k(arrays: Iterable[np.ndarray], k: int, seed: int = 0,
+                    chunk_size: int = MERGE_CHUNK_SIZE) -> np.ndarray:
+    """
+    Uniform sampling without replacement in a single pass: keep k users of the smallest hashes.
+    Memory is bounded by O(k + chunk_size), and duplicated users are sampled at most once.
+
+    :return: np.ndarray of at most k users, ordered by hash.
+        - Its prefix of length k' <= k is also a uniform sample of size k'.
+    """
+    sampled_ids = np.asarray([], dtype=USER_DTYPE)
+    sampled_hashes = np.asarray([], dtype=np.uint64)
+    threshold = None
+    if k <= 0:
+        return sampled_ids
+
+    def prune(ids, hashes, size):
+        ids, first_idx = np.unique(ids, return_index=True)
+        hashes = hashes[first_idx]
+        if len(ids) > size:
+            kept = np.argpartition(hashes, size - 1)[:size]
+            ids, hashes = ids[kept], hashes[kept]
+        return ids, hashes
+
+    for array in arrays:
+        for base in range(0, len(array), chunk_size):
+            chunk = np.asarray(array[base:base + chunk_size], dtype=USER_DTYPE)
+            hashes = hash_user_ids(chunk, seed)
+            if threshold is not None:
+                below = hashes <= threshold
+                chunk, hashes = chunk[below], hashes[below]
+            sampled_ids = np.concatenate((sampled_ids, chunk))
+            sampled_hashes = np.concatenate((sampled_hashes, hashes))
+            if len(sampled_ids) > 2 * k:
+                sampled_ids, sampled_hashes = prune(sampled_ids, sampled_hashes, k)
+                threshold = sampled_hashes.max()
+
+    sampled_ids, sampled_hashes = prune(sampled_ids, sampled_hashes, k)
+    return sampled_ids[np.argsort(sampled_hashes, kind="stable")]
@@ -0,0 +1,225 @@
+from typing import Dict
+
+import numpy as np
+
+from serialization import atomic_open
+from user_array import USER_DTYPE, to_user_array, is_in_user_array
+
+CONTAINER_BITS = 16
+CONTAINER_SIZE = 1 << CONTAINER_BITS
+ARRAY_CONTAINER_LIMIT = 4096  # An array container of more values is larger than a bitmap container (8KB).
+
+
+class UserIdInterner:
+
+    def __init__(self, user_ids, is_sorted: bool = False):
+        """
+        Map user ids in a universe to dense interned ids, 0 to len(universe) - 1.
+
+        :param user_ids: set, list or np.ndarray of the universe
+        :param is_sorted: user_ids is a sorted and deduplicated np.ndarray of USER_DTYPE (e.g., from count_values),
+            which is used without a copy.
+        """
+        self.user_ids: np.ndarray = user_ids if is_sorted else to_user_array(user_ids)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def intern(self, user_ids) -> np.ndarray:
+        """
+        :return: np.int64 array of interned ids, -1 for user ids not in the universe
+        """
+        user_ids = np.asarray(user_ids, dtype=USER_DTYPE)
+        interned = np.searchsorted(self.user_ids, user_ids).astype(np.int64)
+        interned[~is_in_user_array(user_ids, self.user_ids)] = -1
+        return interned
+
+    def extern(self, interned_ids) -> np.ndarray:
+        return self.user_ids[np.asarray(interned_ids, dtype=np.int64)]
+
+
+def _to_low_array(container: np.ndarray) -> np.ndarray:
+    if container.dtype == np.uint16:
+        return container
+    return np.flatnonzero(np.unpackbits(container, bitorder="little")).astype(np.uint16)
+
+
+def _to_container(low_array: np.ndarray) -> np.ndarray or None:
+    """
+    :param low_array: sorted unique np.uint16 array
+    :return: np.uint16 array container, np.uint8 bitmap container (CONTAINER_SIZE bits), or None if empty
+    """
+    if len(low_array) == 0:
+        return None
+    if len(low_array) <= ARRAY_CONTAINER_LIMIT:
+        return low_array.astype(np.uint16, copy=False)
+    bits = np.zeros(CONTAINER_SIZE, dtype=bool)
+    bits[low_array] = True
+    return np.packbits(bits, bitorder="little")
+
+
+def _cardinality(container: np.ndarray) -> int:
+    if container.dtype == np.uint16:
+        return len(container)
+    return int(np.unpackbits(container).sum())
+
+
+class UserBitmap:
+
+    def __init__(self, containers: Dict[int, np.ndarray] = None):
+        """
+        Roaring-style compressed bitmap of interned user ids (non-negative ints < 2^32).
+        Ids are grouped by their high 16 bits, and the low 16 bits of each group are stored
+        either as a sorted np.uint16 array (sparse) or as an 8KB np.uint8 bitmap (dense).
+
+        :param containers: dict, high bits (int) -> container (np.ndarray)
+        """
+        self.containers: Dict[int, np.ndarray] = containers or dict()
+        self._lookup = None
+
+    @classmethod
+    def from_ids(cls, interned_ids) -> "UserBitmap":
+        interned_ids = np.unique(np.asarray(interned_ids, dtype=np.int64))
+        interned_ids = interned_ids[interned_ids >= 0]
+        highs = interned_ids >> CONTAINER_BITS
+        unique_highs, starts = np.unique(highs, return_index=True)
+        ends = np.append(starts[1:], len(interned_ids))
+        containers = dict()
+        for high, s, e in zip(unique_highs.tolist(), starts, ends):
+            containers[high] = _to_container((interned_ids[s:e] & (CONTAINER_SIZE - 1)).astype(np.uint16))
+        return cls(containers)
+
+    def __len__(self):
+        return sum(_cardinality(c) for c in self.containers.values())
+
+    def __repr__(self):
+        return "UserBitmap({} ids in {} containers)".format(len(self), len(self.containers))
+
+    def nbytes(self) -> int:
+        return sum(c.nbytes for c in self.containers.values())
+
+    def to_array(self) -> np.ndarray:
+        """
+        :return: sorted np.int64 array of interned ids
+        """
+        if not self.containers:
+            return np.asarray([], dtype=np.int64)
+        return np.concatenate([(high << CONTAINER_BITS) + _to_low_array(self.containers[high]).astype(np.int64)
+                               for high in sorted(self.containers)])
+
+    def add_many(self, interned_ids):
+        self.containers = (self | UserBitmap.from_ids(interned_ids)).containers
+        self._lookup = None
+
+    def _get_lookup(self) -> np.ndarray:
+        """
+        :return: packed np.uint8 bits of all ids up to the largest container, cached until containers change.
+            - Its size is at most (number of interned ids) / 8 bytes, i.e., 1/64 of the interned user ids.
+        """
+        if self._lookup is None:
+            highs = sorted(self.containers)
+            lookup = np.zeros((highs[-1] + 1 if highs else 0) * (CONTAINER_SIZE // 8), dtype=np.uint8)
+            for high in highs:
+                container = self.containers[high]
+                if container.dtype == np.uint8:
+                    lookup[high * (CONTAINER_SIZE // 8):(high + 1) * (CONTAINER_SIZE // 8)] = container
+                else:
+                    ids = (high << CONTAINER_BITS) + container.astype(np.int64)
+                    np.bitwise_or.at(lookup, ids >> 3, np.left_shift(1, ids & 7).astype(np.uint8))
+            self._lookup = lookup
+        return self._lookup
+
+    def contains_many(self, interned_ids) -> np.ndarray:
+        """
+        Vectorized over ids by one read of the bit of each id, without sorting or grouping ids.
+
+        :param interned_ids: np.ndarray of interned ids (negative ids are never contained)
+        :return: bool mask of the same length
+        """
+        interned_ids = np.asarray(interned_ids, dtype=np.int64)
+        lookup = self._get_lookup()
+        is_valid = (interned_ids >= 0) & (interned_ids < len(lookup) * 8)
+        if is_valid.all():
+            return ((lookup[interned_ids >> 3] >> (interned_ids & 7).astype(np.uint8)) & 1) == 1
+        mask = np.zeros(len(interned_ids), dtype=bool)
+        ids = interned_ids[is_valid]
+        mask[is_valid] = ((lookup[ids >> 3] >> (ids & 7).astype(np.uint8)) & 1) == 1
+        return mask
+
+    def _combine(self, other: "UserBitmap", bitmap_op, array_op,
+                 keep_self_only: bool, keep_other_only: bool) -> "UserBitmap":
+        containers = dict()
+        for high in set(self.containers) | set(other.containers):
+            a, b = self.containers.get(high), other.containers.get(high)
+            if b is None:
+                if keep_self_only:
+                    containers[high] = a
+            elif a is None:
+                if keep_other_only:
+                    containers[high] = b
+            else:
+                if a.dtype == np.uint8 and b.dtype == np.uint8:
+                    c = _to_container(_to_low_array(bitmap_op(a, b)))
+                else:
+                    c = _to_container(array_op(_to_low_array(a), _to_low_array(b)))
+                if c is not None:
+                    containers[high] = c
+        return UserBitmap(containers)
+
+    def __or__(self, other: "UserBitmap") -> "UserBitmap":
+        return self._combine(other, np.bitwise_or, np.union1d, keep_self_only=True, keep_other_only=True)
+
+    def __and__(self, other: "UserBitmap") -> "UserBitmap":
+        return self._combine(other, np.bitwise_and, lambda a, b: np.intersect1d(a, b, assume_unique=True),
+                             keep_self_only=False, keep_other_only=False)
+
+    def __sub__(self, other: "UserBitmap") -> "UserBitmap":
+        return self._combine(other, lambda a, b: np.bitwise_and(a, np.invert(b)),
+                             lambda a, b: np.setdiff1d(a, b, assume_unique=True),
+                             keep_self_only=True, keep_other_only=False)
+
+    def dump(self, file_path: str):
+        highs = sorted(self.containers)
+        containers = [self.containers[high] for high in highs]
+        with atomic_open(file_path) as f:
+            np.savez(f,
+                     highs=np.asarray(highs, dtype=np.int64),
+                     is_bitmap=np.asarray([c.dtype == np.uint8 for c in containers], dtype=bool),
+                     lengths=np.asarray([len(c) for c in containers], dtype=np.int64),
+                     data=np.concatenate([c.view(np.uint8) for c in containers]) if containers
+                     else np.asarray([], dtype=np.uint8))
+
+    @classmethod
+    def load(cls, file_path: str) -> "UserBitmap":
+        with np.load(file_path) as loaded:
+            highs, is_bitmap, lengths, data = loaded["highs"], loaded["is_bitmap"], loaded["lengths"], loaded["data"]
+        containers, base = dict(), 0
+        for high, bitmap, length in zip(highs.tolist(), is_bitmap, lengths):
+            nbytes = int(length) if bitmap else 2 * int(length)
+            chunk = data[base:base + nbytes].copy()
+            containers[high] = chunk if bitmap else chunk.view(np.uint16)
+            base += nbytes
+        return cls(containers)
+
+
+class UserSetBitmap:
+
+    def __init__(self, user_ids, interner: UserIdInterner):
+        """
+        Set of raw user ids backed by UserBitmap over the ids interned by interner.
+        """
+        self.interner = interner
+        self.bitmap = UserBitmap.from_ids(interner.intern(to_user_array(user_ids)))
+
+    def __len__(self):
+        return len(self.bitmap)
+
+    def contains_many(self, user_ids) -> np.ndarray:
+        return self.bitmap.contains_many(self.interner.intern(user_ids))
+
+    def filter(self, user_ids) -> np.ndarray:
+        """
+        :return: user ids (np.ndarray of USER_DTYPE) in this set, in the given order
+        """
+        user_ids = np.asarray(user_ids, dtype=USER_DTYPE)
+        return user_ids[self.contains_many(user_ids)]
@@ -1,58 +1,100 @@
 import os
-from typing import Set
+from typing import Callable, Iterable, List
 
-import pickle
 import numpy as np
 
 from termcolor import cprint
 
 from network import UserNetwork, NETWORK_PATH
+from serialization import dump_pickle, load_pickle
+from user_array import USER_DTYPE, to_user_array, dump_user_array, load_user_array, dump_user_array_chunks, \
+    iter_union, iter_difference, sample_bottom_k
+from utill import round_up_division
+from crawl_index import CrawledUserIndex, get_or_create_crawled_user_index
 
 SIZE_LIMIT = 10000 * 10000
 USER_SET_PATH = os.path.join(NETWORK_PATH, "user_set")
+USER_SET_EXT = ".npy"
 
 
-def dump_user_set(user_set, file, user_set_path=None):
+def dump_user_set(user_set, file, user_set_path=None, compress_level=0):
+    """
+    :param user_set: set or np.ndarray of int user ids
+    :param file: .npy files are stored as sorted uint64 arrays (user_array), others are pickled.
+    """
     user_set_path = user_set_path or USER_SET_PATH
-    with open(os.path.join(user_set_path, file), 'wb') as f:
-        pickle.dump(user_set, f)
+    if file.endswith(".npy"):
+        dump_user_array(to_user_array(user_set), os.path.join(user_set_path, file))
+    else:
+        dump_pickle(user_set, os.path.join(user_set_path, file), compress_level=compress_level)
     cprint("Dump user set: {} in {} users".format(file, len(user_set)), "blue")
 
 
-def load_user_set(file, user_set_path=None):
+def load_user_set(file, user_set_path=None, as_array=False):
+    """
+    :param as_array: if True, return a sorted uint64 np.ndarray (memory-mapped for .npy) instead of a set.
+    """
     user_set_path = user_set_path or USER_SET_PATH
-    with open(os.path.join(user_set_path, file), 'rb') as f:
-        loaded_user_set = pickle.load(f)
-        cprint("Load user set: {} in {} users".format(file, len(loaded_user_set)), "green")
-        return loaded_user_set
+    if file.endswith(".npy"):
+        loaded_user_set = load_user_array(os.path.join(user_set_path, file))
+        if not as_array:
+            loaded_user_set = set(loaded_user_set.tolist())
+    else:
+        loaded_user_set = load_pickle(os.path.join(user_set_path, file))
+        if as_array:
+            loaded_user_set = to_user_array(loaded_user_set)
+    cprint("Load user set: {} in {} users".format(file, len(loaded_user_set)), "green")
+    return loaded_user_set
+
+
+def get_user_set_files(file_prefix, user_set_path=None) -> List[str]:
+    user_set_path = user_set_path or USER_SET_PATH
+    return sorted(f for f in os.listdir(user_set_path) if f.startswith(file_prefix))
+
+
+def load_user_arrays(file_prefix, user_set_path=None) -> List[np.ndarray]:
+    """
+    :return: list of sorted uint64 arrays of shards that start with file_prefix
+    """
+    return [load_user_set(f, user_set_path=user_set_path, as_array=True)
+            for f in get_user_set_files(file_prefix, user_set_path)]
 
 
-def dump_user_set_distributively(user_set, file_prefix, number=3):
-    base = 0
-    size = int(len(user_set)/number) + 1
-    user_list = list(user_set)
-    for i in range(number):
-        sub_user_set = set(user_list[base:base+size])
-        dump_user_set(sub_user_set, f"{file_prefix}_{i}.pkl")
-        base += size
+def dump_user_set_distributively(user_set, file_prefix, number=3, user_set_path=None):
+    user_array = to_user_array(user_set)
+    for i, sub_user_array in enumerate(np.array_split(user_array, number)):
+        dump_user_set(sub_user_array, f"{file_prefix}_{i}{USER_SET_EXT}", user_set_path=user_set_path)
+
+
+def dump_user_array_chunks_distributively(get_chunks: Callable[[], Iterable[np.ndarray]], file_prefix,
+                                          number=3, user_set_path=None):
+    """
+    :param get_chunks: function that returns sorted disjoint chunks (e.g., lambda: iter_union(arrays))
+        - It is called twice: to count users and to dump them into equal-sized shards.
+    """
+    user_set_path = user_set_path or USER_SET_PATH
+    total_num = sum(len(chunk) for chunk in get_chunks())
+    file_paths = dump_user_array_chunks(
+        get_chunks(),
+        os.path.join(user_set_path, file_prefix + "_{}" + USER_SET_EXT),
+        shard_size=round_up_division(total_num, number) or 1,
+    )
+    cprint("Dump user set: {} in {} users, {} files".format(file_prefix, total_num, len(file_paths)), "blue")
 
 
 def load_user_set_distributively(file_prefix, user_set_path=None):
     user_set_path = user_set_path or USER_SET_PATH
-    user_list = []
-    for i, file in enumerate([f for f in os.listdir(user_set_path) if f.startswith(file_prefix)]):
-        sub_user_set = load_user_set(file)
-        user_list += list(sub_user_set)
-    print("Total user number: {}".format(len(user_list)))
-    return set(user_list)
+    user_set = set()
+    for file in get_user_set_files(file_prefix, user_set_path):
+        user_set.update(load_user_set(file, user_set_path=user_set_path))
+    print("Total user number: {}".format(len(user_set)))
+    return user_set
 
 
 def get_unique_user_partition_set_from_network(file_name: str or None, postfix_of_file_prefix: str):
     user_network = UserNetwork()
     user_network.load(file_name=file_name)
 
-    user_set: Set[int] = set()
-
     if file_name and "friend " in file_name:
         user_id_to_x = user_network.user_id_to_friend_ids
     else:
@@ -60,50 +102,47 @@ def get_unique_user_partition_set_from_network(file_name: str or None, postfix_o
 
     total_length = 0
 
+    # Users are gathered into arrays, and deduplicated when a partition is dumped.
+    user_array_list: List[np.ndarray] = []
+    length = 0
+
     i = -1
     for i, (user, f_list) in enumerate(user_id_to_x.items()):
 
         if f_list is None:
-            user_set.add(int(user))
+            user_array_list.append(np.asarray([int(user)], dtype=USER_DTYPE))
+            length += 1
             continue
 
-        length = len(user_set)
-
         if length + len(f_list) >= SIZE_LIMIT:
-            dump_user_set(user_set, "user_set_{}_{}.pkl".format(postfix_of_file_prefix, i))
-            user_set = set()
+            dump_user_set(np.concatenate(user_array_list),
+                          "user_set_{}_{}{}".format(postfix_of_file_prefix, i, USER_SET_EXT))
+            user_array_list, length = [], 0
 
-        user_set.add(int(user))
-        user_set.update(f_list)
-        total_length += length + 1
+        user_array_list.append(np.asarray([int(user)] + list(f_list), dtype=USER_DTYPE))
+        length += len(f_list) + 1
+        total_length += len(f_list) + 1
 
     else:
-        if len(user_set) != 0:
-            dump_user_set(user_set, "user_set_{}_{}.pkl".format(postfix_of_file_prefix, i + 1))
+        if len(user_array_list) != 0:
+            dump_user_set(np.concatenate(user_array_list),
+                          "user_set_{}_{}{}".format(postfix_of_file_prefix, i + 1, USER_SET_EXT))
 
     print("Total length: {}".format(total_length))
 
 
 def reduce_user_partition(postfix_of_file_prefix, new_limit, user_set_path=None):
+    """
+    Union partitions by a streaming k-way merge, and dump them into shards of at most new_limit users.
+    """
     user_set_path = user_set_path or USER_SET_PATH
-
-    file_list = sorted([f for f in os.listdir(user_set_path)
-                        if f.startswith("user_set_{}".format(postfix_of_file_prefix))])
-
-    total_user_set = set()
-    i = -1
-    for i, file_name in enumerate(file_list):
-        user_set = load_user_set(file_name)
-        total_user_set.update(user_set)
-        print("Current total_user_set: {}".format(len(total_user_set)))
-
-        if len(total_user_set) >= new_limit:
-            dump_user_set(total_user_set, "reduced_user_set_{}_{}.pkl".format(postfix_of_file_prefix, i))
-            total_user_set = set()
-
-    else:
-        if len(total_user_set) != 0:
-            dump_user_set(total_user_set, "reduced_user_set_{}_{}.pkl".format(postfix_of_file_prefix, i + 1))
+    user_arrays = load_user_arrays("user_set_{}".format(postfix_of_file_prefix), user_set_path)
+    file_paths = dump_user_array_chunks(
+        iter_union(user_arrays),
+        os.path.join(user_set_path, "reduced_user_set_{}_{{}}{}".format(postfix_of_file_prefix, USER_SET_EXT)),
+        shard_size=new_limit,
+    )
+    cprint("Reduced {} partitions to {}".format(len(user_arrays), file_paths), "blue")
 
 
 def reduce_to_one_and_dump_distributively(file_prefix,
@@ -111,17 +150,8 @@ def reduce_to_one_and_dump_distributively(file_prefix,
                                           number=2,
                                           user_set_path=None):
     user_set_path = user_set_path or USER_SET_PATH
-
-    file_list = sorted([f for f in os.listdir(user_set_path)
-                        if f.startswith(file_prefix_to_merge)])
-
-    total_user_set = set()
-    for i, file_name in enumerate(file_list):
-        user_set = load_user_set(file_name)
-        total_user_set.update(user_set)
-        print("Current total_user_set: {}".format(len(total_user_set)))
-
-    dump_user_set_distributively(total_user_set, file_prefix, number)
+    user_arrays = load_user_arrays(file_prefix_to_merge, user_set_path)
+    dump_user_array_chunks_distributively(lambda: iter_union(user_arrays), file_prefix, number, user_set_path)
 
 
 def get_tiny_user_set(base_file_name, tiny_size):
@@ -133,34 +163,50 @@ def get_tiny_user_set(base_file_name, tiny_size):
 def get_user_set_minus_propagated_user_set(file_prefix_to_load="one_user_set",
                                            file_prefix_to_dump="not_propagated_user_set"):
 
-    user_set = load_user_set_distributively(file_prefix_to_load)
-    total_num = len(user_set)
+    user_arrays = load_user_arrays(file_prefix_to_load)
+    total_num = sum(len(a) for a in user_arrays)
 
     user_network = UserNetwork()
     user_network.load("UserNetwork_friends.pkl")
-    propagated_user_set = set(int(u) for u in user_network.user_id_to_friend_ids)
+    propagated_user_list = [int(u) for u in user_network.user_id_to_friend_ids]
 
     user_leaves_network = UserNetwork()
     user_leaves_network.load("UserNetwork_friends_leaves.pkl")
-    propagated_user_set.update(set(int(u) for u in user_leaves_network.user_id_to_friend_ids))
+    propagated_user_list += [int(u) for u in user_leaves_network.user_id_to_friend_ids]
 
-    propagated_num = len(propagated_user_set)
+    propagated_user_array = to_user_array(propagated_user_list)
+    propagated_num = len(propagated_user_array)
     print("Total({}) - Propagated({}) = {}".format(total_num, propagated_num, total_num - propagated_num))
 
-    dump_user_set_distributively(user_set - propagated_user_set, file_prefix_to_dump, 2)
+    dump_user_array_chunks_distributively(lambda: iter_difference(user_arrays, [propagated_user_array]),
+                                          file_prefix_to_dump, 2)
 
 
-def sample_user_set(original_file_prefix, sample_nums, number=1, seed=42):
+def get_user_set_minus_crawled_user_set(crawl_index: CrawledUserIndex,
+                                        file_prefix_to_load="one_user_set",
+                                        file_prefix_to_dump="not_crawled_user_set",
+                                        number=2):
+    """
+    Plan a crawl frontier by streaming user set shards through crawl_index, without loading any UserNetwork.
+    """
+    user_arrays = load_user_arrays(file_prefix_to_load)
+    dump_user_array_chunks_distributively(
+        lambda: (crawl_index.filter_not_crawled(chunk) for chunk in iter_union(user_arrays)),
+        file_prefix_to_dump, number,
+    )
 
-    user_ndarray = np.asarray(list(load_user_set_distributively(original_file_prefix)))
-    np.random.seed(seed)
-    permutation = np.random.permutation(user_ndarray.size)
+
+def sample_user_set(original_file_prefix, sample_nums, number=1, seed=42):
+    """
+    Sample users of every size in sample_nums by one pass over the shards (see user_array.sample_bottom_k).
+    Smaller samples are subsets of larger ones.
+    """
+    user_arrays = load_user_arrays(original_file_prefix)
+    sampled = sample_bottom_k(user_arrays, max(sample_nums), seed=seed)
 
     for sample_num in sample_nums:
-        indices = permutation[:sample_num]
-        sampled = set(user_ndarray[indices])
         dump_user_set_distributively(
-            sampled,
+            sampled[:sample_num],
             "sampled_{}_{}_{}".format(original_file_prefix, seed, sample_num),
             number,
         )
@@ -193,10 +239,15 @@ if __name__ == '__main__':
     elif MODE == "MINUS_PROPAGATED":
         get_user_set_minus_propagated_user_set()
 
+    elif MODE == "MINUS_CRAWLED":
+        get_user_set_minus_crawled_user_set(get_or_create_crawled_user_index(
+            "crawled_friends", network_files=["UserNetwork_friends.pkl", "UserNetwork_friends_leaves.pkl"],
+        ))
+
     elif MODE == "SAMPLE_USER_SET":
         sample_user_set("not_propagated_user_set", [362232*4, 362232*9, 362232*49, 362232*99])
 
     else:
-        user_set = load_user_set("sampled_not_propagated_user_set_42_1448928_0.pkl")
+        user_set = load_user_set("sampled_not_propagated_user_set_42_1448928_0.npy")
         print("User set: {}".format(len(user_set)))
         print("Sample: {}".format(list(user_set)[:5]))